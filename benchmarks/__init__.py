@@ -0,0 +1,6 @@
+# benchmarks
+# قياس أداء main.py على بيانات حقيقية (اللقطات المحلية) أو مولّدة بأي حجم
+# التشغيل من جذر المستودع:
+#   python -m benchmarks --rows 10000 100000 1000000
+#   python -m benchmarks.dates
+#   python -m benchmarks.memory
@@ -0,0 +1,189 @@
+# benchmarks/__main__.py
+# قياس الدوال الأساسية في main.py على بيانات مولّدة بأحجام متزايدة: الزمن، عدد الصفوف في الثانية، وأعلى استهلاك للذاكرة
+# التشغيل من جذر المستودع:
+#   python -m benchmarks --rows 10000 100000 1000000
+#   python -m benchmarks --rows 5000000 --repeat 1 --no-memory
+#   python -m benchmarks --json results.json --baseline previous.json
+
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import main
+from main import (SheetDataset, parse_date_safely, parse_date_column, _parse_date_text, search_data_for_web,
+                  advanced_search_data, analyze_sales_data, analyze_sales_trends, get_dashboard_stats, save_data_locally, load_snapshot)
+from benchmarks.synthetic import generate_main_rows, generate_sales_rows
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+SALES_PERIODS = ('all', 'day', 'week', '2weeks', 'month')
+
+def advanced_queries(rows):
+    today = rows[-1][0]
+    return [{}, {'payment_method': 'udf19'}, {'payment_method': 'cash', 'amount_min': '500'},
+            {'customer_name': 'محمد'}, {'cashier_name': 'raafat', 'amount_max': '100'},
+            {'date_from': parse_date_safely(today).strftime('%Y-%m-%d')}]
+
+def search_queries(rows):
+    """أرقام فواتير وهواتف موجودة، هاتف بدون الصفر الأول، وقيم غير موجودة"""
+    picks = [rows[len(rows) * i // 5] for i in range(5)]
+    return ([(row[1], 'invoice') for row in picks] + [('99999999999', 'invoice')]
+            + [(row[6], 'phone') for row in picks] + [(picks[0][6][1:], 'phone'), ('01999999999', 'phone')])
+
+@contextmanager
+def snapshot_directory():
+    """اللقطة المحلية تُكتب في مجلد العمل، فالقياس يتم في مجلد مؤقت حتى لا تُستبدل بيانات المستودع"""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield
+        finally:
+            os.chdir(previous)
+
+def benchmark_cases(main_rows, sales_rows):
+    """[(الاسم، عدد الصفوف التي تعالجها، دالة تجهيز تعيد الدالة المقاسة)]
+    التجهيز يبني SheetDataset جديداً حتى يشمل القياس الأول بناء الفهارس والتجميعات"""
+    main_dates = [row[0] for row in main_rows]
+    sales_dates = [row[0] for row in sales_rows]
+    queries, params = search_queries(main_rows), advanced_queries(main_rows)
+
+    def dates_per_row(values):
+        def run():
+            _parse_date_text.cache_clear()
+            return [parse_date_safely(value) for value in values]
+        return lambda: run
+
+    def on_dataset(rows, sheet_type, func):
+        def setup():
+            ds = SheetDataset(rows, sheet_type)
+            return lambda: func(ds)
+        return setup
+
+    def save(ds):
+        # save_data_locally يسجل الخطأ ويعيد None بدلاً من رفع استثناء
+        if save_data_locally(ds, 'main') is None:
+            raise RuntimeError('snapshot save failed')
+
+    def snapshot_save():
+        ds = SheetDataset(main_rows, 'main')
+        return lambda: save(ds)
+
+    def snapshot_load():
+        save(SheetDataset(main_rows, 'main'))
+        return lambda: load_snapshot('main')
+
+    return [
+        ('parse_date_safely main', len(main_rows), dates_per_row(main_dates)),
+        ('parse_date_safely sales', len(sales_rows), dates_per_row(sales_dates)),
+        ('parse_date_column main', len(main_rows), lambda: lambda: parse_date_column(main_dates)),
+        ('parse_date_column sales', len(sales_rows), lambda: lambda: parse_date_column(sales_dates)),
+        ('SheetDataset main', len(main_rows), lambda: lambda: SheetDataset(main_rows, 'main')),
+        ('SheetDataset sales', len(sales_rows), lambda: lambda: SheetDataset(sales_rows, 'sales')),
+        ('search_data_for_web', len(main_rows) * len(queries),
+         on_dataset(main_rows, 'main', lambda ds: [search_data_for_web(query, search_type, ds) for query, search_type in queries])),
+        ('advanced_search_data', len(main_rows) * len(params),
+         on_dataset(main_rows, 'main', lambda ds: [advanced_search_data(p, ds) for p in params])),
+        ('analyze_sales_data', len(sales_rows) * len(SALES_PERIODS),
+         on_dataset(sales_rows, 'sales', lambda ds: [analyze_sales_data(ds, period) for period in SALES_PERIODS])),
+        ('analyze_sales_trends', len(sales_rows) * len(SALES_PERIODS),
+         on_dataset(sales_rows, 'sales', lambda ds: [analyze_sales_trends(ds, period) for period in SALES_PERIODS])),
+        ('get_dashboard_stats', len(main_rows), on_dataset(main_rows, 'main', get_dashboard_stats)),
+        ('snapshot save', len(main_rows), snapshot_save),
+        ('snapshot load', len(main_rows), snapshot_load),
+    ]
+
+def measure(setup, repeat, memory):
+    """القياس الأول (بارد)، أفضل قياس من التكرارات التالية (دافئ)، وأعلى ذاكرة إضافية أثناء القياس البارد بالميجابايت"""
+    gc.collect()
+    func = setup()
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    warm = cold
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        func()
+        warm = min(warm, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        # tracemalloc يبطئ التنفيذ، فيُقاس في تشغيل منفصل عن قياس الزمن
+        func = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func = setup()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            peak = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return cold, warm, peak
+
+def max_rss_mb():
+    if resource is None: return None
+    # ru_maxrss بالكيلوبايت على Linux وبالبايت على macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+def run(sizes, repeat, memory, days):
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        main_rows, sales_rows = generate_main_rows(size, days=days), generate_sales_rows(size, days=days)
+        print(f"\n{size:,} rows (generated in {time.perf_counter() - start:.1f}s)")
+        print(f"  {'case':<26} {'cold ms':>11} {'warm ms':>11} {'rows/s':>14} {'peak MB':>9}")
+        with snapshot_directory():
+            for name, rows, setup in benchmark_cases(main_rows, sales_rows):
+                cold, warm, peak = measure(setup, repeat, memory)
+                results.append({'rows': size, 'case': name, 'cold_ms': cold * 1000, 'warm_ms': warm * 1000,
+                                'rows_per_second': rows / warm if warm else None, 'peak_mb': peak})
+                peak_text = f'{peak:9.1f}' if peak is not None else f"{'-':>9}"
+                print(f"  {name:<26} {cold * 1000:11.2f} {warm * 1000:11.2f} {rows / warm:14,.0f} {peak_text}", flush=True)
+        main_rows = sales_rows = None
+        rss = max_rss_mb()
+        if rss is not None:
+            print(f"  process max RSS so far: {rss:,.0f} MB")
+    return results
+
+def compare(results, baseline_path):
+    """مقارنة الزمن الدافئ مع نتائج سابقة محفوظة بـ --json"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(entry['rows'], entry['case']): entry for entry in json.load(f)['results']}
+    print(f"\ncompared with {baseline_path} (warm time, >1.00 is slower):")
+    for entry in results:
+        previous = baseline.get((entry['rows'], entry['case']))
+        if not previous or not previous['warm_ms']: continue
+        ratio = entry['warm_ms'] / previous['warm_ms']
+        flag = '  <-- slower' if ratio > 1.2 else ''
+        print(f"  {entry['rows']:>10,} {entry['case']:<26} {ratio:6.2f}x{flag}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark main.py on synthetic sheet data')
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_SIZES), help='row counts to generate (per sheet)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case; the best warm run is reported')
+    parser.add_argument('--days', type=int, default=365, help='days of history the generated rows span')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass (much faster at millions of rows)')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='compare with results written earlier by --json')
+    args = parser.parse_args()
+
+    main.app.logger.setLevel(logging.WARNING)
+    results = run(args.rows, max(args.repeat, 1), not args.no_memory, args.days)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
@@ -0,0 +1,55 @@
+# benchmarks/dates.py
+# قياس سرعة تحليل التواريخ على البيانات المحلية المحفوظة (local_data_main.pkl و local_data_sales.pkl)
+# التشغيل من جذر المستودع: python -m benchmarks.dates
+
+import re
+import pickle
+import time
+import numpy as np
+from dateutil.parser import parse, ParserError
+from main import parse_date_safely, parse_date_column, _parse_date_text
+
+def legacy_parse_date(date_str):
+    """المسار القديم لـ parse_date_safely قبل التحسين (للمقارنة فقط)"""
+    if not date_str: return None
+    date_str = str(date_str).strip()
+    if not date_str: return None
+    try:
+        if '+' in date_str:
+            date_str = date_str.split('+')[0].strip()
+        match = re.match(r'(\d{1,2}-[A-Z]{3}-\d{2})\s+(\d{1,2})\.(\d{2})\.(\d{2})\s+(AM|PM)', date_str)
+        if match:
+            hour = int(match.group(2))
+            if match.group(5) == 'PM' and hour != 12:
+                hour += 12
+            elif match.group(5) == 'AM' and hour == 12:
+                hour = 0
+            return parse(f"{match.group(1)} {hour:02d}:{match.group(3)}:{match.group(4)}", fuzzy=True)
+        return parse(date_str, fuzzy=True)
+    except (ParserError, ValueError, TypeError):
+        return None
+
+def to_column(dates):
+    return np.array(dates, dtype='datetime64[s]')
+
+def load_dates(sheet_type):
+    with open(f'local_data_{sheet_type}.pkl', 'rb') as f:
+        return [row[0] if row else None for row in pickle.load(f)['data']]
+
+def timed(label, func, values, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        _parse_date_text.cache_clear()
+        start = time.perf_counter()
+        result = func(values)
+        best = min(best, time.perf_counter() - start)
+    parsed = int(np.count_nonzero(~np.isnat(result)))
+    print(f"  {label:<28} {best * 1000:9.2f} ms  {len(values) / best:12,.0f} rows/s  parsed={parsed}")
+
+if __name__ == '__main__':
+    for sheet_type in ['main', 'sales']:
+        values = load_dates(sheet_type)
+        print(f"{sheet_type}: {len(values)} rows")
+        timed('legacy dateutil per row', lambda v: to_column([legacy_parse_date(x) for x in v]), values)
+        timed('parse_date_safely per row', lambda v: to_column([parse_date_safely(x) for x in v]), values)
+        timed('parse_date_column (batch)', parse_date_column, values)
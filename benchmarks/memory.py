@@ -0,0 +1,88 @@
+# benchmarks/memory.py
+# حجم الصفوف الخام في الذاكرة وعلى القرص: قوائم Python كما تأتي من get_all_values (والـ pickle القديم)
+# مقابل الصيغة المضغوطة (RowBlock)، على اللقطات المحلية المرفقة (local_data_main.pkl و local_data_sales.pkl)
+# أو على بيانات مولّدة
+# التشغيل من جذر المستودع:
+#   python -m benchmarks.memory
+#   python -m benchmarks.memory --rows 100000 1000000
+
+import os
+import sys
+import pickle
+import logging
+import argparse
+import tracemalloc
+
+import main
+from main import SheetDataset, RowBlock, save_data_locally, load_snapshot, snapshot_manifest_path, CELL_STR
+from benchmarks.__main__ import snapshot_directory
+from benchmarks.synthetic import generate_main_rows, generate_sales_rows
+
+MB = 2 ** 20
+
+def legacy_rows_size(rows):
+    """حجم قائمة الصفوف في الذاكرة: القائمة وكل صف وكل قيمة (القيمة المشتركة بين أكثر من خلية تُحسب مرة)"""
+    seen, total = set(), sys.getsizeof(rows)
+    for row in rows:
+        total += sys.getsizeof(row)
+        for value in row:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+def column_layout(arrays, n):
+    """وصف مختصر لترميز عمود: ما يُحفظ لكل صف وما يُحفظ مرة واحدة"""
+    parts = []
+    if len(arrays['tags']) < n: parts.append(f"one type ({'text' if arrays['tags'][0] == CELL_STR else 'number'})")
+    if 'ints' in arrays: parts.append(f"ints {arrays['ints'].dtype}")
+    if 'floats' in arrays: parts.append('floats')
+    if 'codes' in arrays:
+        unique = len(arrays['offsets']) - 1
+        parts.append(f'{unique} unique' if len(arrays['codes']) < n else f"codes {arrays['codes'].dtype} ({unique} unique)")
+    elif 'text' in arrays:
+        parts.append('text')
+    return ', '.join(parts)
+
+def report(sheet_type, rows, pickle_path=None):
+    block = RowBlock.encode(rows)
+    legacy, compact = legacy_rows_size(rows), block.nbytes
+    print(f"\n{sheet_type}: {len(rows):,} rows x {len(block.columns)} columns")
+    print(f"  rows as Python lists:   {legacy / MB:9.2f} MB  ({legacy / max(len(rows), 1):,.0f} bytes/row)")
+    print(f"  rows as RowBlock:       {compact / MB:9.2f} MB  ({compact / max(len(rows), 1):,.0f} bytes/row, {legacy / max(compact, 1):.1f}x smaller)")
+    for j, arrays in enumerate(block.columns):
+        size = sum(array.nbytes for array in arrays.values())
+        print(f"    column {j:<3} {size / 1024:10.1f} KB  {column_layout(arrays, len(block))}")
+
+    with snapshot_directory():
+        manifest = save_data_locally(SheetDataset(rows, sheet_type), sheet_type)
+        on_disk = os.path.getsize(snapshot_manifest_path(sheet_type)) + sum(os.path.getsize(segment['file']) for segment in manifest['segments'])
+        tracemalloc.start()
+        try:
+            dataset = load_snapshot(sheet_type, manifest)
+            heap = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        storage = dataset.rows.status()
+        dataset = None
+    if pickle_path:
+        print(f"  pickle file:            {os.path.getsize(pickle_path) / MB:9.2f} MB")
+    print(f"  snapshot files:         {on_disk / MB:9.2f} MB  ({len(manifest['segments'])} segments)")
+    # الصفوف الخام للنسخة المحملة من اللقطة تبقى على الـ mmap؛ قبل RowBlock كانت قوائم Python فوق باقي الأعمدة
+    print(f"  loaded dataset:         {heap / MB:9.2f} MB heap + {storage['mapped_bytes'] / MB:.2f} MB mapped rows"
+          f"  (with rows as lists: ~{(heap + legacy) / MB:.2f} MB heap)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the memory footprint of raw sheet rows as Python lists and as RowBlock')
+    parser.add_argument('--rows', type=int, nargs='*', default=[], help='also report on generated data of these sizes')
+    args = parser.parse_args()
+
+    main.app.logger.setLevel(logging.WARNING)
+    for sheet_type in ('main', 'sales'):
+        path = f'local_data_{sheet_type}.pkl'
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                report(sheet_type, pickle.load(f)['data'], path)
+    for size in args.rows:
+        report('main', generate_main_rows(size))
+        report('sales', generate_sales_rows(size))
@@ -0,0 +1,111 @@
+# benchmarks/synthetic.py
+# توليد صفوف بنفس شكل شيت الفواتير وشيت المبيعات بأي عدد، لقياس الأداء مع نمو البيانات
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from main import PAYMENT_METHOD_MAP, EXCEL_EPOCH
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+CASHIERS = ('momen.m', 'm.raafat', 'hazem.mostafa', 'KSALAH', 'e.mossad', 'MO.AMEN', 'ali.fathy')
+CUSTOMER_NAMES = ('محمد', 'أحمد', 'نور', 'رنا', 'مريم', 'سارة', 'ياسمين', 'عمر', 'يوسف', 'هدى', 'منة الله', 'كريم')
+# طرق الدفع كما تظهر في الشيت (أكواد UDF بحروف كبيرة)، مع قيم غير موجودة في PAYMENT_METHOD_MAP
+PAYMENTS = tuple(code.upper() if code.startswith('udf') else code.title() for code in PAYMENT_METHOD_MAP) + ('Central Gift Card', 'Bank')
+PAYMENT_WEIGHTS = (0.03, 0.55, 0.02, 0.02, 0.02, 0.01, 0.01, 0.01, 0.01, 0.01, 0.28, 0.02, 0.01)
+ITEM_WORDS = ('SLIME GLAM', 'BABY SANDAL', 'مسدس فل', 'اسكوتر شحن', 'COMB', 'ACROCANTHOSAURUS', 'فاكهة مجففة', 'LEGO CITY', 'عروسة', 'PUZZLE')
+STORE_HOURS = (10, 23)
+# نسب الصفوف الشاذة التي تظهر في الشيت الحقيقي
+RETURN_RATE = 0.03
+BAD_ROW_RATE = 0.001
+
+def _first_day(days, end):
+    end = (end or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return end - timedelta(days=days - 1)
+
+def _oracle_day(day):
+    return f'{day.day:02d}-{MONTHS[day.month - 1]}-{day.year % 100:02d}'
+
+def _phones(rng, count):
+    prefixes = rng.choice(['010', '011', '012', '015'], count)
+    return [f'{prefix}{number:08d}' for prefix, number in zip(prefixes, rng.integers(0, 10 ** 8, count))]
+
+def generate_main_rows(rows, days=365, end=None, seed=0):
+    """صفوف شيت الفواتير بترتيب زمني خلال آخر days يوماً حتى end (اليوم افتراضياً):
+    تاريخ Oracle بمنطقة +03:00، رقم فاتورة متزايد، المبلغ (مع مرتجعات سالبة)، طريقة الدفع، الكاشير، العميل والهاتف"""
+    rng = np.random.default_rng(seed)
+    first_day = _first_day(days, end)
+    day_prefixes = [_oracle_day(first_day + timedelta(days=day)) for day in range(days)]
+
+    # أوقات متزايدة داخل ساعات العمل
+    span = (STORE_HOURS[1] - STORE_HOURS[0]) * 3600
+    moments = np.sort(rng.integers(0, days * span, rows))
+    day_index = moments // span
+    seconds = STORE_HOURS[0] * 3600 + moments % span
+    hours, minutes, secs = seconds // 3600, seconds // 60 % 60, seconds % 60
+    hours12 = np.where(hours % 12 == 0, 12, hours % 12)
+
+    amounts = np.round(rng.lognormal(6, 1, rows), 1) - 0.1
+    amounts[rng.random(rows) < RETURN_RATE] *= -1
+    whole = rng.random(rows) < 0.5
+    payments = rng.choice(len(PAYMENTS), rows, p=PAYMENT_WEIGHTS)
+    cashiers = rng.integers(0, len(CASHIERS), rows)
+
+    # العملاء يتكررون: مجموعة أصغر من العملاء يظهر كل منهم في أكثر من فاتورة
+    customers = max(rows // 4, 1)
+    phones = _phones(rng, customers)
+    names = [CUSTOMER_NAMES[i] for i in rng.integers(0, len(CUSTOMER_NAMES), customers)]
+    customer_index = rng.integers(0, customers, rows)
+    name_kind = rng.random(rows)
+    bad = rng.random(rows) < BAD_ROW_RATE
+
+    # قوائم Python بدلاً من مصفوفات numpy لأن الوصول لعنصر واحد منها أسرع بكثير داخل الحلقة
+    day_index, hours, hours12, minutes, secs = day_index.tolist(), hours.tolist(), hours12.tolist(), minutes.tolist(), secs.tolist()
+    amounts, whole, payments, cashiers = amounts.tolist(), whole.tolist(), payments.tolist(), cashiers.tolist()
+    customer_index, name_kind, bad = customer_index.tolist(), name_kind.tolist(), bad.tolist()
+
+    data = []
+    for i in range(rows):
+        customer = customer_index[i]
+        date = f"{day_prefixes[day_index[i]]} {hours12[i]:02d}.{minutes[i]:02d}.{secs[i]:02d} {'PM' if hours[i] >= 12 else 'AM'} +03:00"
+        amount = int(round(amounts[i])) if whole[i] else amounts[i]
+        # الاسم أحياناً فارغ أو مكتوب فيه رقم الهاتف
+        name = '' if name_kind[i] < 0.2 else phones[customer] if name_kind[i] < 0.3 else names[customer]
+        invoice = str(1000 + i)
+        if bad[i]:
+            invoice, amount = ('', amount) if i % 2 else (invoice, 'N/A')
+        data.append([date, invoice, amount, PAYMENTS[payments[i]], CASHIERS[cashiers[i]], name, phones[customer], '', '', '', ''])
+    return data
+
+def generate_sales_rows(rows, days=365, end=None, seed=0, items=None):
+    """صفوف شيت المبيعات بترتيب زمني: التاريخ كرقم Excel تسلسلي (وأحياناً نص ISO)، كود القطعة، الوصف، الكمية، القيمة
+    المرتجعات بكمية وقيمة سالبة"""
+    rng = np.random.default_rng(seed + 1)
+    first_day = _first_day(days, end)
+    first_serial = (first_day - EXCEL_EPOCH).days
+    items = items or min(max(rows // 5, 1), 50000)
+
+    codes = [str(code) for code in rng.integers(10 ** 9, 10 ** 13, items)]
+    descriptions = [f'{code[-5:]} {ITEM_WORDS[i % len(ITEM_WORDS)]} {i}' for i, code in enumerate(codes)]
+    prices = np.round(rng.lognormal(5, 1, items), 1) - 0.1
+
+    day_index = np.sort(rng.integers(0, days, rows))
+    # بعض القطع تُباع أكثر بكثير من غيرها
+    item_index = np.minimum(rng.zipf(1.3, rows) - 1, items - 1)
+    item_index = rng.permutation(items)[item_index]
+    quantities = rng.integers(1, 4, rows)
+    quantities[rng.random(rows) < RETURN_RATE] *= -1
+    iso = rng.random(rows) < 0.2
+    whole = rng.random(rows) < 0.6
+
+    iso_days = [(first_day + timedelta(days=day)).strftime('%Y-%m-%d') for day in range(days)]
+    day_index, item_index, quantities = day_index.tolist(), item_index.tolist(), quantities.tolist()
+    iso, whole, prices = iso.tolist(), whole.tolist(), prices.tolist()
+
+    data = []
+    for i in range(rows):
+        item, day, quantity = item_index[i], day_index[i], quantities[i]
+        date = iso_days[day] if iso[i] else first_serial + day
+        amount = quantity * prices[item]
+        data.append([date, codes[item], descriptions[item], quantity, int(round(amount)) if whole[i] else round(amount, 1)])
+    return data
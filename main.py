@@ -1,15 +1,38 @@
 import os
+import re
+import io
+import csv
+import bisect
+import heapq
+import zipfile
+import itertools
+import hashlib
 import json
 import configparser
+import urllib.parse
 import pickle
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+import mmap
+import random
+import threading
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from flask import Flask, render_template, stream_template, stream_with_context, request, redirect, url_for, flash, session, Response, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 import gspread
 from datetime import datetime, timedelta
 from dateutil.parser import parse, ParserError
-from cachetools import cached, TTLCache
-from functools import wraps
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, wait
+from cachetools import LRUCache
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: لا يوجد قفل بين العمليات
+    fcntl = None
 
 # --- إعداد التطبيق وقاعدة البيانات ---
 app = Flask(__name__)
@@ -40,480 +63,2933 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- القياس (metrics) ---
+# عدادات وhistograms لكل عامل تُعرض بصيغة Prometheus على /metrics
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# سجلات الصفوف التشخيصية (كل تطابق، كل صف غير صالح) تعمل في وضع debug أو لنسبة من الطلبات فقط
+ROW_LOG_SAMPLE_RATE = float(os.environ.get('ROW_LOG_SAMPLE_RATE', '0'))
+
+def row_logging_enabled():
+    return app.debug or (ROW_LOG_SAMPLE_RATE > 0 and random.random() < ROW_LOG_SAMPLE_RATE)
+
+def _format_labels(labels):
+    if not labels: return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.definitions = {}   # الاسم -> (النوع، الوصف، حدود الـ buckets)
+        self.values = {}        # (الاسم، labels) -> قيمة العداد، أو [عدد كل bucket، المجموع، العدد] للـ histogram
+        # دوال تعيد [(الاسم، labels، القيمة)] لعدادات محفوظة في مكان آخر (مثل إحصائيات SheetRefresher)
+        self.collectors = []
+
+    def define(self, name, kind, description, buckets=None):
+        self.definitions[name] = (kind, description, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """النص بصيغة Prometheus exposition"""
+        with self._lock:
+            values = {key: (list(value[0]), value[1], value[2]) if isinstance(value, list) else value for key, value in self.values.items()}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                values[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        for name, (kind, description, buckets) in self.definitions.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for (metric, labels), value in sorted(values.items(), key=lambda item: item[0]):
+                if metric != name: continue
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+def timed_stage(stage):
+    """decorator يسجل زمن الدالة في hedeya_stage_seconds"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with metrics.timer('hedeya_stage_seconds', stage=stage):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+metrics = Metrics()
+metrics.define('hedeya_stage_seconds', 'histogram', 'Time spent per processing stage', STAGE_BUCKETS)
+metrics.define('hedeya_upstream_request_seconds', 'histogram', 'Google Sheets API request latency', UPSTREAM_BUCKETS)
+metrics.define('hedeya_upstream_errors_total', 'counter', 'Failed Google Sheets API requests')
+metrics.define('hedeya_sheet_cache_events_total', 'counter', 'Sheet cache hits, misses and loads in this worker')
+metrics.define('hedeya_dashboard_cache_events_total', 'counter', 'Rendered dashboard cache hits and misses in this worker')
+metrics.define('hedeya_sheet_rows', 'gauge', 'Rows in the in-memory sheet snapshot')
+metrics.define('hedeya_archive_partition_loads_total', 'counter', 'Old-month partition columns decoded from the local snapshot')
+metrics.define('hedeya_archive_resident_partitions', 'gauge', 'Old-month partitions currently held in memory')
+
 # --- دوال التعامل مع Google Sheets ---
-sheet_cache = TTLCache(maxsize=2, ttl=300)
+GSPREAD_HTTP_TIMEOUT = 60
+SHEETS_API_ROOT = 'https://sheets.googleapis.com'
+
+class SheetsHTTPClient(gspread.http_client.HTTPClient):
+    """HTTPClient بجلسة واحدة (keep-alive) يجدد الـ access token فقط عند انتهائه، ويعدّ الطلبات
+    يمكن توجيهه لخادم Sheets محلي (مثلاً للاختبار) عبر GSPREAD_API_BASE_URL"""
+
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        self.set_timeout(GSPREAD_HTTP_TIMEOUT)
+        self.base_url = os.environ.get('GSPREAD_API_BASE_URL', '').rstrip('/')
+        self.request_count = 0
+
+    def request(self, method, endpoint, *args, **kwargs):
+        self.request_count += 1
+        operation = 'batch_get' if ':batchGet' in endpoint else 'values' if '/values/' in endpoint else 'metadata'
+        if self.base_url and endpoint.startswith(SHEETS_API_ROOT):
+            endpoint = self.base_url + endpoint[len(SHEETS_API_ROOT):]
+        try:
+            with metrics.timer('hedeya_upstream_request_seconds', operation=operation):
+                return super().request(method, endpoint, *args, **kwargs)
+        except Exception:
+            metrics.inc('hedeya_upstream_errors_total', operation=operation)
+            raise
+
+def get_gspread_client():
+    creds_json_string = os.environ.get('GSPREAD_CREDENTIALS_JSON')
+    if not creds_json_string: raise ValueError("Secret GSPREAD_CREDENTIALS_JSON is not set.")
+    return gspread.service_account_from_dict(json.loads(creds_json_string), http_client=SheetsHTTPClient)
+
+class SheetsConnection:
+    """اتصال Google Sheets طوال عمر العامل: العميل (بيانات الاعتماد والـ token وجلسة HTTP) ومقابض أوراق العمل
+    تُنشأ مرة واحدة، فكل تحديث يكلف طلب قراءة واحد بدلاً من تسجيل دخول وفتح الشيت والبحث عن الورقة"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client, self._credentials = None, None
+        self._worksheets = {}   # sheet_type -> (رابط الشيت، ورقة العمل)
+        self.stats = {'clients_created': 0, 'worksheets_opened': 0, 'resets': 0}
+
+    def client(self):
+        credentials = os.environ.get('GSPREAD_CREDENTIALS_JSON')
+        with self._lock:
+            if self._client is None or credentials != self._credentials:
+                self._client, self._credentials = get_gspread_client(), credentials
+                self._worksheets.clear()
+                self.stats['clients_created'] += 1
+            return self._client
+
+    def worksheet(self, sheet_type):
+        """ورقة العمل الخاصة بالشيت، تُفتح مرة واحدة لكل رابط في config.ini"""
+        sheet_url = sheet_url_for(sheet_type)
+        client = self.client()
+        cached = self._worksheets.get(sheet_type)
+        if cached is not None and cached[0] == sheet_url:
+            return cached[1]
+        worksheet = open_worksheet(client, sheet_type, sheet_url)
+        self._worksheets[sheet_type] = (sheet_url, worksheet)
+        self.stats['worksheets_opened'] += 1
+        return worksheet
+
+    def batch_get(self, sheet_type, ranges):
+        """قراءة عدة نطاقات من ورقة العمل في طلب واحد (values:batchGet)، بالقيم غير المنسقة"""
+        worksheet = self.worksheet(sheet_type)
+        response = worksheet.client.values_batch_get(
+            worksheet.spreadsheet_id, [gspread.utils.absolute_range_name(worksheet.title, r) for r in ranges],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+        return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+    def reset(self, sheet_type, error=None):
+        """نسيان مقبض ورقة العمل بعد فشل (قد تكون حُذفت أو أعيدت تسميتها)، والعميل كله إذا لم يكن الخطأ من الـ API"""
+        with self._lock:
+            self._worksheets.pop(sheet_type, None)
+            if not isinstance(error, gspread.exceptions.APIError):
+                self._client = None
+            self.stats['resets'] += 1
+
+    def status(self):
+        client = self._client
+        return {**self.stats, 'http_requests': getattr(getattr(client, 'http_client', None), 'request_count', None),
+                'open_worksheets': sorted(self._worksheets)}
+
+sheets_connection = SheetsConnection()
+
+# --- اللقطة المحلية (snapshot) ---
+# كل شيت يُحفظ كملف manifest صغير (JSON) يشير إلى ملفات segments ثنائية عمودية لا تتغير بعد كتابتها:
+# - قراءة البيانات الوصفية (عدد الصفوف، وقت التحديث) لا تحتاج تحميل البيانات
+# - إضافة صفوف جديدة = segment جديد + استبدال الـ manifest
+# - كل كتابة تتم في ملف مؤقت ثم os.replace، فانقطاع الحفظ لا يفسد النسخة السابقة
+# - الأعمدة الرقمية المحللة تُقرأ عبر mmap دون نسخ، وتتشاركها صفحات الذاكرة بين عمال gunicorn
+# - الـ segments مقسمة حسب الشهر (partition لكل شهر)، فالشهور القديمة لا يُعاد كتابتها ويمكن قراءتها وحدها عند الحاجة
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_SEGMENT_MAGIC = b'HDYSEG01'
+SNAPSHOT_MAX_SEGMENTS = 8         # أقصى segments للشهر الأخير (المفتوح) قبل دمجها في segment واحد
+# أنواع الخلايا الخام في الـ segment (CELL_DIGITS: نص أرقام مثل رقم الفاتورة، يُحفظ كرقم ويُعاد نصاً)
+CELL_STR, CELL_INT, CELL_FLOAT, CELL_BOOL, CELL_NONE, CELL_MISSING, CELL_BIGINT, CELL_DIGITS = range(8)
+# ترميز الأعمدة الخام: 2 = إزاحات النصوص بالبايت والقيم المتكررة كأكواد (segments الترميز الأول بإزاحات بالحروف)
+SNAPSHOT_SEGMENT_ENCODING = 2
+
+def snapshot_manifest_path(sheet_type):
+    return f'local_data_{sheet_type}.json'
+
+def _legacy_pickle_path(sheet_type):
+    return f'local_data_{sheet_type}.pkl'
+
+def _write_atomically(path, write):
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# نوع الخلية حسب نوع قيمتها؛ القيم من أي نوع آخر تُحفظ كنص
+_CELL_TAGS = {str: CELL_STR, int: CELL_INT, float: CELL_FLOAT, bool: CELL_BOOL, type(None): CELL_NONE}
+
+def _narrow_ints(values):
+    """أصغر نوع صحيح يسع القيم"""
+    if len(values):
+        low, high = int(values.min()), int(values.max())
+        for dtype in (np.int8, np.int16, np.int32):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return values.astype(dtype)
+    return values
+
+def _constant(array):
+    """المصفوفة التي كل قيمها واحدة (نوع خلايا واحد، عمود فارغ) تُحفظ بعنصر واحد"""
+    return array[:1] if len(array) > 1 and array.min() == array.max() else array
+
+def _row_columns(rows):
+    """(قائمة لكل عمود في الشيت بطول عدد الصفوف والخلايا غير الموجودة None، عدد خلايا كل صف)"""
+    lengths = np.fromiter(map(len, rows), dtype=np.int32, count=len(rows))
+    if not len(rows): return [], lengths
+    if lengths.min() == lengths.max():
+        return [[row[j] for row in rows] for j in range(lengths[0])], lengths
+    return [[row[j] if j < len(row) else None for row in rows] for j in range(lengths.max())], lengths
+
+def _encode_raw_column(values, present=None):
+    """ترميز عمود خام مختلط الأنواع (نص/رقم/...) بدون فقدان للنوع: الأرقام في مصفوفات أرقام،
+    والنصوص المتكررة (طريقة الدفع، الكاشير، الهاتف...) تُحفظ كل قيمة منها مرة واحدة ويحمل كل صف كودها
+    present: الصفوف التي فيها هذه الخلية (الباقي خلايا غير موجودة)"""
+    n = len(values)
+    kinds = set(map(type, values))
+    tag_of = {**_CELL_TAGS, **{kind: CELL_STR for kind in kinds if kind not in _CELL_TAGS}}
+    if len(kinds) == 1:
+        tags = np.full(n, tag_of[kinds.pop()], dtype=np.uint8)
+    else:
+        tags = np.fromiter(map(tag_of.__getitem__, map(type, values)), dtype=np.uint8, count=n)
+    if present is not None:
+        tags[~present] = CELL_MISSING
+    ints = np.zeros(n, dtype=np.int64)
+    floats = np.zeros(n, dtype=np.float64)
+
+    def cells(tag):
+        rows = np.flatnonzero(tags == tag)
+        return rows, (list(values) if len(rows) == n else list(map(values.__getitem__, rows.tolist())))
+
+    text_rows, texts = cells(CELL_STR)
+    if len(tag_of) > len(_CELL_TAGS):
+        texts = list(map(str, texts))
+    # نصوص الأرقام بدون صفر في البداية (أرقام الفواتير) تُحفظ كأرقام وتعود نفس النص؛ أرقام الهواتف تبقى نصوصاً
+    digits = np.flatnonzero(np.fromiter(map(str.isdigit, texts), dtype=bool, count=len(texts)))
+    if len(digits):
+        candidates = list(map(texts.__getitem__, digits.tolist()))
+        lengths = np.fromiter(map(len, candidates), dtype=np.int64, count=len(candidates))
+        exact = (lengths < 19) & np.fromiter(map(str.isascii, candidates), dtype=bool, count=len(candidates))
+        exact &= ~np.fromiter(map(str.startswith, candidates, itertools.repeat('0')), dtype=bool, count=len(candidates)) | (lengths == 1)
+        digits = digits[exact]
+    if len(digits):
+        tags[text_rows[digits]] = CELL_DIGITS
+        ints[text_rows[digits]] = [int(texts[k]) for k in digits.tolist()]
+        keep = np.ones(len(texts), dtype=bool)
+        keep[digits] = False
+        text_rows, texts = text_rows[keep], list(itertools.compress(texts, keep.tolist()))
+
+    rows, numbers = cells(CELL_INT)
+    try:
+        ints[rows] = np.array(numbers, dtype=np.int64)
+    except OverflowError:
+        # الأعداد الأكبر من 64 بت تُحفظ كنص
+        big = np.fromiter((not -2 ** 63 <= number < 2 ** 63 for number in numbers), dtype=bool, count=len(numbers))
+        ints[rows[~big]] = [number for number, large in zip(numbers, big.tolist()) if not large]
+        tags[rows[big]] = CELL_BIGINT
+        text_rows = np.concatenate([text_rows, rows[big]])
+        texts += [str(number) for number, large in zip(numbers, big.tolist()) if large]
+        order = np.argsort(text_rows, kind='stable')
+        text_rows, texts = text_rows[order], [texts[k] for k in order.tolist()]
+    rows, flags = cells(CELL_BOOL)
+    ints[rows] = flags
+    rows, numbers = cells(CELL_FLOAT)
+    floats[rows] = numbers
+
+    arrays = {'tags': _constant(tags)}
+    is_int = (tags == CELL_INT) | (tags == CELL_BOOL) | (tags == CELL_DIGITS)
+    has_ints, has_floats = bool(is_int.any()), len(rows) > 0
+    if has_ints and has_floats and -2 ** 53 < ints[is_int].min() and ints[is_int].max() < 2 ** 53:
+        # الأعداد الصحيحة في عمود فيه كسور (المبالغ) تُحفظ مع الكسور لأنها تُمثل فيها بدقة
+        floats, has_ints = np.where(is_int, ints, floats), False
+    if has_ints: arrays['ints'] = _narrow_ints(ints)
+    if has_floats: arrays['floats'] = floats
+    if texts:
+        unique = dict.fromkeys(texts)
+        if len(unique) * 2 <= len(texts):
+            index = dict(zip(unique, range(len(unique))))
+            codes = np.zeros(n, dtype=np.uint8 if len(unique) <= 2 ** 8 else np.uint16 if len(unique) <= 2 ** 16 else np.int32)
+            codes[text_rows] = np.fromiter(map(index.__getitem__, texts), dtype=np.int64, count=len(texts))
+            arrays['codes'] = _constant(codes)
+            encoded = list(map(str.encode, unique))
+            offsets = np.r_[0, np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))]
+        else:
+            encoded = list(map(str.encode, texts))
+            lengths = np.zeros(n, dtype=np.int64)
+            lengths[text_rows] = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+            offsets = np.r_[0, np.cumsum(lengths)]
+        # إزاحات بالبايت: نص أي صف يُقرأ وحده دون فك باقي العمود
+        arrays['offsets'] = offsets.astype(np.int32) if offsets[-1] < 2 ** 31 else offsets
+        arrays['text'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return arrays
+
+def _slice_raw_column(arrays, lo, hi):
+    """ترميز الصفوف من lo حتى hi فقط من عمود مرمّز؛ النصوص المتكررة تقتصر على المستخدم منها في هذه الصفوف"""
+    sliced = {}
+    for name in ('tags', 'codes', 'ints', 'floats'):
+        if name not in arrays: continue
+        array = arrays[name]
+        if name in ('tags', 'codes'):
+            sliced[name] = _constant(array[lo:hi]) if len(array) > 1 else array
+        else:
+            sliced[name] = array[lo:hi]
+    if 'text' in arrays:
+        text, offsets = arrays['text'], arrays['offsets']
+        if 'codes' in arrays:
+            used = np.unique(sliced['codes']).astype(np.int64)
+            if len(used) < len(offsets) - 1:
+                starts, stops = offsets[used].astype(np.int64), offsets[used + 1].astype(np.int64)
+                sliced['codes'] = np.searchsorted(used, sliced['codes']).astype(sliced['codes'].dtype)
+                text = np.concatenate([text[start:stop] for start, stop in zip(starts.tolist(), stops.tolist())]) if len(used) else text[:0]
+                offsets = np.r_[0, np.cumsum(stops - starts)].astype(offsets.dtype)
+        else:
+            start, stop = int(offsets[lo]), int(offsets[hi])
+            text, offsets = text[start:stop], offsets[lo:hi + 1] - offsets[lo]
+        sliced['offsets'], sliced['text'] = offsets, text
+    return sliced
+
+def _byte_offsets(arrays):
+    """إزاحات نصوص عمود من segment بالترميز الأول (بالحروف) محولة إلى بايت"""
+    text, offsets = arrays['text'].tobytes().decode('utf-8'), arrays['offsets']
+    if len(text) == len(arrays['text']): return offsets
+    bounds = offsets.tolist()
+    return np.r_[0, np.cumsum([len(text[start:stop].encode('utf-8')) for start, stop in zip(bounds, bounds[1:])], dtype=np.int64)]
+
+def _column_texts(arrays):
+    """نصوص العمود المرمّز: نص لكل صف، أو القيم الفريدة إذا كان محفوظاً كأكواد"""
+    text, offsets = arrays['text'].tobytes(), arrays['offsets'].tolist()
+    return [text[start:stop].decode('utf-8') for start, stop in zip(offsets, offsets[1:])]
+
+def _decode_raw_column(arrays, n):
+    """قيم عمود مرمّز (None للخلايا غير الموجودة)؛ تكرارات النص الواحد تعود نفس الكائن"""
+    tags = arrays['tags']
+    if not n or tags.min() == tags.max() == CELL_MISSING: return [None] * n
+    floats = arrays['floats'].tolist() if 'floats' in arrays else None
+    ints = arrays['ints'].tolist() if 'ints' in arrays else floats
+    texts = _column_texts(arrays) if 'text' in arrays else None
+    if texts is not None:
+        if 'codes' in arrays:
+            codes = arrays['codes'].tolist()
+            texts = [texts[code] for code in codes] if len(codes) == n else [texts[codes[0]]] * n
+    if len(tags) < n:
+        # كل الخلايا من نوع واحد
+        tag = int(tags[0])
+        if tag == CELL_STR: return texts
+        if tag == CELL_FLOAT: return floats
+        if tag == CELL_DIGITS: return [str(int(value)) for value in ints]
+        tags = [tag] * n
+    else:
+        tags = tags.tolist()
+    values = [None] * n
+    for i, tag in enumerate(tags):
+        if tag == CELL_STR:
+            values[i] = texts[i]
+        elif tag == CELL_DIGITS:
+            values[i] = str(int(ints[i]))
+        elif tag == CELL_INT:
+            values[i] = int(ints[i])
+        elif tag == CELL_FLOAT:
+            values[i] = floats[i]
+        elif tag == CELL_BOOL:
+            values[i] = bool(ints[i])
+        elif tag == CELL_BIGINT:
+            values[i] = int(texts[i])
+    return values
+
+class RowBlock:
+    """صفوف خام متتالية بصيغة مضغوطة: كل عمود في الشيت مرمّز كما في الـ segment (الأرقام أرقاماً، النصوص المتكررة
+    أكواداً، والأعمدة الفارغة بقيمة واحدة)، والصف يُبنى كقائمة عند طلبه فقط. الـ block المقروء من segment يبقى على
+    الـ mmap فلا يأخذ من ذاكرة العامل، وتتشارك صفحاته العمليات"""
+
+    def __init__(self, columns, lengths, mapped=False):
+        self.columns = columns      # مصفوفات ترميز كل عمود في الشيت
+        self.lengths = lengths      # عدد خلايا كل صف (row_lengths)
+        self.mapped = mapped
+
+    @classmethod
+    def encode(cls, rows):
+        return cls.from_columns(*_row_columns(rows))
+
+    @classmethod
+    def from_columns(cls, columns, lengths):
+        """columns وlengths كما يعيدها _row_columns"""
+        return cls([_encode_raw_column(values, lengths > j) for j, values in enumerate(columns)], lengths)
+
+    @classmethod
+    def from_segment(cls, header, arrays, lengths):
+        columns = []
+        for j in range(header['width']):
+            prefix = f'raw{j}.'
+            column = {key[len(prefix):]: array for key, array in arrays.items() if key.startswith(prefix)}
+            if 'text' in column and header.get('encoding', 1) < 2:
+                column['offsets'] = _byte_offsets(column)
+            columns.append(column)
+        return cls(columns, lengths, mapped=True)
+
+    def __len__(self): return len(self.lengths)
+
+    def column(self, j):
+        """قيم العمود رقم j في الشيت لكل الصفوف (None للخلايا غير الموجودة)"""
+        return _decode_raw_column(self.columns[j], len(self)) if j < len(self.columns) else [None] * len(self)
+
+    def coded(self, j):
+        """(القيم الفريدة، كود كل صف) إذا كان العمود j كله نصوصاً محفوظة كأكواد، وإلا None"""
+        arrays = self.columns[j] if j < len(self.columns) else {}
+        if 'codes' not in arrays or len(arrays['tags']) != 1 or arrays['tags'][0] != CELL_STR: return None
+        codes = arrays['codes']
+        return _column_texts(arrays), (codes if len(codes) == len(self) else np.full(len(self), codes[0], dtype=codes.dtype))
+
+    def rows(self, lo=0, hi=None):
+        """الصفوف من lo حتى hi كقوائم بطولها الأصلي"""
+        hi = len(self) if hi is None else hi
+        columns = [_decode_raw_column(_slice_raw_column(arrays, lo, hi), hi - lo) for arrays in self.columns]
+        rows = [list(cells) for cells in zip(*columns)] if columns else [[] for _ in range(hi - lo)]
+        lengths = self.lengths[lo:hi]
+        if rows and columns and int(lengths.min()) < len(columns):
+            for i in np.flatnonzero(lengths < len(columns)).tolist():
+                rows[i] = rows[i][:lengths[i]]
+        return rows
+
+    def encoded(self, lo, hi):
+        return [_slice_raw_column(arrays, lo, hi) for arrays in self.columns]
+
+    @property
+    def nbytes(self):
+        return int(self.lengths.nbytes + sum(array.nbytes for arrays in self.columns for array in arrays.values()))
+
+class _RowColumns:
+    """قيم أعمدة RowBlock أثناء تحليله: من قوائم الخلايا الأصلية إن وُجدت وإلا بفك ترميز العمود (مرة واحدة لكل عمود)
+    العمود المحفوظ كأكواد يُحوَّل مرة لكل قيمة فريدة، فتكرارات القيمة الواحدة تعود نفس الكائن"""
+
+    def __init__(self, block, columns=None):
+        self.block, self.columns = block, columns
+        self._values = {}
+
+    def __call__(self, j):
+        """قيم العمود رقم j في الشيت (None للخلايا غير الموجودة)"""
+        if self.columns is not None:
+            return self.columns[j] if j < len(self.columns) else [None] * len(self.block)
+        if j not in self._values:
+            self._values[j] = self.block.column(j)
+        return self._values[j]
+
+    def coded(self, j, convert=None):
+        """(القيم الفريدة بعد convert، كود كل صف) إذا كان العمود كله نصوصاً محفوظة كأكواد، وإلا None"""
+        coded = self.block.coded(j)
+        if coded is None: return None
+        categories, codes = coded
+        return (list(map(convert, categories)) if convert else categories), codes
+
+    def converted(self, j, convert=None):
+        """قيم العمود رقم j بعد convert"""
+        coded = self.coded(j, convert)
+        if coded is not None:
+            return list(map(coded[0].__getitem__, coded[1].tolist()))
+        return list(map(convert, self(j))) if convert else list(self(j))
+
+class CompactRows:
+    """الصفوف الخام لـ SheetDataset: RowBlock لكل دفعة (التحميل الكامل، كل segment، كل تحديث تزايدي)
+    يُستخدم كقائمة: len، الفهرسة برقم أو بمدى (يعيد list من القوائم)، المرور بالترتيب، و+ صفوف جديدة"""
+
+    def __init__(self, blocks=()):
+        self.blocks = [block for block in blocks if len(block)]
+        self.starts = list(itertools.accumulate((len(block) for block in self.blocks), initial=0))
+
+    def __len__(self): return self.starts[-1]
+
+    def pieces(self, start, stop):
+        """[(block، أول صف منه، آخر صف + 1)] للصفوف من start حتى stop"""
+        pieces, k = [], bisect.bisect_right(self.starts, start) - 1
+        while start < stop:
+            first, last = self.starts[k], min(stop, self.starts[k + 1])
+            pieces.append((self.blocks[k], start - first, last - first))
+            start, k = last, k + 1
+        return pieces
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: return [self[i] for i in range(start, stop, step)]
+            return [row for block, lo, hi in self.pieces(start, stop) for row in block.rows(lo, hi)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self): raise IndexError('CompactRows index out of range')
+        return self[index:index + 1][0]
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from block.rows()
+
+    def __add__(self, rows):
+        blocks = rows.blocks if isinstance(rows, CompactRows) else [rows if isinstance(rows, RowBlock) else RowBlock.encode(list(rows))]
+        return CompactRows(self.blocks + blocks)
+
+    def encoded(self, start, stop):
+        """أعمدة الصفوف من start حتى stop مرمّزة لكتابتها في segment (من block واحد دون فك الترميز)"""
+        pieces = self.pieces(start, stop)
+        if len(pieces) == 1:
+            block, lo, hi = pieces[0]
+            return block.encoded(lo, hi)
+        return RowBlock.encode(self[start:stop]).columns
+
+    def status(self):
+        return {'blocks': len(self.blocks), 'heap_bytes': sum(block.nbytes for block in self.blocks if not block.mapped),
+                'mapped_bytes': sum(block.nbytes for block in self.blocks if block.mapped)}
+
+def _write_segment(path, dataset, start, stop=None):
+    """كتابة الصفوف من start حتى stop (أو النهاية) كـ segment: الأعمدة الخام المرمّزة + الأعمدة الرقمية المحللة"""
+    stop = len(dataset) if stop is None else stop
+    width = int(dataset.row_lengths[start:stop].max()) if stop > start else 0
+    arrays = {}
+    for j, column in enumerate(dataset.rows.encoded(start, stop)[:width]):
+        for name, array in column.items():
+            arrays[f'raw{j}.{name}'] = array
+    for name in SheetDataset.NUMERIC_COLUMNS[dataset.sheet_type]:
+        column = getattr(dataset, name)[start:stop]
+        arrays[name] = column.view(np.int64) if column.dtype.kind == 'M' else column
+
+    # كل مصفوفة تبدأ عند إزاحة من مضاعفات 8 ليمكن قراءتها مباشرة من الـ mmap
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset += -(-array.nbytes // 8) * 8
+    header = json.dumps({'rows': stop - start, 'width': width, 'encoding': SNAPSHOT_SEGMENT_ENCODING, 'arrays': layout}).encode('utf-8')
+    header += b' ' * (-(len(SNAPSHOT_SEGMENT_MAGIC) + 8 + len(header)) % 8)
+
+    def write(f):
+        f.write(SNAPSHOT_SEGMENT_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data + b'\0' * (-len(data) % 8))
+    _write_atomically(path, write)
+
+def _read_segment(path):
+    """قراءة segment عبر mmap؛ المصفوفات الرقمية المعادة للقراءة فقط ولا تُنسخ"""
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(SNAPSHOT_SEGMENT_MAGIC)] != SNAPSHOT_SEGMENT_MAGIC:
+        raise ValueError(f"Invalid snapshot segment: {path}")
+    header_length = int.from_bytes(buffer[8:16], 'little')
+    header = json.loads(buffer[16:16 + header_length])
+    data_start = 16 + header_length
+    arrays = {name: np.frombuffer(buffer, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+              for name, (dtype, offset, count) in header['arrays'].items()}
+    return header, arrays
+
+def _segment_dataset_parts(header, arrays, sheet_type):
+    """(الصفوف الخام RowBlock، الأعمدة الرقمية المحللة) من segment، وكلاهما على الـ mmap"""
+    numeric = {name: arrays[name] for name in SheetDataset.NUMERIC_COLUMNS[sheet_type]}
+    numeric['dates'] = numeric['dates'].view('datetime64[s]')
+    return RowBlock.from_segment(header, arrays, numeric['row_lengths']), numeric
+
+def read_snapshot_metadata(sheet_type='main'):
+    """البيانات الوصفية للنسخة المحلية دون تحميل البيانات (None إذا لم توجد)"""
+    path = snapshot_manifest_path(sheet_type)
+    if not os.path.exists(path): return None
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {manifest.get('version')}")
+    return manifest
+
+def _write_manifest(sheet_type, segments, previous=None, generation=None, **sync_info):
+    """كتابة الـ manifest؛ generation يزيد مع كل تغيير في البيانات ليعرف العمال الآخرون أن عليهم إعادة التحميل"""
+    manifest = {
+        'version': SNAPSHOT_FORMAT_VERSION,
+        'sheet_type': sheet_type,
+        'generation': generation if generation is not None else (previous or {}).get('generation', 0) + 1,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'rows_count': sum(segment['rows'] for segment in segments),
+        'segments': segments,
+    }
+    manifest.update(sync_info)
+    _write_atomically(snapshot_manifest_path(sheet_type), lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8')))
+    return manifest
+
+def _new_segment_path(sheet_type):
+    return f'local_data_{sheet_type}.{datetime.now().strftime("%Y%m%d%H%M%S")}-{os.getpid()}-{random.randrange(16 ** 6):06x}.seg'
+
+def _remove_unreferenced_segments(sheet_type, segments):
+    referenced = {segment['file'] for segment in segments}
+    for filename in os.listdir('.'):
+        if filename.startswith(f'local_data_{sheet_type}.') and filename.endswith('.seg') and filename not in referenced:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+def newest_first(dataset):
+    """هل الشيت مرتب بالأحدث أولاً (الأيام الجديدة تُضاف في أعلاه): أول صف مؤرخ أحدث شهراً من آخر صف مؤرخ"""
+    months = dataset.dates[~np.isnat(dataset.dates)].astype('datetime64[M]')
+    return bool(len(months) and months[0] > months[-1])
+
+def _month_partitions(dataset, start, after=None):
+    """[(بداية، نهاية، الشهر 'YYYY-MM')] لصفوف dataset من start: مدى متتالٍ من الصفوف لكل شهر بترتيبها في الشيت
+    (الشهور تصاعدية، أو تنازلية إذا كان الشيت بالأحدث أولاً). الصف المخالف لترتيب الشيت (أُدخل متأخراً) أو بدون تاريخ
+    يبقى في شهر ما قبله؛ after هو شهر آخر segment موجود"""
+    months = dataset.dates[start:].astype('datetime64[M]').astype(np.int64)
+    if not len(months): return []
+    dated = months != NAT_SECONDS
+    if after is not None:
+        fill = np.datetime64(after, 'M').astype(np.int64)
+    elif dated.any():
+        fill = months[np.argmax(dated)]
+    else:
+        return [(start, len(dataset), None)]
+    # الصفوف بدون تاريخ في البداية تتبع الشهر السابق أو أول شهر بعدها، والباقي يأخذ شهر ما قبله بعد accumulate
+    months[~dated] = fill
+    envelope = np.minimum if newest_first(dataset) else np.maximum
+    if after is not None:
+        months = envelope(months, fill)
+    months = envelope.accumulate(months)
+    bounds = np.r_[0, np.flatnonzero(np.diff(months)) + 1, len(months)].tolist()
+    return [(start + lo, start + hi, str(np.datetime64(int(months[lo]), 'M'))) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+@timed_stage('save')
+def save_data_locally(dataset, sheet_type='main', new_rows_count=None, **sync_info):
+    """حفظ البيانات محلياً: إضافة آخر new_rows_count صف كـ segments جديدة، أو كتابة النسخة كاملة (segment لكل شهر)
+    يعيد الـ manifest الجديد، أو None إذا فشل الحفظ"""
+    if not isinstance(dataset, SheetDataset):
+        dataset = SheetDataset(dataset or [], sheet_type)
+    try:
+        manifest = read_snapshot_metadata(sheet_type)
+        # اللقطات الأقدم من تقسيم الشهور تُكتب من جديد مقسمة
+        appendable = (new_rows_count is not None and manifest is not None
+                      and manifest['rows_count'] + new_rows_count == len(dataset)
+                      and all('month' in segment for segment in manifest['segments']))
+        segments = list(manifest['segments']) if appendable else []
+        # الشهر الأخير ما زال مفتوحاً: إذا تراكمت فيه segments كثيرة يُعاد كتابته كـ segment واحد، والشهور الأقدم لا تتغير
+        open_month = list(itertools.takewhile(lambda segment: segment['month'] == segments[-1]['month'], reversed(segments))) if segments else []
+        compacted = len(open_month) >= SNAPSHOT_MAX_SEGMENTS
+        if compacted:
+            segments = segments[:-len(open_month)]
+        start = sum(segment['rows'] for segment in segments)
+        for lo, hi, month in _month_partitions(dataset, start, segments[-1]['month'] if segments else None):
+            path = _new_segment_path(sheet_type)
+            _write_segment(path, dataset, lo, hi)
+            segments.append({'file': path, 'rows': hi - lo, 'month': month})
+        new_manifest = _write_manifest(sheet_type, segments, previous=manifest, **sync_info)
+        if not appendable or compacted:
+            _remove_unreferenced_segments(sheet_type, segments)
+        app.logger.info(f"تم حفظ بيانات {sheet_type} محلياً في {snapshot_manifest_path(sheet_type)}")
+        return new_manifest
+    except Exception as e:
+        app.logger.error(f"فشل في حفظ البيانات محلياً: {str(e)}")
+        return None
+
+def mark_snapshot_synced(manifest, **sync_info):
+    """تسجيل مزامنة ناجحة لم تأتِ بصفوف جديدة دون تغيير generation"""
+    try:
+        return _write_manifest(manifest['sheet_type'], manifest['segments'], generation=manifest['generation'], **sync_info)
+    except Exception as e:
+        app.logger.error(f"فشل في تحديث البيانات الوصفية المحلية: {str(e)}")
+        return None
+
+# --- أرشيف الشهور القديمة ---
+# الشهور الحديثة (شهر بداية فترة الحساب الحالية وSNAPSHOT_HOT_MONTHS شهراً قبله) تبقى أعمدتها النصية في الذاكرة.
+# الأعمدة النصية للشهور الأقدم تُقرأ من segments اللقطة المحلية عند الحاجة، ويبقى منها في الذاكرة
+# COLD_PARTITIONS_RESIDENT شهراً على الأكثر (الصفوف الخام نفسها RowBlock على الـ mmap لكل الشهور).
+# الأعمدة الرقمية والأكواد والفهارس والتجميعات تبقى لكل البيانات لأن البحث ولوحة التحكم يعملان عليها،
+# وهي تختار الصفوف حسب التاريخ قبل قراءة أي صف، فلا يُقرأ إلا شهور النتائج
+SNAPSHOT_HOT_MONTHS = int(os.environ.get('SNAPSHOT_HOT_MONTHS', '3'))
+COLD_PARTITIONS_RESIDENT = int(os.environ.get('COLD_PARTITIONS_RESIDENT', '4'))
+
+def hot_window_start(today=None):
+    """أول شهر ('YYYY-MM') تبقى صفوفه في الذاكرة"""
+    start = billing_period_start(today or datetime.now().date())
+    month = start.year * 12 + start.month - 1 - SNAPSHOT_HOT_MONTHS
+    return f'{month // 12:04d}-{month % 12 + 1:02d}'
+
+def cold_segments(manifest, hot_from=None):
+    """(أول segment، آخر segment + 1) لـ segments الـ manifest التي شهرها أقدم من النافذة الحديثة (تُنقل إلى SheetArchive):
+    في أول الـ manifest إذا كان الشيت بترتيب زمني، وفي آخره إذا كان بالأحدث أولاً"""
+    hot_from = hot_from or hot_window_start()
+    segments = manifest['segments']
+    cold = lambda segment: segment.get('month') is not None and segment['month'] < hot_from
+    head = sum(1 for _ in itertools.takewhile(cold, segments))
+    if head: return 0, head
+    return len(segments) - sum(1 for _ in itertools.takewhile(cold, reversed(segments))), len(segments)
+
+class SheetArchive:
+    """الأعمدة النصية للشهور القديمة (الصفوف من offset حتى stop): partition لكل segment بأول صف فيه، وصفوفه RowBlock على الـ mmap (يبقى صالحاً حتى
+    لو حُذف الملف بعد كتابة لقطة جديدة). كل عمود نصي يُفك من الـ segment وحده عند أول وصول له، وتبقى أعمدة آخر
+    COLD_PARTITIONS_RESIDENT شهراً في LRU. الأرشيف لا يتغير بعد التحميل، وتتشاركه النسخ المضاف إليها صفوف جديدة"""
+
+    def __init__(self, sheet_type, resident=COLD_PARTITIONS_RESIDENT, offset=0):
+        self.sheet_type = sheet_type
+        self.offset, self.size = offset, 0
+        self.starts, self.months, self._blocks = [], [], []
+        self._payloads = LRUCache(maxsize=max(resident, 1))
+        self._lock = threading.Lock()
+        self.loads = self.hits = 0
+
+    @property
+    def stop(self): return self.offset + self.size
+
+    def add(self, segment, block):
+        self.starts.append(self.stop)
+        self.months.append(segment['month'])
+        self._blocks.append(block)
+        self.size += len(block)
+
+    def block(self, name, index):
+        """(أول صف، آخر صف + 1، قيم العمود name) للشهر الذي فيه الصف index"""
+        partition = bisect.bisect_right(self.starts, index) - 1
+        stop = self.starts[partition + 1] if partition + 1 < len(self.starts) else self.stop
+        return self.starts[partition], stop, self._column(partition, name)
+
+    def _column(self, partition, name):
+        with self._lock:
+            payload = self._payloads.get(partition)
+            if payload is None:
+                payload = self._payloads[partition] = {}
+            values = payload.get(name)
+            if values is not None:
+                self.hits += 1
+                return values
+            index = SheetDataset.TEXT_COLUMNS[self.sheet_type][name][0]
+            with metrics.timer('hedeya_stage_seconds', stage='archive_load'):
+                values = SheetDataset.text_column(self.sheet_type, name, _RowColumns(self._blocks[partition]))
+            payload[name] = values
+            self.loads += 1
+            return values
+
+    def values(self, name, start, stop):
+        values = []
+        while start < stop:
+            first, last, block = self.block(name, start)
+            values.extend(block[start - first:min(stop, last) - first])
+            start = last
+        return values
+
+    def status(self):
+        return {'partitions': len(self.starts), 'rows': self.size, 'months': min(self.months) + ' - ' + max(self.months) if self.months else None,
+                'resident': len(self._payloads), 'max_resident': self._payloads.maxsize, 'loads': self.loads, 'hits': self.hits}
+
+class PartitionedColumn:
+    """عمود نصي من SheetDataset: الصفوف من archive.offset حتى archive.stop من SheetArchive، وما قبلها (head) وما بعدها (hot)
+    في قوائم عادية. يُستخدم كقائمة: len، الفهرسة برقم أو بمدى (يعيد list)، المرور بالترتيب، و+ قائمة للصفوف الجديدة"""
+
+    def __init__(self, archive, name, hot, head=()):
+        self.archive, self.name, self.hot, self.head = archive, name, hot, list(head)
+        # آخر شهر قُرئ منه: القراءات المتتالية في نفس الشهر (بناء الفهارس، عرض النتائج) لا تمر بالـ LRU
+        self._block = (0, 0, [])
+
+    def __len__(self): return self.archive.stop + len(self.hot)
+
+    def __getitem__(self, index):
+        first, last = self.archive.offset, self.archive.stop
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: return [self[i] for i in range(start, stop, step)]
+            values = self.head[start:min(stop, first)]
+            if max(start, first) < min(stop, last):
+                values += self.archive.values(self.name, max(start, first), min(stop, last))
+            return values + self.hot[max(start - last, 0):max(stop - last, 0)]
+        if index < 0:
+            index += len(self)
+            if index < 0: raise IndexError('PartitionedColumn index out of range')
+        if index < first:
+            return self.head[index]
+        if index >= last:
+            return self.hot[index - last]
+        first, last, block = self._block
+        if not first <= index < last:
+            first, last, block = self._block = self.archive.block(self.name, index)
+        return block[index - first]
+
+    def __iter__(self): return self.iter_from(0)
+
+    def iter_from(self, start):
+        """القيم من start حتى النهاية، شهراً بعد شهر"""
+        yield from itertools.islice(self.head, start, None)
+        start = max(start, self.archive.offset)
+        while start < self.archive.stop:
+            first, last, block = self.archive.block(self.name, start)
+            yield from itertools.islice(block, start - first, None)
+            start = last
+        yield from itertools.islice(self.hot, start - self.archive.stop, None)
+
+    def __add__(self, values):
+        return PartitionedColumn(self.archive, self.name, self.hot + list(values), self.head)
+
+def iter_column(values, start):
+    """قيم عمود (قائمة أو PartitionedColumn) من start حتى النهاية، دون قراءة شهور الأرشيف قبل start"""
+    return values.iter_from(start) if isinstance(values, PartitionedColumn) else itertools.islice(values, start, None)
+
+def archive_cold_rows(dataset, manifest):
+    """بعد حفظ dataset كاملاً: الصفوف الخام تُقرأ من segments الـ manifest (mmap) بدلاً من نسختها في الذاكرة،
+    والأعمدة النصية للشهور القديمة من SheetArchive"""
+    if not manifest or not isinstance(dataset, SheetDataset) or manifest['rows_count'] != len(dataset): return dataset
+    blocks = [_segment_dataset_parts(*_read_segment(segment['file']), dataset.sheet_type)[0] for segment in manifest['segments']]
+    dataset.rows = CompactRows(blocks)
+    first, last = cold_segments(manifest) if dataset.archive is None else (0, 0)
+    if first == last: return dataset
+    archive = SheetArchive(dataset.sheet_type, offset=sum(segment['rows'] for segment in manifest['segments'][:first]))
+    for segment, block in zip(manifest['segments'][first:last], blocks[first:last]):
+        archive.add(segment, block)
+    dataset.archive_rows(archive)
+    return dataset
+
+@timed_stage('local_load')
+def load_snapshot(sheet_type='main', manifest=None):
+    """تحميل اللقطة المحلية المشار إليها في الـ manifest كـ SheetDataset (يرفع استثناء عند الفشل)
+    الصفوف الخام تبقى في الـ segments (mmap)، وsegments الشهور القديمة تُحلل ثم تنتقل أعمدتها النصية إلى SheetArchive
+    واحداً بعد الآخر، فلا تجتمع كلها في الذاكرة"""
+    manifest = manifest or read_snapshot_metadata(sheet_type)
+    first, last = cold_segments(manifest)
+    dataset = SheetDataset([], sheet_type)
+    archive = SheetArchive(sheet_type, offset=sum(segment['rows'] for segment in manifest['segments'][:first]))
+    for position, segment in enumerate(manifest['segments']):
+        block, numeric = _segment_dataset_parts(*_read_segment(segment['file']), sheet_type)
+        dataset = SheetDataset(block, sheet_type, base=dataset if len(dataset) else None, precomputed=numeric)
+        if first <= position < last:
+            archive.add(segment, block)
+            dataset.archive_rows(archive)
+    return dataset
+
+def load_data_locally(sheet_type='main', manifest=None):
+    """تحميل البيانات المحفوظة محلياً كـ SheetDataset (مع دعم ملفات pickle القديمة)"""
+    try:
+        manifest = manifest or read_snapshot_metadata(sheet_type)
+        if manifest is not None:
+            dataset = load_snapshot(sheet_type, manifest)
+            app.logger.info(f"تم تحميل بيانات {sheet_type} من الملف المحلي (آخر تحديث: {manifest['timestamp']})")
+            return dataset
+        filename = _legacy_pickle_path(sheet_type)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                saved_data = pickle.load(f)
+                app.logger.info(f"تم تحميل بيانات {sheet_type} من الملف المحلي (آخر تحديث: {saved_data['timestamp']})")
+                return SheetDataset(saved_data['data'], sheet_type) if saved_data['data'] else None
+    except Exception as e:
+        app.logger.error(f"فشل في تحميل البيانات المحلية: {str(e)}")
+    return None
+
+@contextmanager
+def shared_sheet_lock(sheet_type, timeout=0):
+    """قفل ملف بين العمليات حتى يحمّل عامل gunicorn واحد فقط من Google Sheets بينما يقرأ الباقون اللقطة المحلية
+    يعطي False إذا لم يتحرر القفل خلال timeout ثانية"""
+    if fcntl is None:
+        yield True
+        return
+    with open(f'local_data_{sheet_type}.lock', 'a') as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(0.2)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def sheet_url_for(sheet_type='main'):
+    """رابط الشيت من config.ini (يرفع استثناء إذا لم يوجد)"""
+    # التحقق من وجود ملف الإعدادات
+    if not os.path.exists('config.ini'):
+        raise ValueError("config.ini file not found")
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    url_key = 'sheet_url' if sheet_type == 'main' else 'sales_sheet_url'
+
+    # التحقق من وجود URL في الإعدادات
+    if not config.has_section('GSPREAD') or not config.has_option('GSPREAD', url_key):
+        raise ValueError(f"Missing {url_key} in config.ini")
+    return config.get('GSPREAD', url_key)
+
+def open_worksheet(gc, sheet_type, sheet_url):
+    """فتح ورقة العمل الخاصة بالشيت (يرفع استثناء عند الفشل)"""
+    app.logger.info(f"Attempting to access {sheet_type} sheet: {sheet_url}")
+    spreadsheet = gc.open_by_url(sheet_url)
+    worksheet_name = "الورقة1" if sheet_type == 'main' else "Data Sheet 1"
+
+    try:
+        return spreadsheet.worksheet(worksheet_name)
+    except gspread.WorksheetNotFound:
+        # محاولة استخدام أول ورقة عمل إذا لم يتم العثور على الاسم المحدد
+        app.logger.warning(f"Worksheet '{worksheet_name}' not found, using first worksheet")
+        return spreadsheet.get_worksheet(0)
+
+@timed_stage('sheet_fetch')
+def download_sheet_rows(sheet_type='main'):
+    """تحميل كل صفوف الشيت من Google Sheets (يرفع استثناء عند الفشل)"""
+    worksheet = sheets_connection.worksheet(sheet_type)
+    data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
+    app.logger.info(f"Successfully retrieved {len(data)} rows from {sheet_type} sheet")
+
+    # البيانات بدون العنوان (الصف الأول)
+    return data[1:] if len(data) > 1 else []
+
+@timed_stage('sheet_fetch')
+def download_new_rows(sheet_type, first_known, last_known, known_count):
+    """تحميل الصفوف المضافة بعد آخر صف معروف فقط (للشيتات التي تُضاف صفوفها في الأسفل)
+    يُعاد تحميل أول وآخر صف معروفين في نفس الطلب للتأكد أنهما لم يتغيرا؛ يعيد None إذا لزم تحميل كامل"""
+    if not known_count: return None
+    width = len(last_known)
+    # الصف 1 هو العنوان، لذلك آخر صف معروف رقمه known_count + 1
+    last_column = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, width))
+    head, data = sheets_connection.batch_get(sheet_type, [f"A2:{last_column}2", f"A{known_count + 1}:{last_column}"])
+
+    # القراءة بالنطاقات لا تكمل الخلايا الفارغة في نهاية الصف كما يفعل get_all_values
+    rows = [list(row) + [''] * (width - len(row)) for row in data]
+    head = [list(row) + [''] * (len(first_known) - len(row)) for row in head]
+    if not rows or head != [first_known] or rows[0] != last_known or any(len(row) > width for row in rows):
+        app.logger.warning(f"أول أو آخر صف معروف في {sheet_type} تغير - يلزم تحميل كامل")
+        return None
+    app.logger.info(f"Retrieved {len(rows) - 1} new rows from {sheet_type} sheet")
+    return rows[1:]
+
+def log_download_error(sheet_type, error):
+    if isinstance(error, gspread.SpreadsheetNotFound):
+        app.logger.error(f"Spreadsheet not found for {sheet_type}")
+    elif isinstance(error, json.JSONDecodeError):
+        app.logger.error("Invalid JSON in GSPREAD_CREDENTIALS_JSON")
+    else:
+        app.logger.error(f"Failed to get {sheet_type} sheet data: {str(error)}")
+
+@timed_stage('parse')
+def _build_dataset(rows, sheet_type):
+    return SheetDataset(rows, sheet_type) if rows else rows
+
+def load_local_dataset(sheet_type='main', manifest=None):
+    """البيانات المحفوظة محلياً بعد تحليلها"""
+    local_data = load_data_locally(sheet_type, manifest)
+    if not local_data:
+        app.logger.warning(f"لا توجد بيانات محلية متاحة لـ {sheet_type}")
+        return [] if sheet_type == 'main' else None
+    return local_data
+
+def get_sheet_data(sheet_type='main', offline_mode=False):
+    """آخر نسخة جاهزة من بيانات الشيت؛ التحديث من Google Sheets يتم في الخلفية"""
+    # إذا كان الوضع المطلوب هو العمل بدون إنترنت، حمّل البيانات المحلية مباشرة
+    if offline_mode:
+        app.logger.info(f"الوضع بدون إنترنت مفعل - تحميل البيانات المحلية لـ {sheet_type}")
+        return sheet_refresher.get_offline(sheet_type)
+    return sheet_refresher.get(sheet_type)
+
+def get_sheets_data(*sheet_types):
+    """بيانات عدة شيتات معاً؛ ما لم يُحمَّل بعد يُحمَّل بالتوازي بمهلة مشتركة"""
+    data = sheet_refresher.get_many(sheet_types)
+    return [data[sheet_type] for sheet_type in sheet_types]
+
+# --- التحديث في الخلفية ---
+SHEET_REFRESH_INTERVAL = 240      # ثانية بين كل تحديث ناجح وآخر
+SHEET_REFRESH_JITTER = 30         # توزيع عشوائي حتى لا تتزامن طلبات العمال
+SHEET_RETRY_DELAY = 15            # أول إعادة محاولة بعد الفشل، وتتضاعف مع كل فشل متتالٍ
+SHEET_MAX_BACKOFF = 1800
+SHEET_FULL_SYNC_EVERY = 15        # تحميل كامل كل 15 تحديثاً (حوالي ساعة) لالتقاط التعديلات على الصفوف القديمة
+SHEET_SHARED_POLL_INTERVAL = 5    # فحص الـ manifest لالتقاط ما حمّله العمال الآخرون
+SHEET_SHARED_LOCK_TIMEOUT = 90    # أقصى انتظار لعامل آخر يحمّل نفس الشيت عند أول تحميل
+SHEET_LOAD_DEADLINE = 25          # مهلة مشتركة لتحميل عدة شيتات معاً، بعدها تُستخدم البيانات المحلية لما تأخر
+SHEET_REFRESH_DEADLINE = 120      # مهلة التحديث اليدوي من /refresh_local_data
+
+class SheetRefresher:
+    """يحتفظ بآخر نسخة ناجحة من كل شيت ويحدّثها في thread بالخلفية قبل أن تقدم (stale-while-revalidate)
+    بين عمال gunicorn: عامل واحد يحمل قفل الشيت ويحمّل من Google Sheets ويكتب اللقطة المحلية، والباقون يقرؤونها"""
+
+    def __init__(self, sheet_types=('main', 'sales')):
+        self.sheet_types = sheet_types
+        self.snapshots, self.next_refresh, self.failures = {}, {}, {}
+        self.last_success, self.last_error = {}, {}
+        # generation اللقطة المحلية المطابقة للنسخة الموجودة في الذاكرة
+        self.generations = {}
+        # (البيانات، generation) منشورتان معاً في تعيين واحد: الطلبات تقرأ النسخة ثم generation الخاصة بها
+        # لمفتاح صفحات لوحة التحكم والـ ETag، فلا يجوز أن ترى بيانات جديدة مع generation قديمة أو العكس
+        self.versions = {}
+        # عدادات هذا العامل: hits/misses للطلبات، وما تم تحميله من Google Sheets مقابل ما قُرئ من عامل آخر
+        self.stats = {sheet_type: dict.fromkeys(('hits', 'misses', 'upstream_fetches', 'shared_loads', 'lock_busy', 'offline_loads', 'deadline_misses'), 0)
+                      for sheet_type in sheet_types}
+        self._locks = {sheet_type: threading.Lock() for sheet_type in sheet_types}
+        # نسخة الوضع بدون إنترنت: (generation، البيانات) كما قُرئت من اللقطة المحلية
+        self.offline = {}
+        self._offline_locks = {sheet_type: threading.Lock() for sheet_type in sheet_types}
+        self._thread, self._pool = None, None
+        # دوال تُستدعى عند نشر بيانات جديدة لشيت (لإفراغ ما بُني على النسخة السابقة)
+        self.listeners = []
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """تشغيل thread التحديث عند أول استخدام (بعد fork عمال gunicorn)"""
+        if self._thread and self._thread.is_alive(): return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._run, name='sheet-refresher', daemon=True)
+            self._thread.start()
+
+    def get(self, sheet_type):
+        """آخر نسخة جاهزة فوراً؛ الانتظار فقط في أول تحميل للشيت"""
+        self.start()
+        if sheet_type in self.snapshots:
+            self.stats[sheet_type]['hits'] += 1
+        else:
+            self.stats[sheet_type]['misses'] += 1
+            with self._locks[sheet_type]:
+                if sheet_type not in self.snapshots:
+                    self._refresh_locked(sheet_type, timeout=SHEET_SHARED_LOCK_TIMEOUT)
+        return self.snapshots[sheet_type]
+
+    def _executor(self):
+        """threads تحميل الشيتات بالتوازي، تُنشأ عند أول استخدام (بعد fork عمال gunicorn)"""
+        with self._start_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=len(self.sheet_types), thread_name_prefix='sheet-loader')
+            return self._pool
+
+    def get_many(self, sheet_types, timeout=SHEET_LOAD_DEADLINE):
+        """عدة شيتات معاً: ما لم يُحمَّل بعد يُحمَّل بالتوازي، وما لم يكتمل خلال المهلة تُستخدم بياناته المحلية
+        ويكمل تحميله في الخلفية"""
+        futures = {sheet_type: self._executor().submit(self.get, sheet_type)
+                   for sheet_type in sheet_types if sheet_type not in self.snapshots}
+        wait(futures.values(), timeout=timeout)
+        data = {}
+        for sheet_type in sheet_types:
+            future = futures.get(sheet_type)
+            if future is None:
+                data[sheet_type] = self.get(sheet_type)
+            elif future.done() and future.exception() is None:
+                data[sheet_type] = future.result()
+            else:
+                app.logger.warning(f"لم يكتمل تحميل {sheet_type} خلال {timeout} ثانية - استخدام البيانات المحلية")
+                self.stats[sheet_type]['deadline_misses'] += 1
+                data[sheet_type] = self.get_offline(sheet_type)
+        return data
+
+    def refresh_many(self, sheet_types, full=False, timeout=SHEET_REFRESH_DEADLINE):
+        """تحديث عدة شيتات بالتوازي بمهلة مشتركة: True/False لكل شيت، وNone لما لم يكتمل (يكمل في الخلفية)"""
+        futures = {sheet_type: self._executor().submit(self.refresh, sheet_type, full=full) for sheet_type in sheet_types}
+        wait(futures.values(), timeout=timeout)
+        return {sheet_type: (future.exception() is None and future.result()) if future.done() else None
+                for sheet_type, future in futures.items()}
+
+    def get_offline(self, sheet_type):
+        """بيانات اللقطة المحلية دون الاتصال بـ Google Sheets
+        إذا كانت النسخة المباشرة هي نفسها المحفوظة محلياً يُعاد نفس الكائن بدلاً من تحميل نسخة ثانية"""
+        manifest = self._read_manifest(sheet_type)
+        generation = manifest['generation'] if manifest else None
+        published = self.versions.get(sheet_type)
+        if generation is not None and published is not None and published[1] == generation:
+            return published[0]
+
+        # طلب واحد فقط يقرأ الملف المحلي والباقون ينتظرون نتيجته
+        with self._offline_locks[sheet_type]:
+            cached = self.offline.get(sheet_type)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+            dataset = load_local_dataset(sheet_type, manifest)
+            self.offline[sheet_type] = (generation, dataset)
+            self.stats[sheet_type]['offline_loads'] += 1
+            return dataset
+
+    def refresh(self, sheet_type, only_if_due=False, full=False):
+        """تحديث الشيت الآن، ويعيد False إذا فشل التحميل من Google Sheets"""
+        with self._locks[sheet_type]:
+            if only_if_due and self.next_refresh.get(sheet_type, 0) > time.monotonic():
+                return True
+            # التحميل الأول أو الكامل ينتظر العامل الذي يحمل القفل، والتحديث الدوري لا ينتظر
+            cold = full or sheet_type not in self.snapshots
+            return self._refresh_locked(sheet_type, full, timeout=SHEET_SHARED_LOCK_TIMEOUT if cold else 0)
+
+    def poll_shared(self, sheet_type):
+        """التقاط ما كتبه العمال الآخرون في اللقطة المحلية دون الاتصال بـ Google Sheets"""
+        with self._locks[sheet_type]:
+            self._adopt_shared(sheet_type, self._read_manifest(sheet_type))
+
+    def _read_manifest(self, sheet_type):
+        try:
+            return read_snapshot_metadata(sheet_type)
+        except Exception as e:
+            app.logger.error(f"فشل في قراءة البيانات الوصفية المحلية لـ {sheet_type}: {str(e)}")
+            return None
+
+    def _adopt_shared(self, sheet_type, manifest):
+        """استخدام اللقطة المحلية إذا كانت أحدث من النسخة الموجودة في الذاكرة"""
+        if manifest is None or manifest.get('generation') == self.generations.get(sheet_type): return False
+        try:
+            dataset = load_snapshot(sheet_type, manifest)
+            self._prepare(dataset)
+        except Exception as e:
+            app.logger.error(f"فشل في تحميل اللقطة المحلية لـ {sheet_type}: {str(e)}")
+            return False
+        self._publish(sheet_type, dataset if len(dataset) else [], manifest['generation'])
+        self.stats[sheet_type]['shared_loads'] += 1
+        return True
+
+    def _publish(self, sheet_type, dataset, generation=None):
+        """نشر نسخة جديدة مع generation لقطتها المحلية (None إذا لم تُحفظ) قبل إبلاغ المستمعين"""
+        changed = self.snapshots.get(sheet_type) is not dataset
+        self.generations[sheet_type] = generation
+        self.versions[sheet_type] = (dataset, generation)
+        self.snapshots[sheet_type] = dataset
+        if changed:
+            for listener in self.listeners:
+                listener(sheet_type)
+
+    @timed_stage('index')
+    def _prepare(self, dataset):
+        """تجهيز تجميعات لوحة التحكم وفهارس البحث للصفوف الجديدة قبل أن تصل إليها الطلبات
+        (فهارس البحث تُبنى هنا أيضاً لأن بناءها عند أول طلب يعني قراءة عمودها من كل شهور الأرشيف أثناء الطلب)"""
+        if isinstance(dataset, SheetDataset) and len(dataset):
+            if dataset.sheet_type == 'sales':
+                dataset.sales_index()
+            else:
+                dataset.rollup()
+                dataset.query_index()
+                dataset.invoice_table()
+                dataset.search_index('invoice')
+                dataset.search_index('phone')
+
+    def _sync(self, sheet_type, full, manifest):
+        """تحميل تزايدي للصفوف الجديدة فوق اللقطة الحالية، أو تحميل كامل عند الحاجة؛ يعيد (البيانات، الـ manifest الجديد)
+        التحميل التزايدي للشيتات التي تُضاف صفوفها في الأسفل فقط: الشيت المرتب بالأحدث أولاً تتغير صفوفه الأولى مع كل
+        يوم جديد، فيُحمَّل كاملاً مباشرة بدلاً من طلب تزايدي يفشل في كل مرة"""
+        snapshot = self.snapshots.get(sheet_type)
+        count = manifest.get('incremental_since_full_sync') if manifest else None
+        self.stats[sheet_type]['upstream_fetches'] += 1
+        in_sync_with_disk = manifest is not None and self.generations.get(sheet_type) == manifest['generation']
+        if (not full and isinstance(snapshot, SheetDataset) and in_sync_with_disk and count is not None and count < SHEET_FULL_SYNC_EVERY
+                and not newest_first(snapshot)):
+            new_rows = download_new_rows(sheet_type, snapshot.first_row, snapshot.rows[-1], len(snapshot))
+            if new_rows is not None:
+                sync_info = {'synced_at': time.time(), 'incremental_since_full_sync': count + 1}
+                if not new_rows:
+                    return snapshot, mark_snapshot_synced(manifest, **sync_info)
+                with metrics.timer('hedeya_stage_seconds', stage='parse'):
+                    dataset = snapshot.appended(new_rows)
+                return dataset, save_data_locally(dataset, sheet_type, new_rows_count=len(new_rows), **sync_info)
+
+        dataset = _build_dataset(download_sheet_rows(sheet_type), sheet_type)
+        # حفظ البيانات محلياً للاستخدام المستقبلي وللعمال الآخرين، ثم ترك صفوف الشهور القديمة للأرشيف بعد التجهيز
+        manifest = save_data_locally(dataset, sheet_type, synced_at=time.time(), incremental_since_full_sync=0)
+        self._prepare(dataset)
+        return archive_cold_rows(dataset, manifest), manifest
+
+    def _refresh_locked(self, sheet_type, full=False, timeout=0):
+        with shared_sheet_lock(sheet_type, timeout) as acquired:
+            manifest = self._read_manifest(sheet_type)
+            if not acquired:
+                # عامل آخر يحمّل هذا الشيت الآن: استخدام آخر ما كتبه وترك التحديث له
+                self.stats[sheet_type]['lock_busy'] += 1
+                self._adopt_shared(sheet_type, manifest)
+                if sheet_type not in self.snapshots:
+                    self._publish(sheet_type, self.get_offline(sheet_type))
+                self._schedule(sheet_type, SHEET_REFRESH_INTERVAL)
+                return True
+
+            age = time.time() - manifest.get('synced_at', 0) if manifest else None
+            if not full and age is not None and age < SHEET_REFRESH_INTERVAL:
+                # عامل آخر حدّث البيانات مؤخراً فلا داعي للاتصال بـ Google Sheets
+                self._adopt_shared(sheet_type, manifest)
+                if sheet_type in self.snapshots:
+                    self._schedule(sheet_type, SHEET_REFRESH_INTERVAL - age)
+                    return True
+
+            # البدء من اللقطة المحلية (قد تكون من تشغيل سابق) ثم جلب الصفوف الجديدة فقط
+            self._adopt_shared(sheet_type, manifest)
+            try:
+                dataset, manifest = self._sync(sheet_type, full, manifest)
+            except Exception as e:
+                log_download_error(sheet_type, e)
+                sheets_connection.reset(sheet_type, e)
+                return self._refresh_failed(sheet_type, e)
+            try:
+                self._prepare(dataset)
+                self._publish(sheet_type, dataset, manifest['generation'] if manifest else None)
+            except Exception as e:
+                app.logger.error(f"فشل في تجهيز بيانات {sheet_type}: {str(e)}")
+                return self._refresh_failed(sheet_type, e)
+
+        self.failures[sheet_type] = 0
+        self.last_error.pop(sheet_type, None)
+        self.last_success[sheet_type] = datetime.now()
+        self._schedule(sheet_type, SHEET_REFRESH_INTERVAL)
+        return True
+
+    def _refresh_failed(self, sheet_type, error):
+        """إعادة المحاولة بعد مهلة متزايدة، وإذا لم توجد نسخة ناجحة بعد تُستخدم البيانات المحلية بدلاً من Google Sheets"""
+        self.failures[sheet_type] = self.failures.get(sheet_type, 0) + 1
+        self.last_error[sheet_type] = str(error)
+        self._schedule(sheet_type, min(SHEET_RETRY_DELAY * 2 ** (self.failures[sheet_type] - 1), SHEET_MAX_BACKOFF))
+        if sheet_type not in self.snapshots:
+            self._publish(sheet_type, self.get_offline(sheet_type))
+        return False
+
+    def _schedule(self, sheet_type, delay):
+        self.next_refresh[sheet_type] = time.monotonic() + delay + random.uniform(-SHEET_REFRESH_JITTER, SHEET_REFRESH_JITTER) * (delay > SHEET_REFRESH_JITTER)
+
+    def _run(self):
+        while True:
+            for sheet_type in self.sheet_types:
+                try:
+                    self.refresh(sheet_type, only_if_due=True)
+                    self.poll_shared(sheet_type)
+                except Exception as e:
+                    app.logger.error(f"فشل التحديث في الخلفية لـ {sheet_type}: {str(e)}")
+            next_due = min(self.next_refresh.get(sheet_type, 0) for sheet_type in self.sheet_types)
+            time.sleep(min(max(next_due - time.monotonic(), 1.0), SHEET_SHARED_POLL_INTERVAL))
+
+    def data_version(self, dataset):
+        """نسخة البيانات للـ ETag: generation اللقطة المحلية المشتركة بين العمال، أو هوية الكائن إذا لم تُحفظ"""
+        if not dataset: return 'empty'
+        for sheet_type in self.sheet_types:
+            published = self.versions.get(sheet_type)
+            if published is not None and published[1] is not None and published[0] is dataset:
+                return f'{sheet_type}:{published[1]}'
+            offline = self.offline.get(sheet_type)
+            if offline is not None and offline[0] is not None and offline[1] is dataset:
+                return f'{sheet_type}:{offline[0]}'
+        return f'{id(dataset):x}:{len(dataset)}'
+
+    def _archive(self, sheet_type):
+        return getattr(self.snapshots.get(sheet_type), 'archive', None)
+
+    def _sales_index(self, sheet_type):
+        index = getattr(self.snapshots.get(sheet_type), '_sales_index', None)
+        return index.status() if index is not None else None
+
+    def status(self):
+        now = time.monotonic()
+        return {sheet_type: {
+            'loaded': sheet_type in self.snapshots,
+            'rows_count': len(self.snapshots.get(sheet_type) or []),
+            'generation': self.generations.get(sheet_type),
+            'last_success': self.last_success[sheet_type].strftime('%Y-%m-%d %H:%M:%S') if sheet_type in self.last_success else None,
+            'consecutive_failures': self.failures.get(sheet_type, 0),
+            'last_error': self.last_error.get(sheet_type),
+            'next_refresh_in': round(self.next_refresh[sheet_type] - now) if sheet_type in self.next_refresh else None,
+            'archive': self._archive(sheet_type).status() if self._archive(sheet_type) else None,
+            'sales_analysis': self._sales_index(sheet_type),
+            'rows_storage': self.snapshots[sheet_type].rows.status() if isinstance(self.snapshots.get(sheet_type), SheetDataset) else None,
+            **self.stats[sheet_type],
+        } for sheet_type in self.sheet_types}
+
+sheet_refresher = SheetRefresher()
+
+# --- دالة مخصصة وآمنة لمعالجة التاريخ ---
+# تنسيق Google Sheets / Oracle: "15-JUN-25 05.10.52 PM +03:00"
+ORACLE_TIMESTAMP_PATTERN = re.compile(r'(\d{1,2})-([A-Z]{3})-(\d{2})\s+(\d{1,2})\.(\d{2})\.(\d{2})\s+(AM|PM)')
+ISO_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+MONTH_NUMBERS = {name.upper(): number for number, name in enumerate(ARABIC_MONTH_NAMES, 1)}
+# شيت المبيعات يخزن التواريخ كأرقام Excel التسلسلية (مثل 45849 = 2025-07-11)
+EXCEL_EPOCH = datetime(1899, 12, 30)
+EXCEL_SERIAL_RANGE = (20000, 100000)
+UNIX_EPOCH = datetime(1970, 1, 1)
+EXCEL_UNIX_EPOCH_DAYS = (UNIX_EPOCH - EXCEL_EPOCH).days
+NAT_SECONDS = np.iinfo(np.int64).min
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _excel_serial_to_datetime(serial):
+    if not EXCEL_SERIAL_RANGE[0] <= serial < EXCEL_SERIAL_RANGE[1]: return None
+    return EXCEL_EPOCH + timedelta(seconds=round(serial * 86400))
+
+def _oracle_match_to_datetime(match):
+    day, month, year, hour, minute, second, ampm = match.groups()
+    hour = int(hour)
+    # تحويل إلى تنسيق 24 ساعة
+    if ampm == 'PM' and hour != 12:
+        hour += 12
+    elif ampm == 'AM' and hour == 12:
+        hour = 0
+    try:
+        return datetime(2000 + int(year), MONTH_NUMBERS[month], int(day), hour, int(minute), int(second))
+    except (KeyError, ValueError):
+        return None
+
+@lru_cache(maxsize=65536)
+def _parse_date_text(date_str):
+    """تحليل النصوص غير المطابقة لتنسيق Oracle مع حفظ النتائج للنصوص المتكررة"""
+    dt_object = _excel_serial_to_datetime(_to_float(date_str))
+    if dt_object: return dt_object
+    if ISO_DATE_PATTERN.match(date_str):
+        try:
+            return datetime.fromisoformat(date_str)
+        except ValueError:
+            pass
+    # dateutil للقيم الشاذة فقط لأنه بطيء
+    try:
+        return parse(date_str, fuzzy=True)
+    except (ParserError, ValueError, TypeError, OverflowError):
+        return None
+
+def parse_date_safely(date_str):
+    if not date_str: return None
+
+    if _is_number(date_str):
+        dt_object = _excel_serial_to_datetime(date_str)
+        if dt_object: return dt_object
+
+    # تحويل إلى نص أولاً
+    date_str = str(date_str).strip()
+    if not date_str: return None
+
+    # إزالة المنطقة الزمنية إذا وجدت
+    if '+' in date_str:
+        date_str = date_str.split('+')[0].strip()
+
+    match = ORACLE_TIMESTAMP_PATTERN.match(date_str)
+    if match:
+        return _oracle_match_to_datetime(match)
+    return _parse_date_text(date_str)
+
+def _detect_date_format(values, sample_size=50):
+    """اكتشاف تنسيق عمود التاريخ من عينة من أول القيم غير الفارغة"""
+    sample = [value for value in values[:sample_size * 4] if value][:sample_size]
+    if not sample: return None
+    serials = sum(1 for value in sample if _is_number(value))
+    oracle = sum(1 for value in sample if isinstance(value, str) and ORACLE_TIMESTAMP_PATTERN.match(value))
+    if serials * 2 > len(sample): return 'excel_serial'
+    if oracle * 2 > len(sample): return 'oracle'
+    return None
+
+def parse_date_column(values):
+    """تحليل عمود تواريخ كامل إلى datetime64: يُكتشف التنسيق مرة واحدة ثم يُطبق المسار السريع، مع parse_date_safely للقيم الأخرى"""
+    date_format = _detect_date_format(values)
+    serial_mask = None
+
+    if date_format == 'excel_serial':
+        serials = np.array([value if _is_number(value) else np.nan for value in values], dtype=np.float64)
+        serial_mask = (serials >= EXCEL_SERIAL_RANGE[0]) & (serials < EXCEL_SERIAL_RANGE[1])
+
+    # ثوانٍ منذ 1970 مباشرة (أسرع بكثير من تحويل numpy لكائنات datetime)، وأصغر قيمة int64 تمثل NaT
+    seconds = [NAT_SECONDS] * len(values)
+    for i in (np.flatnonzero(~serial_mask) if serial_mask is not None else range(len(values))):
+        value = values[i]
+        match = ORACLE_TIMESTAMP_PATTERN.match(value) if date_format == 'oracle' and isinstance(value, str) else None
+        dt_object = _oracle_match_to_datetime(match) if match else parse_date_safely(value)
+        if dt_object is not None:
+            seconds[i] = int((dt_object.replace(tzinfo=None) - UNIX_EPOCH).total_seconds())
+
+    column = np.array(seconds, dtype=np.int64)
+    if serial_mask is not None:
+        column[serial_mask] = np.round((serials[serial_mask] - EXCEL_UNIX_EPOCH_DAYS) * 86400).astype(np.int64)
+    return column.view('datetime64[s]')
+
+# --- مجموعة البيانات العمودية ---
+MAIN_COLUMNS = {'date': 0, 'invoice': 1, 'amount': 2, 'payment': 3, 'cashier': 4, 'customer_name': 5, 'customer_phone': 6}
+SALES_COLUMNS = {'date': 0, 'item_code': 1, 'description': 2, 'quantity': 3, 'amount': 4}
+
+def _cell_text(value):
+    """النص المنظف للخلية أو نص فارغ إذا كانت الخلية فارغة"""
+    return str(value).strip() if value else ''
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+def _to_invoice_number(value):
+    try:
+        number = int(float(value))
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return number if -2 ** 63 <= number < 2 ** 63 else None
+
+def _intern_column(values, lookup, categories):
+    """تحويل عمود نصي متكرر إلى أكواد رقمية، مع إضافة القيم الجديدة إلى قائمة القيم الفريدة"""
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        key = (type(value), value)
+        code = lookup.get(key)
+        if code is None:
+            code = lookup[key] = len(categories)
+            categories.append(value)
+        codes[i] = code
+    return codes
+
+def _to_datetime(value):
+    """تحويل قيمة datetime64 إلى datetime أو None"""
+    return None if np.isnat(value) else value.astype(datetime)
+
+def format_arabic_date(dt_object):
+    month = dt_object.strftime('%b')
+    return f"{dt_object.day:02d} {ARABIC_MONTH_NAMES.get(month, month)} {dt_object.year}"
+
+class SheetDataset:
+    """بيانات الشيت بعد تحليلها مرة واحدة إلى أعمدة مصنفة (تواريخ، مبالغ، أرقام فواتير...)
+    النسخة لا تتغير بعد إنشائها؛ إضافة صفوف جديدة تنتج نسخة جديدة عبر appended()"""
+    CATEGORY_COLUMNS = {'main': ('payment', 'cashier', 'customer'), 'sales': ('item',)}
+    # الأعمدة الرقمية التي تُحفظ محللة في اللقطة المحلية فلا يُعاد تحليلها عند التحميل
+    NUMERIC_COLUMNS = {'main': ('dates', 'invoice_ok', 'invoice_numbers', 'amounts', 'row_lengths'),
+                       'sales': ('dates', 'quantities', 'amounts', 'row_lengths')}
+    # الأعمدة النصية كما هي في الصفوف: الاسم -> (رقم العمود في الشيت، دالة التحويل أو None)
+    TEXT_COLUMNS = {'main': {'invoice_texts': (MAIN_COLUMNS['invoice'], _cell_text), 'customer_phones': (MAIN_COLUMNS['customer_phone'], None),
+                             'phone_texts': (MAIN_COLUMNS['customer_phone'], _cell_text)},
+                    'sales': {'descriptions': (SALES_COLUMNS['description'], lambda value: str(value).strip())}}
+    def __init__(self, rows, sheet_type='main', base=None, precomputed=None):
+        """rows: قوائم الخلايا كما جاءت من الشيت، أو RowBlock مقروء من segment"""
+        self.sheet_type = sheet_type
+        # الصفوف الخام تُحفظ مضغوطة؛ الصفوف الجديدة تُحلل من أعمدتها مباشرة، والمقروءة من segment من الـ RowBlock
+        # (كل عمود يُفك مرة واحدة حتى لو استخدمه أكثر من عمود محلل، وتكرارات النص الواحد تعود نفس الكائن)
+        if isinstance(rows, RowBlock):
+            block, cells = rows, _RowColumns(rows)
+        else:
+            columns, lengths = _row_columns(rows)
+            block = RowBlock.from_columns(columns, lengths)
+            cells = _RowColumns(block, columns)
+        self.rows = base.rows + block if base is not None else CompactRows([block])
+        self.archive = base.archive if base is not None else None
+        # أول صف يبقى في الذاكرة لأن التحديث التزايدي يقارنه بالشيت في كل مرة
+        self.first_row = base.first_row if base is not None else (block.rows(0, 1)[0] if len(block) else None)
+        # فهارس البحث مشتركة مع النسخة الأساسية وتُكمَل للصفوف الجديدة فقط
+        self._search_indexes = base._search_indexes if base is not None else {}
+        # التجميعات اليومية لا تتغير، فالنسخة الجديدة تبدأ من تجميعات النسخة الأساسية وتضيف الصفوف الجديدة
+        self._rollup = base._rollup if base is not None else None
+        self._query_index = base._query_index if base is not None else None
+        self._invoice_table = base._invoice_table if base is not None else None
+        self._sales_index = base._sales_index if base is not None else None
+        self._lookups = {}
+        for name in self.CATEGORY_COLUMNS[sheet_type]:
+            self._lookups[name] = dict(base._lookups[name]) if base is not None else {}
+            setattr(self, f'{name}_categories', list(getattr(base, f'{name}_categories')) if base is not None else [])
+
+        precomputed = precomputed or {}
+        columns = self._parse_main_rows(cells, precomputed) if sheet_type == 'main' else self._parse_sales_rows(cells, precomputed)
+        columns['row_lengths'] = block.lengths
+        for name, column in columns.items():
+            if base is not None:
+                previous = getattr(base, name)
+                column = np.concatenate([previous, column]) if isinstance(column, np.ndarray) else previous + column
+            setattr(self, name, column)
+
+    def __len__(self): return len(self.rows)
+    def __iter__(self): return iter(self.rows)
+    def __getitem__(self, index): return self.rows[index]
+
+    def appended(self, rows):
+        """نسخة جديدة تضيف صفوفاً في نهاية البيانات مع تحليل الصفوف الجديدة فقط"""
+        return SheetDataset(rows, self.sheet_type, base=self)
+
+    def archive_rows(self, archive):
+        """الصفوف من archive.offset حتى archive.stop تُقرأ أعمدتها النصية من archive، وما قبلها وبعدها يبقى في الذاكرة
+        (يُستدعى أثناء التحميل فقط، قبل أن تصل النسخة إلى الطلبات)"""
+        self.archive = archive
+        # الصفوف بعد الأرشيف من القائمة في الذاكرة (العمود قد يكون مبنياً على الأرشيف قبل أن يكبر)
+        keep = len(self.row_lengths) - archive.stop
+        for name in self.TEXT_COLUMNS[self.sheet_type]:
+            column = getattr(self, name)
+            if isinstance(column, PartitionedColumn):
+                head, values = column.head, column.hot
+            else:
+                head, values = column[:archive.offset], column
+            setattr(self, name, PartitionedColumn(archive, name, values[len(values) - keep:], head))
+
+    @classmethod
+    def text_column(cls, sheet_type, name, cells):
+        """العمود النصي name من أعمدة الصفوف (_RowColumns)"""
+        return cells.converted(*cls.TEXT_COLUMNS[sheet_type][name])
+
+    def _text_columns(self, cells):
+        return {name: self.text_column(self.sheet_type, name, cells) for name in self.TEXT_COLUMNS[self.sheet_type]}
+
+    def _intern(self, name, values):
+        return _intern_column(values, self._lookups[name], getattr(self, f'{name}_categories'))
+
+    def _intern_cells(self, name, cells, j, convert=None):
+        """أكواد قيم العمود رقم j؛ العمود المحفوظ كأكواد تُضاف قيمه الفريدة فقط ثم تُنقل إليها أكواد الصفوف"""
+        coded = cells.coded(j, convert)
+        if coded is None:
+            return self._intern(name, cells.converted(j, convert))
+        categories, codes = coded
+        return self._intern(name, categories)[codes]
+
+    def _parse_main_rows(self, cells, precomputed):
+        """cells: أعمدة الصفوف الجديدة (_RowColumns)"""
+        cols = MAIN_COLUMNS
+        columns = {
+            **self._text_columns(cells),
+            'payment_codes': self._intern_cells('payment', cells, cols['payment'], lambda value: str(value).strip()),
+            'cashier_codes': self._intern_cells('cashier', cells, cols['cashier']),
+            'customer_codes': self._intern_cells('customer', cells, cols['customer_name']),
+        }
+        if 'dates' in precomputed:
+            columns.update({name: precomputed[name] for name in ('dates', 'invoice_ok', 'invoice_numbers', 'amounts')})
+            return columns
+        invoice_numbers = [_to_invoice_number(value) for value in cells(cols['invoice'])]
+        columns.update({
+            'dates': parse_date_column(cells(cols['date'])),
+            'invoice_ok': np.array([n is not None for n in invoice_numbers], dtype=bool),
+            'invoice_numbers': np.array([n if n is not None else 0 for n in invoice_numbers], dtype=np.int64),
+            'amounts': np.array([_to_float(value) for value in cells(cols['amount'])], dtype=np.float64),
+        })
+        return columns
+
+    def _parse_sales_rows(self, cells, precomputed):
+        cols = SALES_COLUMNS
+        columns = {
+            **self._text_columns(cells),
+            'item_codes': self._intern_cells('item', cells, cols['item_code'], lambda value: str(value).strip()),
+        }
+        if 'dates' in precomputed:
+            columns.update({name: precomputed[name] for name in ('dates', 'quantities', 'amounts')})
+            return columns
+        columns.update({
+            'dates': parse_date_column(cells(cols['date'])),
+            'quantities': np.array([_to_float(str(value).replace(',', '.')) for value in cells(cols['quantity'])], dtype=np.float64),
+            'amounts': np.array([_to_float(value) for value in cells(cols['amount'])], dtype=np.float64),
+        })
+        return columns
+
+    def payment_display(self, index, fallback=None):
+        payment = self.payment_categories[self.payment_codes[index]]
+        key = payment.lower()
+        return PAYMENT_METHOD_MAP.get(key, fallback(key) if fallback else payment)
+
+    def cashier(self, index): return self.cashier_categories[self.cashier_codes[index]]
+    def customer_name(self, index): return self.customer_categories[self.customer_codes[index]]
+
+    def search_index(self, search_type):
+        """فهرس البحث لعمود الفاتورة أو الهاتف، يُبنى عند أول استخدام ويُكمَل للصفوف الجديدة"""
+        if search_type == 'invoice':
+            texts, search_col = self.invoice_texts, MAIN_COLUMNS['invoice']
+        else:
+            texts, search_col = self.phone_texts, MAIN_COLUMNS['customer_phone']
+        index = self._search_indexes.get(search_type)
+        if index is None:
+            phone = search_type == 'phone'
+            index = self._search_indexes.setdefault(search_type, SearchIndex(with_grams=phone, normalize=normalize_phone if phone else None))
+        if index.size < len(texts):
+            index.update(texts, self.row_lengths > max(MAIN_COLUMNS['customer_phone'], search_col))
+        return index
+
+    def customer_matches(self, query):
+        """[(كود العميل، الدرجة)] للأسماء المطابقة لـ query بعد التوحيد، الأقوى أولاً"""
+        index = self._search_indexes.get('customer_name')
+        if index is None:
+            index = self._search_indexes.setdefault('customer_name', CustomerNameIndex())
+        if len(index.names) < len(self.customer_categories):
+            index.update(self.customer_categories)
+        return index.ranked(query, len(self.customer_categories))
+
+    def rollup(self):
+        """التجميعات اليومية لشيت الفواتير (DailyRollup)، تُبنى عند أول استخدام وتُكمَل للصفوف الجديدة فقط"""
+        rollup = self._rollup
+        if rollup is None or rollup.size < len(self):
+            rollup = self._rollup = (rollup or DailyRollup()).extended(self)
+        return rollup
+
+    def sales_index(self):
+        """فهرس تحليل شيت المبيعات (SalesIndex)، يُبنى عند أول استخدام ويُدمج فيه الصفوف الجديدة فقط"""
+        index = self._sales_index
+        if index is None or index.size < len(self):
+            index = self._sales_index = (index or SalesIndex()).extended(self)
+        return index
+
+    def query_index(self):
+        """فهارس البحث المتقدم (QueryIndex)، تُبنى عند أول استخدام ويُدمج فيها الصفوف الجديدة فقط"""
+        index = self._query_index
+        if index is None or index.size < len(self):
+            index = self._query_index = (index or QueryIndex()).extended(self)
+        return index
+
+    def invoice_table(self):
+        """جدول الفواتير (InvoiceTable)، يُبنى عند أول استخدام وتُضاف إليه الصفوف الجديدة فقط"""
+        table = self._invoice_table
+        if table is None or table.size < len(self):
+            table = self._invoice_table = (table or InvoiceTable()).extended(self)
+        return table
+
+    def category_codes(self, name, predicate):
+        """أكواد القيم المصنفة في العمود name التي تحقق الشرط"""
+        return [code for code, value in enumerate(getattr(self, f'{name}_categories')) if predicate(value)]
+
+    def category_mask(self, codes, categories, predicate):
+        """قناع منطقي للصفوف التي تحقق قيمتها المصنفة الشرط (يُقيَّم مرة لكل قيمة فريدة)"""
+        selected = [code for code, value in enumerate(categories) if predicate(value)]
+        return np.isin(codes, np.array(selected, dtype=np.int32))
+
+class SearchIndex:
+    """فهرس مطابقة تامة (نصية ورقمية) وفهرس n-gram للبحث الجزئي على عمود واحد، يُحدَّث تدريجياً للصفوف الجديدة"""
+    GRAM_SIZE = 3
+
+    def __init__(self, with_grams=False, normalize=None):
+        self.with_grams = with_grams
+        # دالة توحيد اختيارية (مثل normalize_phone): النص الموحد يُفهرس كمفتاح إضافي
+        self.normalize = normalize
+        self.by_text, self.by_number, self.by_gram = {}, {}, {}
+        # النصوص الفريدة المفهرسة بالـ n-grams، للفحص المباشر عند استعلام أقصر من الـ n-gram
+        self.texts = set()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def update(self, texts, eligible):
+        """فهرسة الصفوف التي أضيفت منذ آخر تحديث فقط"""
+        with self._lock:
+            self._update_locked(texts, eligible)
+
+    def _update_locked(self, texts, eligible):
+        for i, text in enumerate(iter_column(texts, self.size), self.size):
+            if not text or not eligible[i]: continue
+            # النص كما هو وبعد إزالة .0 (مثل "37372.0") وبعد التوحيد
+            keys = self._keys(text)
+            for key in keys | {text.replace('.0', '')}:
+                self.by_text.setdefault(key, []).append(i)
+            # القيمة الرقمية تجعل "01204926919" و"1204926919" مفتاحاً واحداً
+            number = _to_float(text)
+            if not np.isnan(number):
+                self.by_number.setdefault(number, []).append(i)
+            if self.with_grams:
+                self.texts.update(keys)
+                for key in keys:
+                    for j in range(len(key) - self.GRAM_SIZE + 1):
+                        self.by_gram.setdefault(key[j:j + self.GRAM_SIZE], set()).add(key)
+        self.size = max(self.size, len(texts))
+
+    def _keys(self, text):
+        normalized = self.normalize(text) if self.normalize else None
+        return {text, normalized} if normalized else {text}
+
+    def exact(self, query, limit):
+        """الصفوف المطابقة تماماً ضمن أول limit صف (الفهرس قد يكون مشتركاً مع نسخة أحدث من البيانات)"""
+        matches = set()
+        for key in self._keys(query):
+            matches.update(self.by_text.get(key, ()))
+        number = _to_float(query)
+        if not np.isnan(number):
+            matches.update(self.by_number.get(number, ()))
+        return {i for i in matches if i < limit}
+
+    def partial(self, query, limit):
+        """الصفوف التي يحتوي نصها على الاستعلام، عبر تقاطع قوائم الـ n-grams ثم التحقق"""
+        matches = set()
+        for key in self._keys(query):
+            if len(key) < self.GRAM_SIZE:
+                # استعلام أقصر من الـ n-gram: فحص كل النصوص الفريدة
+                with self._lock:
+                    candidates = set(self.texts)
+            else:
+                grams = {key[j:j + self.GRAM_SIZE] for j in range(len(key) - self.GRAM_SIZE + 1)}
+                postings = sorted((self.by_gram.get(gram, set()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            for text in candidates:
+                if key in text:
+                    matches.update(i for i in self.by_text[text] if i < limit)
+        return matches
+
+# --- توحيد الأسماء العربية وأرقام الهواتف ---
+# التشكيل والتطويل تُحذف، وأشكال الألف والهمزة والتاء المربوطة والألف المقصورة تُوحَّد
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTER_VARIANTS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه'})
+# الأرقام العربية الهندية والفارسية
+DIGIT_VARIANTS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '0123456789' * 2)
+NON_WORD = re.compile(r'[\W_]+')
+ARABIC_LETTERS = re.compile('[\u0621-\u064a]')
+# هيكل الحروف الساكنة بالحروف اللاتينية، حتى يطابق "Mohamed" و"Muhammad" كلمة "محمد": الحركات القصيرة تُحذف،
+# والواو والياء تبقى (ou/oo = و، ee/ie = ي) حتى لا يتطابق "محمد" و"محمود"
+ARABIC_TO_LATIN = str.maketrans({'ا': '', 'ء': '', 'ع': '', 'ب': 'b', 'ت': 't', 'ث': 's', 'ج': 'g', 'ح': 'h', 'خ': 'k', 'د': 'd',
+                                 'ذ': 'z', 'ر': 'r', 'ز': 'z', 'س': 's', 'ش': 's', 'ص': 's', 'ض': 'd', 'ط': 't', 'ظ': 'z', 'غ': 'g',
+                                 'ف': 'f', 'ق': 'k', 'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w', 'ي': 'y'})
+LATIN_DIGRAPHS = (('kh', 'k'), ('sh', 's'), ('th', 's'), ('dh', 'z'), ('gh', 'g'), ('ph', 'f'), ('ou', 'w'), ('oo', 'w'), ('ee', 'y'), ('ie', 'y'))
+LATIN_TO_SKELETON = str.maketrans({'a': '', 'e': '', 'i': '', 'o': '', 'u': '', 'q': 'k', 'c': 'k', 'j': 'g', 'x': 'ks', 'v': 'f', 'p': 'b'})
+REPEATED_LETTERS = re.compile(r'(.)\1+')
+
+def normalize_name(text):
+    """الاسم بحروف صغيرة بعد توحيد الحروف العربية والأرقام وحذف التشكيل والرموز"""
+    text = ARABIC_DIACRITICS.sub('', str(text or '').translate(DIGIT_VARIANTS).translate(ARABIC_LETTER_VARIANTS))
+    return NON_WORD.sub(' ', text.lower()).strip()
+
+def name_skeleton(token):
+    """هيكل الحروف الساكنة اللاتينية لكلمة موحدة (عربية أو لاتينية)، أو نص فارغ للأرقام"""
+    if token.isdigit(): return ''
+    if ARABIC_LETTERS.search(token):
+        token = token.translate(ARABIC_TO_LATIN)
+    else:
+        for digraph, letter in LATIN_DIGRAPHS:
+            token = token.replace(digraph, letter)
+        token = token.translate(LATIN_TO_SKELETON)
+    # الحروف المشددة، والتاء المربوطة/الهاء في آخر الاسم (ساره = Sara)
+    token = REPEATED_LETTERS.sub(r'\1', token)
+    return token[:-1] if token.endswith('h') and len(token) > 2 else token
+
+def normalize_phone(text):
+    """رقم الهاتف بالصيغة المحلية (01xxxxxxxxx): أرقام فقط، بدون +20 أو 0020، مع إعادة الصفر الأول إذا حُذف"""
+    text = str(text or '').strip().translate(DIGIT_VARIANTS)
+    if text.endswith('.0'): text = text[:-2]
+    digits = ''.join(ch for ch in text if ch.isdigit())
+    if text.startswith('+20') or digits.startswith('0020'):
+        digits = '0' + digits[4 if digits.startswith('0020') else 2:]
+    elif len(digits) == 12 and digits.startswith('201'):
+        digits = '0' + digits[2:]
+    elif len(digits) == 10 and digits.startswith('1'):
+        digits = '0' + digits
+    return digits
+
+class CustomerNameIndex:
+    """فهرس أسماء العملاء (القيم الفريدة لعمود الاسم، بأكوادها المصنفة): الكلمات، الـ trigrams والهيكل اللاتيني
+    للاسم الموحد. الأكواد تزيد فقط مع البيانات الجديدة، فيُكمَل الفهرس للأسماء الجديدة فقط"""
+    GRAM_SIZE = 3
+    # درجات المطابقة: الاسم نفسه، كل كلمات البحث كلمات كاملة في الاسم، جزء من الاسم، نفس النطق بحروف أخرى
+    EXACT, TOKENS, SUBSTRING, SKELETON = 4, 3, 2, 1
+
+    def __init__(self):
+        self.names = []
+        self.by_token, self.by_gram, self.by_skeleton = {}, {}, {}
+        self._lock = threading.Lock()
+
+    def update(self, categories):
+        with self._lock:
+            for code in range(len(self.names), len(categories)):
+                name = normalize_name(categories[code])
+                self.names.append(name)
+                if not name: continue
+                for token in name.split():
+                    self.by_token.setdefault(token, set()).add(code)
+                    skeleton = name_skeleton(token)
+                    if len(skeleton) >= 2:
+                        self.by_skeleton.setdefault(skeleton, set()).add(code)
+                for j in range(len(name) - self.GRAM_SIZE + 1):
+                    self.by_gram.setdefault(name[j:j + self.GRAM_SIZE], set()).add(code)
+
+    def _substring_candidates(self, query):
+        if len(query) < self.GRAM_SIZE:
+            # استعلام أقصر من الـ trigram: فحص كل الأسماء الفريدة
+            return {code for code, name in enumerate(self.names) if query in name}
+        grams = {query[j:j + self.GRAM_SIZE] for j in range(len(query) - self.GRAM_SIZE + 1)}
+        postings = sorted((self.by_gram.get(gram, set()) for gram in grams), key=len)
+        return {code for code in set(postings[0]).intersection(*postings[1:]) if query in self.names[code]}
+
+    def ranked(self, query, limit):
+        """[(الكود، الدرجة)] للأسماء المطابقة بين أول limit كود، الأقوى أولاً"""
+        query = normalize_name(query)
+        if not query: return []
+        tokens = query.split()
+        skeletons = [name_skeleton(token) for token in tokens]
+        candidates = self._substring_candidates(query)
+        if all(len(skeleton) >= 2 for skeleton in skeletons):
+            postings = sorted((self.by_skeleton.get(skeleton, set()) for skeleton in skeletons), key=len)
+            candidates |= set(postings[0]).intersection(*postings[1:])
+
+        arabic_query = bool(ARABIC_LETTERS.search(query))
+        results = []
+        for code in candidates:
+            if code >= limit: continue
+            name = self.names[code]
+            if name == query:
+                score = self.EXACT
+            elif all(code in self.by_token.get(token, ()) for token in tokens):
+                score = self.TOKENS
+            elif query in name:
+                score = self.SUBSTRING
+            elif arabic_query and ARABIC_LETTERS.search(name):
+                # بين اسمين عربيين يكفي التوحيد؛ الهيكل اللاتيني للتهجئات اللاتينية فقط
+                continue
+            else:
+                score = self.SKELETON
+            results.append((code, score))
+        return sorted(results, key=lambda result: (-result[1], result[0]))
+
+def _day_number(value):
+    """رقم اليوم منذ 1970-01-01 لتاريخ أو datetime64"""
+    return int(np.datetime64(value, 'D').astype(np.int64))
+
+def _group_sum(keys, weights):
+    """مجموع weights لكل مفتاح فريد في keys"""
+    unique, sums = _group_sum_arrays(keys, weights)
+    return unique.tolist(), sums.tolist()
+
+def _group_sum_arrays(keys, weights):
+    # bincount يجمع بترتيب الصفوف، فمجموع كل مفتاح لا يتغير إذا جُمعت صفوفه في دفعة أصغر بنفس الترتيب
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, np.bincount(inverse, weights=weights, minlength=len(unique))
+
+def _group_last(keys, seconds, rows):
+    """لكل مفتاح فريد (بترتيب np.unique) التاريخ ورقم آخر صف له: الأحدث تاريخاً ثم الأكبر رقماً"""
+    order = np.lexsort((rows, seconds, keys))
+    sorted_keys = keys[order]
+    last = order[np.flatnonzero(np.r_[sorted_keys[1:] != sorted_keys[:-1], True])]
+    return seconds[last], rows[last]
+
+class _DayBucket:
+    __slots__ = ('revenue', 'by_payment', 'by_cashier', 'customers', 'cashiers', 'rows')
+
+    def __init__(self):
+        self.revenue = 0.0
+        self.by_payment, self.by_cashier = {}, {}
+        # main: رقم العميل / كود الكاشير -> (الإيرادات، عدد الفواتير، (تاريخ، رقم) آخر صف)
+        self.customers, self.cashiers = {}, {}
+        # أرقام صفوف اليوم لحساب الأيام الجزئية
+        self.rows = []
+
+    def copy(self):
+        bucket = _DayBucket()
+        bucket.revenue = self.revenue
+        bucket.by_payment, bucket.by_cashier = dict(self.by_payment), dict(self.by_cashier)
+        bucket.customers, bucket.cashiers = dict(self.customers), dict(self.cashiers)
+        bucket.rows = list(self.rows)
+        return bucket
+
+NO_ROW = (NAT_SECONDS, -1)
+
+def _merge_activity(totals, key, revenue=0.0, visits=0, last=NO_ROW):
+    previous = totals.get(key)
+    totals[key] = (previous[0] + revenue, previous[1] + visits, max(previous[2], last)) if previous else (revenue, visits, last)
+
+def _activity(keys, ds, rows, count_visits=True):
+    """{المفتاح: (الإيرادات، عدد الفواتير المختلفة، (تاريخ، رقم) آخر صف)} لصفوف rows مجمعة حسب keys"""
+    unique, revenue = _group_sum(keys, ds.amounts[rows])
+    last_seconds, last_rows = _group_last(keys, ds.dates[rows].astype(np.int64), rows)
+    if count_visits:
+        visits = np.unique(np.unique(np.stack([keys, ds.invoice_numbers[rows]], axis=1), axis=0)[:, 0], return_counts=True)[1].tolist()
+    else:
+        visits = [0] * len(unique)
+    return dict(zip(unique, zip(revenue, visits, zip(last_seconds.tolist(), last_rows.tolist()))))
+
+def _split_days(days, *columns):
+    """(اليوم، أجزاء الأعمدة) لكل يوم في أعمدة مرتبة حسب اليوم"""
+    starts = np.r_[0, np.flatnonzero(days[1:] != days[:-1]) + 1]
+    for start, stop in zip(starts.tolist(), np.r_[starts[1:], len(days)].tolist()):
+        yield int(days[start]), [column[start:stop].tolist() for column in columns]
+
+# --- التجميع المتوازي (map-reduce) ---
+# التجميع اليومي لدفعة صفوف يُحسب كنتائج جزئية (مصفوفات مرتبة حسب اليوم) من أعمدة محاذية للصفوف.
+# لأن كل مفاتيح التجميع تبدأ باليوم، فالصفوف تُقسم حسب الشهر وتُجمع كل مجموعة أشهر في عملية منفصلة،
+# ودمج النتائج بترتيب الأشهر يعطي نفس المصفوفات (ونفس المجاميع بالضبط) كالتجميع في عملية واحدة
+
+def _composite(days, codes):
+    width = int(codes.max()) + 1 if len(codes) else 1
+    return days * width + codes, width
+
+def _keyed_partials(days, codes, seconds, amounts, rows, pair_days=None, pair_codes=None):
+    """(الأيام، الأكواد، الإيرادات، عدد الفواتير، تاريخ آخر صف، آخر صف) لكل (يوم، كود)"""
+    keys, width = _composite(days, codes)
+    unique, revenue = _group_sum_arrays(keys, amounts)
+    last_seconds, last_rows = _group_last(keys, seconds, rows)
+    visits = np.zeros(len(unique), dtype=np.int64)
+    if pair_days is not None and len(pair_days):
+        pair_keys, pair_counts = np.unique(pair_days * width + pair_codes, return_counts=True)
+        visits[np.searchsorted(unique, pair_keys)] = pair_counts
+    return unique // width, unique % width, revenue, visits, last_seconds, last_rows
+
+def _main_partials(columns, rows):
+    """النتائج الجزئية لصفوف شيت الفواتير الصالحة rows، والأعمدة محاذية لها"""
+    days, seconds, amounts = columns['days'], columns['seconds'], columns['amounts']
+    customers, cashiers = columns['customers'], columns['cashiers']
+
+    # الفواتير المختلفة في كل يوم (أول صف لكل فاتورة/يوم يحدد العميل والكاشير)، مرتبة حسب (الفاتورة، اليوم)
+    pairs, first_positions = np.unique(np.stack([columns['invoices'], days], axis=1), axis=0, return_index=True)
+    pair_days, pair_customers, pair_cashiers = pairs[:, 1], customers[first_positions], cashiers[first_positions]
+
+    unique_days, revenue = _group_sum_arrays(days, amounts)
+    known = customers >= 0
+    with_customer = pair_customers >= 0
+    order = np.argsort(days, kind='stable')
+    return {
+        'day': (unique_days, revenue),
+        'rows': (days[order], rows[order]),
+        'by_payment': _keyed_partials(days, columns['payments'], seconds, amounts, rows)[:3],
+        'by_cashier': _keyed_partials(days, cashiers, seconds, amounts, rows)[:3],
+        'customers': _keyed_partials(days[known], customers[known], seconds[known], amounts[known], rows[known],
+                                     pair_days[with_customer], pair_customers[with_customer]),
+        'cashiers': _keyed_partials(days, cashiers, seconds, amounts, rows, pair_days, pair_cashiers),
+        'pairs': (pairs[:, 0], pair_days, pair_customers, pair_cashiers),
+    }
+
+PARTIAL_FUNCTIONS = {'main': _main_partials}
+
+def _concat_partials(results):
+    """دمج النتائج الجزئية لمجموعات أشهر متتالية (بالترتيب)"""
+    merged = {name: tuple(np.concatenate(parts) for parts in zip(*(result[name] for result in results))) for name in results[0]}
+    if 'pairs' in merged:
+        # التجميع في عملية واحدة يرتب الفواتير حسب (الفاتورة، اليوم)
+        invoices, days = merged['pairs'][:2]
+        order = np.lexsort((days, invoices))
+        merged['pairs'] = tuple(column[order] for column in merged['pairs'])
+    return merged
+
+def _partials_task(kind, specs, start, stop):
+    """تعمل في عملية من الـ pool: النتائج الجزئية للمواضع order[start:stop] من الأعمدة في shared memory"""
+    blocks = {name: shared_memory.SharedMemory(name=spec[0]) for name, spec in specs.items()}
+    try:
+        arrays = {name: np.ndarray(spec[1], dtype=spec[2], buffer=blocks[name].buf) for name, spec in specs.items()}
+        positions = arrays.pop('order')[start:stop]
+        rows = arrays.pop('rows')[positions]
+        # الفهرسة تنسخ البيانات، فلا يبقى مرجع للذاكرة المشتركة قبل إغلاقها
+        columns = {name: array[positions] for name, array in arrays.items()}
+        del arrays
+        return PARTIAL_FUNCTIONS[kind](columns, rows)
+    finally:
+        for block in blocks.values():
+            block.close()
+
+class AnalyticsEngine:
+    """تجميع دفعات الصفوف للتجميعات اليومية: الدفعات الكبيرة (التحميل الكامل لسنوات من البيانات) تُقسم حسب الشهر
+    وتُجمع في process pool من أعمدة في shared memory ثم تُدمج؛ الدفعات الصغيرة (التحديثات التدريجية) أو عند الفشل
+    تُجمع في العملية الحالية. الـ pool واحد للعملية، يُنشأ عند أول تجميع متوازي ويبقى للتجميعات التالية"""
+
+    def __init__(self, workers, min_rows, start_method=None):
+        self.workers, self.min_rows = workers, min_rows
+        self.start_method = start_method
+        self.stats = {'serial': 0, 'parallel': 0, 'fallbacks': 0}
+        self._pool, self._pool_lock = None, threading.Lock()
+
+    def partials(self, kind, columns, rows):
+        if self.workers > 1 and len(rows) >= self.min_rows:
+            try:
+                result = self._parallel(kind, columns, rows)
+                self.stats['parallel'] += 1
+                return result
+            except Exception as e:
+                self.stats['fallbacks'] += 1
+                app.logger.warning(f"فشل التجميع المتوازي لـ {kind}، يتم التجميع في العملية الحالية: {e}")
+                if isinstance(e, BrokenExecutor):
+                    self.shutdown()
+        self.stats['serial'] += 1
+        return PARTIAL_FUNCTIONS[kind](columns, rows)
+
+    def status(self):
+        return {**self.stats, 'workers': self.workers, 'min_rows': self.min_rows, 'start_method': self.start_method,
+                'pool': self._pool is not None}
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method))
+            return self._pool
+
+    def shutdown(self):
+        """إيقاف الـ pool (بعد عطل فيه)؛ التجميع المتوازي التالي ينشئ pool جديداً"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _tasks(self, months):
+        """(order، [(بداية، نهاية)]): الصفوف مرتبة حسب الشهر (مع الحفاظ على ترتيبها داخل الشهر)،
+        ومجموعات أشهر متتالية بعدد صفوف متقارب، ضعف عدد العمليات لتوزيع أفضل"""
+        order = np.argsort(months, kind='stable')
+        boundaries = np.r_[0, np.flatnonzero(np.diff(months[order])) + 1, len(order)]
+        target = len(order) / (self.workers * 2)
+        tasks, start = [], 0
+        for boundary in boundaries[1:].tolist():
+            if boundary - start >= target or boundary == len(order):
+                tasks.append((start, boundary))
+                start = boundary
+        return order, tasks
+
+    def _parallel(self, kind, columns, rows):
+        months = columns['days'].astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        order, tasks = self._tasks(months)
+        if len(tasks) < 2:
+            return PARTIAL_FUNCTIONS[kind](columns, rows)
+
+        blocks, specs = [], {}
+        try:
+            for name, array in list(columns.items()) + [('rows', rows), ('order', order)]:
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+            pool = self._executor()
+            futures = [pool.submit(_partials_task, kind, specs, start, stop) for start, stop in tasks]
+            return _concat_partials([future.result() for future in futures])
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+# عدد العمليات للتجميع المتوازي (1 = بدون process pool، الافتراضي لأن كل عملية تحمّل التطبيق كاملاً في الذاكرة)،
+# وأقل عدد صفوف في الدفعة لاستخدامه
+ANALYTICS_WORKERS = int(os.environ.get('ANALYTICS_WORKERS', '1'))
+ANALYTICS_PARALLEL_MIN_ROWS = int(os.environ.get('ANALYTICS_PARALLEL_MIN_ROWS', '500000'))
+# التجميع يبدأ من thread التحديث في عامل gunicorn متعدد الـ threads، وfork من عملية فيها threads قد ينسخ قفلاً
+# يمسكه thread آخر (الـ logging، metrics، أقفال التحديث) فتتوقف العملية الجديدة عليه؛ لذلك forkserver أو spawn
+ANALYTICS_START_METHOD = os.environ.get('ANALYTICS_START_METHOD', 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+analytics_engine = AnalyticsEngine(ANALYTICS_WORKERS, ANALYTICS_PARALLEL_MIN_ROWS, ANALYTICS_START_METHOD)
+
+class DailyRollup:
+    """تجميعات يومية محسوبة مسبقاً للوحة التحكم من شيت الفواتير: الإيرادات والإيرادات لكل طريقة دفع وكاشير ونشاط
+    العملاء والكاشير (تحليل شيت المبيعات في SalesIndex). النسخة لا تتغير؛ extended() ينسخ الأيام التي تغيرت فقط ويضيف الصفوف الجديدة"""
+
+    def __init__(self):
+        self.size = 0
+        self.days = {}                  # رقم اليوم -> _DayBucket
+        self.day_keys = []              # أرقام الأيام مرتبة
+        self.invoice_days = {}          # رقم الفاتورة -> أول يوم ظهرت فيه
+        self.multi_day_invoices = {}    # الفواتير التي ظهرت في أكثر من يوم -> frozenset الأيام
+        # العملاء يُعرَّفون برقم الهاتف الموحد: الهاتف -> رقم العميل
+        self.customer_ids = {}
+        self.customer_totals, self.cashier_totals = {}, {}  # لكل البيانات، بنفس شكل _DayBucket.customers
+        self._touched = set()
+
+    def extended(self, ds):
+        """نسخة تشمل صفوف ds من self.size إلى آخرها"""
+        rollup = DailyRollup()
+        rollup.days, rollup.day_keys = dict(self.days), list(self.day_keys)
+        rollup.invoice_days, rollup.multi_day_invoices = dict(self.invoice_days), dict(self.multi_day_invoices)
+        rollup.customer_ids = dict(self.customer_ids)
+        rollup.customer_totals, rollup.cashier_totals = dict(self.customer_totals), dict(self.cashier_totals)
+        rollup._add_main_rows(ds, self.size)
+        rollup.size = len(ds)
+        rollup._touched = set()
+        return rollup
+
+    def _bucket(self, day):
+        """اليوم للتعديل: يُنسخ أول مرة حتى لا تتغير النسخة السابقة"""
+        if day not in self._touched:
+            bucket = self.days.get(day)
+            if bucket is None:
+                bisect.insort(self.day_keys, day)
+            self.days[day] = bucket.copy() if bucket is not None else _DayBucket()
+            self._touched.add(day)
+        return self.days[day]
+
+    def _add_main_rows(self, ds, start):
+        valid = (ds.row_lengths[start:] > MAIN_COLUMNS['amount']) & ~np.isnan(ds.amounts[start:]) & ds.invoice_ok[start:] & ~np.isnat(ds.dates[start:])
+        rows = start + np.flatnonzero(valid)
+        if not len(rows): return
+        customers = self._customer_ids(ds, rows)
+        cashiers = ds.cashier_codes[rows].astype(np.int64)
+        columns = {'days': ds.dates[rows].astype('datetime64[D]').astype(np.int64), 'seconds': ds.dates[rows].astype(np.int64),
+                   'invoices': ds.invoice_numbers[rows], 'amounts': ds.amounts[rows],
+                   'payments': ds.payment_codes[rows].astype(np.int64), 'cashiers': cashiers, 'customers': customers}
+        partials = analytics_engine.partials('main', columns, rows)
+
+        self._add_day_rows(*partials['rows'])
+        for day, day_revenue in zip(*(column.tolist() for column in partials['day'])):
+            self._bucket(day).revenue += day_revenue
+        for attribute in ('by_payment', 'by_cashier'):
+            for day, (codes, revenue) in _split_days(*partials[attribute]):
+                breakdown = getattr(self._bucket(day), attribute)
+                if not breakdown:
+                    breakdown.update(zip(codes, revenue))
+                    continue
+                for code, code_revenue in zip(codes, revenue):
+                    breakdown[code] = breakdown.get(code, 0.0) + code_revenue
+        # إيرادات وعدد فواتير وآخر شراء لكل عميل (له رقم هاتف) ولكل كاشير في كل يوم
+        for attribute in ('customers', 'cashiers'):
+            for day, (keys, revenue, visits, last_seconds, last_rows) in _split_days(*partials[attribute]):
+                activity = getattr(self._bucket(day), attribute)
+                entries = zip(keys, zip(revenue, visits, zip(last_seconds, last_rows)))
+                if not activity:
+                    activity.update(entries)
+                    continue
+                for key, (key_revenue, key_visits, last) in entries:
+                    _merge_activity(activity, key, key_revenue, key_visits, last)
+        for totals, ids, mask in ((self.customer_totals, customers, customers >= 0), (self.cashier_totals, cashiers, slice(None))):
+            if not len(ids[mask]): continue
+            for key, (revenue, _, last) in _activity(ids[mask], ds, rows[mask], count_visits=False).items():
+                _merge_activity(totals, key, revenue, last=last)
+        self._count_invoices(*partials['pairs'])
+
+    def _count_invoices(self, invoices, days, customers, cashiers):
+        """النتائج الجزئية تحسب زيارة لكل (فاتورة، يوم) في الدفعة؛ هنا تُسجل الأيام الأولى للفواتير الجديدة وزياراتها،
+        ويُطرح ما حُسب في دفعة سابقة. الفاتورة التي تظهر في أكثر من يوم تُسجل أيامها لتُحسب مرة واحدة في أي فترة
+        (عدد فواتير الفترة في لوحة التحكم من InvoiceTable)"""
+        known = np.fromiter((invoice in self.invoice_days for invoice in invoices.tolist()), dtype=bool, count=len(invoices))
+        # فواتير جديدة: اليوم الأول (الأزواج مرتبة حسب الفاتورة ثم اليوم) وزيارة واحدة للعميل والكاشير في أول يوم
+        new_invoices, new_days = invoices[~known], days[~known]
+        first = np.r_[True, new_invoices[1:] != new_invoices[:-1]] if len(new_invoices) else np.zeros(0, dtype=bool)
+        self.invoice_days.update(zip(new_invoices[first].tolist(), new_days[first].tolist()))
+        repeated = ~first | np.r_[~first[1:], False]
+        for invoice, group in itertools.groupby(zip(new_invoices[repeated].tolist(), new_days[repeated].tolist()), key=lambda pair: pair[0]):
+            self.multi_day_invoices[invoice] = frozenset(day for _, day in group)
+        for totals, ids in ((self.customer_totals, customers[~known][first]), (self.cashier_totals, cashiers[~known][first])):
+            ids = ids[ids >= 0]
+            for key, count in zip(*(column.tolist() for column in np.unique(ids, return_counts=True))):
+                _merge_activity(totals, key, visits=count)
+
+        # فواتير ظهرت في دفعة سابقة
+        for invoice, day, customer, cashier in zip(*(column[known].tolist() for column in (invoices, days, customers, cashiers))):
+            seen = self.multi_day_invoices.get(invoice, frozenset((self.invoice_days[invoice],)))
+            if day not in seen:
+                self.multi_day_invoices[invoice] = seen | {day}
+                continue
+            bucket = self._bucket(day)
+            if customer >= 0: _merge_activity(bucket.customers, customer, visits=-1)
+            _merge_activity(bucket.cashiers, cashier, visits=-1)
+
+    def _customer_ids(self, ds, rows, register=True):
+        """رقم العميل لكل صف من رقم الهاتف الموحد، أو -1 إذا لم يُسجل هاتف (أو لم يُعرف بعد مع register=False)"""
+        ids, cache = np.empty(len(rows), dtype=np.int64), {}
+        for position, i in enumerate(rows.tolist()):
+            text = ds.phone_texts[i]
+            customer = cache.get(text)
+            if customer is None:
+                phone = normalize_phone(text)
+                if not phone:
+                    customer = -1
+                elif register:
+                    customer = self.customer_ids.setdefault(phone, len(self.customer_ids))
+                else:
+                    customer = self.customer_ids.get(phone, -1)
+                cache[text] = customer
+            ids[position] = customer
+        return ids
+
+    def _add_day_rows(self, days, rows):
+        """أرقام صفوف كل يوم بترتيبها (الأعمدة مرتبة حسب اليوم)، لحساب يوم الحد الجزئي في الفترات المتحركة"""
+        for day, (day_rows,) in _split_days(days, rows):
+            self._bucket(day).rows.extend(day_rows)
+
+    def period_totals(self, first_day, last_day):
+        """الإيرادات والإيرادات لكل طريقة دفع وكاشير بين يومين (شاملين)"""
+        first, last = _day_number(first_day), _day_number(last_day)
+        totals = {'revenue': 0.0, 'by_payment': {}, 'by_cashier': {}}
+        for day in self.day_keys[bisect.bisect_left(self.day_keys, first):bisect.bisect_right(self.day_keys, last)]:
+            bucket = self.days[day]
+            totals['revenue'] += bucket.revenue
+            for name in ('by_payment', 'by_cashier'):
+                for code, revenue in getattr(bucket, name).items():
+                    totals[name][code] = totals[name].get(code, 0.0) + revenue
+        return totals
+
+    def activity(self, ds, cutoff=None):
+        """(العملاء، الكاشير): {المفتاح: (الإيرادات، عدد الفواتير، (تاريخ، رقم) آخر صف)} للصفوف التي تاريخها cutoff أو بعده،
+        أو لكل البيانات. الفاتورة الممتدة على يومين داخل الفترة تُحسب في كل يوم منهما"""
+        if cutoff is None: return self.customer_totals, self.cashier_totals
+        cutoff64 = np.datetime64(cutoff, 'us')
+        cutoff_day = _day_number(cutoff64)
+        customers, cashiers = {}, {}
+        # يوم الحد جزئي: تُجمع صفوفه بعد الحد مباشرة، وما بعده أيام كاملة
+        bucket = self.days.get(cutoff_day)
+        if bucket is not None:
+            rows = np.array(bucket.rows, dtype=np.int64)
+            rows = rows[ds.dates[rows] >= cutoff64]
+            ids = self._customer_ids(ds, rows, register=False)
+            for totals, keys, selected in ((customers, ids, ids >= 0), (cashiers, ds.cashier_codes[rows].astype(np.int64), slice(None))):
+                if len(rows[selected]):
+                    totals.update(_activity(keys[selected], ds, rows[selected]))
+        for day in self.day_keys[bisect.bisect_right(self.day_keys, cutoff_day):]:
+            bucket = self.days[day]
+            for totals, day_totals in ((customers, bucket.customers), (cashiers, bucket.cashiers)):
+                for key, (revenue, visits, last) in day_totals.items():
+                    _merge_activity(totals, key, revenue, visits, last)
+        return customers, cashiers
+
+def _merge_sorted(keys, rows, new_keys, new_rows):
+    """دمج صفوف جديدة (أرقامها أكبر من الموجودة) في فهرس مرتب حسب المفتاح"""
+    order = np.argsort(new_keys, kind='stable')
+    new_keys, new_rows = new_keys[order], new_rows[order]
+    positions = np.searchsorted(keys, new_keys, side='right')
+    return np.insert(keys, positions, new_keys), np.insert(rows, positions, new_rows)
+
+class QueryIndex:
+    """فهارس البحث المتقدم على الصفوف الصالحة فقط: الصفوف مرتبة حسب اليوم، وقائمة صفوف لكل قيمة
+    من طريقة الدفع والكاشير والعميل (شرط المبلغ على مجموع الفاتورة من InvoiceTable). النسخة لا تتغير؛ extended() يدمج الصفوف الجديدة"""
+    CATEGORY_COLUMNS = ('payment', 'cashier', 'customer')
+
+    def __init__(self):
+        self.size = 0
+        self.processed_count = 0
+        self.rows = np.empty(0, dtype=np.int64)
+        self.date_days, self.date_rows = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        self.code_rows = {name: {} for name in self.CATEGORY_COLUMNS}
+
+    def extended(self, ds):
+        """نسخة تشمل صفوف ds من self.size إلى آخرها"""
+        start = self.size
+        index = QueryIndex()
+        index.size = len(ds)
+        index.processed_count = self.processed_count + int(np.count_nonzero(ds.row_lengths[start:] > MAIN_COLUMNS['customer_phone']))
 
-def get_gspread_client():
-    creds_json_string = os.environ.get('GSPREAD_CREDENTIALS_JSON')
-    if not creds_json_string: raise ValueError("Secret GSPREAD_CREDENTIALS_JSON is not set.")
-    return gspread.service_account_from_dict(json.loads(creds_json_string))
+        # الصفوف الصالحة: أعمدة كافية ومبلغ ورقم فاتورة صحيحان
+        valid = (ds.row_lengths[start:] > max(MAIN_COLUMNS['customer_phone'], MAIN_COLUMNS['cashier'])) & ~np.isnan(ds.amounts[start:]) & ds.invoice_ok[start:]
+        rows = start + np.flatnonzero(valid)
+        index.rows = np.concatenate([self.rows, rows])
 
-def save_data_locally(data, sheet_type='main'):
-    """حفظ البيانات محلياً"""
-    filename = f'local_data_{sheet_type}.pkl'
-    try:
-        with open(filename, 'wb') as f:
-            pickle.dump({
-                'data': data,
-                'timestamp': datetime.now(),
-                'sheet_type': sheet_type
-            }, f)
-        app.logger.info(f"تم حفظ بيانات {sheet_type} محلياً في {filename}")
-    except Exception as e:
-        app.logger.error(f"فشل في حفظ البيانات محلياً: {str(e)}")
+        dated = rows[~np.isnat(ds.dates[rows])]
+        index.date_days, index.date_rows = _merge_sorted(self.date_days, self.date_rows, ds.dates[dated].astype('datetime64[D]').astype(np.int64), dated)
 
-def load_data_locally(sheet_type='main'):
-    """تحميل البيانات المحفوظة محلياً"""
-    filename = f'local_data_{sheet_type}.pkl'
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'rb') as f:
-                saved_data = pickle.load(f)
-                app.logger.info(f"تم تحميل بيانات {sheet_type} من الملف المحلي (آخر تحديث: {saved_data['timestamp']})")
-                return saved_data['data']
-    except Exception as e:
-        app.logger.error(f"فشل في تحميل البيانات المحلية: {str(e)}")
-    return None
+        for name in self.CATEGORY_COLUMNS:
+            code_rows = index.code_rows[name] = dict(self.code_rows[name])
+            codes = getattr(ds, f'{name}_codes')[rows]
+            order = np.argsort(codes, kind='stable')
+            unique_codes, counts = np.unique(codes[order], return_counts=True)
+            for code, new_rows in zip(unique_codes.tolist(), np.split(rows[order], np.cumsum(counts)[:-1])):
+                code_rows[code] = np.concatenate([code_rows[code], new_rows]) if code in code_rows else new_rows
+        return index
 
-@cached(sheet_cache)
-def get_sheet_data(sheet_type='main', offline_mode=False):
-    # إذا كان الوضع المطلوب هو العمل بدون إنترنت، حمّل البيانات المحلية مباشرة
-    if offline_mode:
-        app.logger.info(f"الوضع بدون إنترنت مفعل - تحميل البيانات المحلية لـ {sheet_type}")
-        local_data = load_data_locally(sheet_type)
-        if local_data:
-            return local_data
-        else:
-            app.logger.warning(f"لا توجد بيانات محلية متاحة لـ {sheet_type}")
-            return [] if sheet_type == 'main' else None
-    
-    # محاولة تحميل البيانات من Google Sheets أولاً
-    try:
-        # التحقق من وجود ملف الإعدادات
-        if not os.path.exists('config.ini'):
-            app.logger.error("config.ini file not found")
-            # محاولة تحميل البيانات المحلية كبديل
-            local_data = load_data_locally(sheet_type)
-            if local_data:
-                app.logger.info("استخدام البيانات المحلية بدلاً من Google Sheets")
-                return local_data
-            return [] if sheet_type == 'main' else None
-            
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        url_key = 'sheet_url' if sheet_type == 'main' else 'sales_sheet_url'
-        
-        # التحقق من وجود URL في الإعدادات
-        if not config.has_section('GSPREAD') or not config.has_option('GSPREAD', url_key):
-            app.logger.error(f"Missing {url_key} in config.ini")
-            # محاولة تحميل البيانات المحلية كبديل
-            local_data = load_data_locally(sheet_type)
-            if local_data:
-                app.logger.info("استخدام البيانات المحلية بدلاً من Google Sheets")
-                return local_data
-            return [] if sheet_type == 'main' else None
-            
-        sheet_url = config.get('GSPREAD', url_key)
-        app.logger.info(f"Attempting to access {sheet_type} sheet: {sheet_url}")
-        
-        gc = get_gspread_client()
-        spreadsheet = gc.open_by_url(sheet_url)
-        worksheet_name = "الورقة1" if sheet_type == 'main' else "Data Sheet 1"
-        
-        try:
-            worksheet = spreadsheet.worksheet(worksheet_name)
-        except gspread.WorksheetNotFound:
-            # محاولة استخدام أول ورقة عمل إذا لم يتم العثور على الاسم المحدد
-            app.logger.warning(f"Worksheet '{worksheet_name}' not found, using first worksheet")
-            worksheet = spreadsheet.get_worksheet(0)
-            
-        data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
-        app.logger.info(f"Successfully retrieved {len(data)} rows from {sheet_type} sheet")
-        
-        # البيانات بدون العنوان (الصف الأول)
-        processed_data = data[1:] if len(data) > 1 else []
-        
-        # حفظ البيانات محلياً للاستخدام المستقبلي
-        save_data_locally(processed_data, sheet_type)
-        
-        return processed_data
-        
-    except gspread.SpreadsheetNotFound:
-        app.logger.error(f"Spreadsheet not found for {sheet_type}")
-        # محاولة تحميل البيانات المحلية كبديل
-        local_data = load_data_locally(sheet_type)
-        if local_data:
-            app.logger.info("استخدام البيانات المحلية بدلاً من Google Sheets")
-            return local_data
-        return [] if sheet_type == 'main' else None
-    except json.JSONDecodeError:
-        app.logger.error("Invalid JSON in GSPREAD_CREDENTIALS_JSON")
-        # محاولة تحميل البيانات المحلية كبديل
-        local_data = load_data_locally(sheet_type)
-        if local_data:
-            app.logger.info("استخدام البيانات المحلية بدلاً من Google Sheets")
-            return local_data
-        return [] if sheet_type == 'main' else None
-    except Exception as e:
-        app.logger.error(f"Failed to get {sheet_type} sheet data: {str(e)}")
-        # محاولة تحميل البيانات المحلية كبديل
-        local_data = load_data_locally(sheet_type)
-        if local_data:
-            app.logger.info("استخدام البيانات المحلية بدلاً من Google Sheets")
-            return local_data
-        return [] if sheet_type == 'main' else None
+    def date_range(self, date_from, date_to):
+        """حدود الصفوف المؤرخة بين يومين (شاملين) في date_rows"""
+        lo = np.searchsorted(self.date_days, _day_number(date_from), side='left') if date_from is not None else 0
+        hi = np.searchsorted(self.date_days, _day_number(date_to), side='right') if date_to is not None else len(self.date_days)
+        return lo, max(hi, lo)
 
-# --- دالة مخصصة وآمنة لمعالجة التاريخ ---
-def parse_date_safely(date_str):
-    if not date_str: return None
-    
-    # تحويل إلى نص أولاً
-    date_str = str(date_str).strip()
-    if not date_str: return None
-    
-    try:
-        # إزالة المنطقة الزمنية إذا وجدت
-        if '+' in date_str:
-            date_str = date_str.split('+')[0].strip()
-        
-        # محاولة معالجة تنسيق Google Sheets المحدد: "15-JUN-25 05.10.52 PM"
-        import re
-        google_sheets_pattern = r'(\d{1,2}-[A-Z]{3}-\d{2})\s+(\d{1,2})\.(\d{2})\.(\d{2})\s+(AM|PM)'
-        match = re.match(google_sheets_pattern, date_str)
-        
-        if match:
-            date_part = match.group(1)  # "15-JUN-25"
-            hour = int(match.group(2))  # "05"
-            minute = int(match.group(3))  # "10"
-            second = int(match.group(4))  # "52"
-            ampm = match.group(5)  # "PM"
-            
-            # تحويل إلى تنسيق 24 ساعة
-            if ampm == 'PM' and hour != 12:
-                hour += 12
-            elif ampm == 'AM' and hour == 12:
-                hour = 0
-                
-            # إنشاء تنسيق ISO للتاريخ والوقت
-            iso_format = f"{date_part} {hour:02d}:{minute:02d}:{second:02d}"
-            
-            # استخدام dateutil لمعالجة التاريخ
-            from dateutil.parser import parse
-            return parse(iso_format, fuzzy=True)
-        
-        # إذا لم يطابق النمط، محاولة المعالجة العادية
-        from dateutil.parser import parse
-        return parse(date_str, fuzzy=True)
-        
-    except (ParserError, ValueError, TypeError, ImportError) as e:
-        # إذا فشلت كل المحاولات، لا نسجل تحذير لكل سجل لتجنب الإزعاج
-        return None
+    def category_rows(self, name, codes):
+        """الصفوف التي قيمتها أحد الأكواد، مرتبة"""
+        code_rows = self.code_rows[name]
+        parts = [code_rows[code] for code in codes if code in code_rows]
+        if not parts: return np.empty(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+class InvoiceTable:
+    """جدول الفواتير: صف لكل رقم فاتورة صالح مرتب حسب الرقم، فيه أول سطر للفاتورة في الشيت (ومنه التاريخ وطريقة الدفع
+    والكاشير والعميل)، مجموع مبالغ سطورها وعدد السطور. يُستخدم في البحث ولوحة التحكم بدلاً من تجميع السطور في كل طلب.
+    النسخة لا تتغير؛ extended() يضيف الصفوف الجديدة (فواتير جديدة أو سطور جديدة لفواتير موجودة)"""
+
+    def __init__(self):
+        self.size = 0
+        self.numbers = np.empty(0, dtype=np.int64)
+        self.first_rows = np.empty(0, dtype=np.int64)
+        self.totals = np.empty(0, dtype=np.float64)
+        self.line_counts = np.empty(0, dtype=np.int64)
+        # يوم كل فاتورة (يوم أول سطر) مرتبة، لعدد فواتير فترة
+        self.sorted_days = np.empty(0, dtype=np.int64)
+
+    def __len__(self): return len(self.numbers)
+
+    def extended(self, ds):
+        """نسخة تشمل صفوف ds من self.size إلى آخرها"""
+        start = self.size
+        table = InvoiceTable()
+        table.size = len(ds)
+        rows = start + np.flatnonzero(ds.invoice_ok[start:])
+        amounts = ds.amounts[rows]
+        # السطر بمبلغ غير صالح يُحسب في سطور الفاتورة ولا يدخل في مجموعها
+        numbers, first_positions, inverse, counts = np.unique(ds.invoice_numbers[rows], return_index=True, return_inverse=True, return_counts=True)
+        sums = np.bincount(inverse, weights=np.where(np.isnan(amounts), 0.0, amounts), minlength=len(numbers))
+
+        positions = np.searchsorted(self.numbers, numbers)
+        known = positions < len(self.numbers)
+        known[known] = self.numbers[positions[known]] == numbers[known]
+        totals, line_counts = self.totals.copy(), self.line_counts.copy()
+        totals[positions[known]] += sums[known]
+        line_counts[positions[known]] += counts[known]
+
+        new, at = ~known, positions[~known]
+        first_rows = rows[first_positions[new]]
+        table.numbers = np.insert(self.numbers, at, numbers[new])
+        table.first_rows = np.insert(self.first_rows, at, first_rows)
+        table.totals = np.insert(totals, at, sums[new])
+        table.line_counts = np.insert(line_counts, at, counts[new])
+        days = np.sort(ds.dates[first_rows].astype('datetime64[D]').astype(np.int64))
+        table.sorted_days = np.insert(self.sorted_days, np.searchsorted(self.sorted_days, days, side='right'), days)
+        return table
+
+    def positions(self, numbers):
+        """موضع كل رقم فاتورة في الجدول (لأرقام موجودة فيه)"""
+        return np.searchsorted(self.numbers, numbers)
+
+    def count_between(self, first_day, last_day):
+        """عدد الفواتير التي يومها بين يومين (شاملين)؛ الفاتورة بدون تاريخ لا تُحسب"""
+        lo = np.searchsorted(self.sorted_days, _day_number(first_day), side='left')
+        hi = np.searchsorted(self.sorted_days, _day_number(last_day), side='right')
+        return int(max(hi - lo, 0))
+
+def _week_start(days):
+    """أول يوم (السبت) في أسبوع كل رقم يوم؛ 1970-01-01 كان خميساً"""
+    return days - (days + 5) % 7
+
+def _series(keys, columns):
+    """(المفاتيح الفريدة مرتبة، مجموع كل عمود لكل مفتاح)"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, [np.bincount(inverse, weights=column, minlength=len(unique)) for column in columns]
+
+class SalesIndex:
+    """تحليل شيت المبيعات: الصفوف الصالحة مرتبة حسب التاريخ، فكل فترة (من تاريخ حتى الآن) مدى متصل في نهايتها،
+    والتجميع لكل كود قطعة (الكمية، الإيرادات، عدد سطور المرتجعات، أول صف) ولكل يوم وأسبوع يتم بـ bincount على المدى.
+    النتائج تُحفظ لكل بداية مدى، فالفترة المتحركة لا يُعاد حسابها إلا عندما يخرج منها صف.
+    النسخة لا تتغير (الصفوف الجديدة تعني نسخة جديدة بذاكرة فارغة)؛ extended() يدمج الصفوف الجديدة"""
+    CACHE_SIZE = 32
+
+    def __init__(self):
+        self.size = 0
+        self.seconds, self.rows = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        self._results = LRUCache(maxsize=self.CACHE_SIZE)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def extended(self, ds):
+        """نسخة تشمل صفوف ds من self.size إلى آخرها"""
+        start = self.size
+        index = SalesIndex()
+        index.size = len(ds)
+        valid = (ds.row_lengths[start:] > SALES_COLUMNS['quantity']) & ~np.isnat(ds.dates[start:]) & ~np.isnan(ds.quantities[start:])
+        valid &= ds.category_mask(ds.item_codes[start:], ds.item_categories, bool)
+        rows = start + np.flatnonzero(valid)
+        index.seconds, index.rows = _merge_sorted(self.seconds, self.rows, ds.dates[rows].astype(np.int64), rows)
+        return index
+
+    def window_start(self, cutoff=None):
+        """أول موضع في الصفوف المرتبة تاريخه cutoff أو بعده (0 لكل البيانات)"""
+        if cutoff is None: return 0
+        cutoff_us = int(np.datetime64(cutoff, 'us').astype(np.int64))
+        return int(np.searchsorted(self.seconds, -(-cutoff_us // 1_000_000), side='left'))
+
+    def cached(self, key, build):
+        """نتيجة build() المحفوظة لـ key (key يبدأ ببداية المدى)"""
+        with self._lock:
+            result = self._results.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = build()
+        with self._lock:
+            self._results[key] = result
+        return result
+
+    def _columns(self, ds, lo):
+        rows = self.rows[lo:]
+        quantities = ds.quantities[rows]
+        # المبلغ غير الصالح لا يدخل في الإيرادات، والسطر يبقى في الكمية
+        return rows, quantities, np.nan_to_num(ds.amounts[rows]), (quantities < 0).astype(np.float64)
+
+    def items(self, ds, lo):
+        """(أكواد القطع، الكمية، الإيرادات، عدد سطور المرتجعات، أول صف) للقطع التي لها صفوف من الموضع lo"""
+        def build():
+            rows, quantities, amounts, returns = self._columns(ds, lo)
+            codes = ds.item_codes[rows]
+            size = len(ds.item_categories)
+            first_rows = np.full(size, len(ds), dtype=np.int64)
+            np.minimum.at(first_rows, codes, rows)
+            present = np.flatnonzero(first_rows < len(ds))
+            totals = [np.bincount(codes, weights=column, minlength=size)[present] for column in (quantities, amounts, returns)]
+            return present, totals[0], totals[1], totals[2].astype(np.int64), first_rows[present]
+        return self.cached(('items', lo), build)
+
+    def trends(self, ds, lo):
+        """{'daily'/'weekly': (أرقام الأيام، الكمية، الإيرادات، عدد سطور المرتجعات)} للصفوف من الموضع lo"""
+        def build():
+            _, quantities, amounts, returns = self._columns(ds, lo)
+            days = self.seconds[lo:] // 86400
+            result = {}
+            for name, keys in (('daily', days), ('weekly', _week_start(days))):
+                unique, totals = _series(keys, (quantities, amounts, returns))
+                result[name] = (unique, totals[0], totals[1], totals[2].astype(np.int64))
+            return result
+        return self.cached(('trends', lo), build)
+
+    def status(self):
+        return {'rows': len(self.rows), 'cached': len(self._results), 'hits': self.hits, 'misses': self.misses}
+
+def _as_dataset(data, sheet_type):
+    return data if isinstance(data, SheetDataset) else SheetDataset(data, sheet_type)
 
 # --- دوال تحليل ومعالجة البيانات ---
 
+@timed_stage('filter')
 def search_data_for_web(query, search_type, data):
     if not data: return []
-    INDEX_DATE, INDEX_INVOICE, INDEX_AMOUNT, INDEX_PAYMENT, INDEX_CASHIER, INDEX_CUST_NAME, INDEX_CUST_PHONE = 0, 1, 2, 3, 4, 5, 6
-    invoices, query_stripped = {}, str(query).strip()
-    search_col = INDEX_INVOICE if search_type == 'invoice' else INDEX_CUST_PHONE
+    ds = _as_dataset(data, 'main')
+    query_stripped = str(query).strip()
+    search_col = MAIN_COLUMNS['invoice'] if search_type == 'invoice' else MAIN_COLUMNS['customer_phone']
 
-    app.logger.info(f"البحث عن: '{query_stripped}' في العمود {search_col}")
-    app.logger.info(f"عدد الصفوف المتاحة: {len(data)}")
-    
-    matches_found = 0
-    for i, row in enumerate(data):
-        if len(row) <= max(INDEX_CUST_PHONE, search_col): 
+    verbose = row_logging_enabled()
+    if verbose:
+        app.logger.info(f"البحث عن: '{query_stripped}' في العمود {search_col}")
+        app.logger.info(f"عدد الصفوف المتاحة: {len(ds)}")
+
+    # مطابقة تامة من الفهرس، ثم البحث الجزئي لأرقام الهواتف (المطابقات التامة تظهر أولاً)
+    index = ds.search_index(search_type)
+    exact = index.exact(query_stripped, len(ds))
+    partial = index.partial(query_stripped, len(ds)) - exact if search_type == 'phone' else set()
+    matches = exact | partial
+
+    # أرقام الفواتير المطابقة بترتيب أول تطابق؛ بيانات كل فاتورة ومجموعها من جدول الفواتير
+    invoice_numbers = {}
+    for i in sorted(exact) + sorted(partial):
+        if verbose: app.logger.info(f"تطابق موجود في الصف {i}: {ds.rows[i]}")
+        if not ds.invoice_texts[i]:
+            if verbose: app.logger.warning(f"رقم الفاتورة فارغ في الصف {i}")
             continue
-            
-        if i < 3:  # عرض أول 3 صفوف للتشخيص
-            app.logger.info(f"الصف {i}: {row}")
-        
-        cell_value = row[search_col]
-        if not cell_value: continue
-        
-        # تنظيف وتحويل القيمة
-        cell_str = str(cell_value).strip()
-        
-        # مقارنة مباشرة
-        match_found = False
-        if cell_str == query_stripped:
-            match_found = True
-        elif cell_str.replace('.0', '') == query_stripped:  # إزالة .0 من الأرقام
-            match_found = True
+        if not ds.invoice_ok[i]:
+            if verbose: app.logger.error(f"خطأ في معالجة الصف {i}: رقم فاتورة غير صالح {ds.invoice_texts[i]}")
+            continue
+        invoice_numbers.setdefault(int(ds.invoice_numbers[i]))
+
+    table = ds.invoice_table()
+    results = []
+    for number, position in zip(invoice_numbers, table.positions(np.fromiter(invoice_numbers, dtype=np.int64, count=len(invoice_numbers))).tolist()):
+        i = int(table.first_rows[position])
+        dt_object = _to_datetime(ds.dates[i])
+        if not dt_object:
+            if verbose: app.logger.warning(f"استخدام تاريخ افتراضي للصف {i}")
+            date_display = "تاريخ غير محدد"
         else:
-            # محاولة تحويل إلى رقم للمقارنة
-            try:
-                if float(cell_str) == float(query_stripped):
-                    match_found = True
-            except (ValueError, TypeError):
-                # البحث الجزئي للنصوص (للأسماء والهواتف)
-                if search_type == 'phone' and query_stripped in cell_str:
-                    match_found = True
-                
-        if match_found:
-            matches_found += 1
-            app.logger.info(f"تطابق موجود في الصف {i}: {row}")
-            try:
-                # تأكد من وجود جميع البيانات المطلوبة
-                if len(row) <= INDEX_CUST_PHONE:
-                    app.logger.warning(f"الصف {i} لا يحتوي على بيانات كافية")
-                    continue
-                    
-                invoice_num_raw = row[INDEX_INVOICE]
-                if not invoice_num_raw:
-                    app.logger.warning(f"رقم الفاتورة فارغ في الصف {i}")
-                    continue
-                    
-                invoice_num = str(int(float(invoice_num_raw)))
-                app.logger.info(f"معالجة الفاتورة رقم: {invoice_num}")
-                
-                if invoice_num not in invoices:
-                    dt_object = parse_date_safely(row[INDEX_DATE])
-                    if not dt_object: 
-                        # استخدام تاريخ افتراضي إذا فشلت المعالجة
-                        app.logger.warning(f"استخدام تاريخ افتراضي للصف {i}: {row[INDEX_DATE]}")
-                        date_display = "تاريخ غير محدد"
-                    else:
-                        date_display = f"{dt_object.day:02d} {ARABIC_MONTH_NAMES.get(dt_object.strftime('%b'), dt_object.strftime('%b'))} {dt_object.year}"
-
-                    invoices[invoice_num] = {
-                        'number': invoice_num,
-                        'date': date_display,
-                        'payment_method': PAYMENT_METHOD_MAP.get(str(row[INDEX_PAYMENT]).strip().lower(), str(row[INDEX_PAYMENT]).strip()),
-                        'cashier': row[INDEX_CASHIER] or 'غير محدد', 
-                        'customer_name': row[INDEX_CUST_NAME] or 'غير مسجل',
-                        'customer_phone': row[INDEX_CUST_PHONE] or 'غير مسجل', 
-                        'total_amount': 0.0
-                    }
-                
-                # إضافة المبلغ
-                amount_value = row[INDEX_AMOUNT]
-                if amount_value:
-                    try:
-                        invoices[invoice_num]['total_amount'] += float(amount_value)
-                    except (ValueError, TypeError):
-                        app.logger.warning(f"مبلغ غير صالح في الصف {i}: {amount_value}")
-                        
-            except (ValueError, IndexError) as e:
-                app.logger.error(f"خطأ في معالجة الصف {i}: {e}")
-                continue
-    
-    app.logger.info(f"تم العثور على {matches_found} تطابق, {len(invoices)} فاتورة فريدة")
-    results = list(invoices.values())
-    for res in results: 
-        res['total_amount'] = f"{res['total_amount']:.2f}"
+            date_display = format_arabic_date(dt_object)
+        results.append({
+            'number': str(number),
+            'date': date_display,
+            'payment_method': ds.payment_display(i),
+            'cashier': ds.cashier(i) or 'غير محدد',
+            'customer_name': ds.customer_name(i) or 'غير مسجل',
+            'customer_phone': ds.customer_phones[i] or 'غير مسجل',
+            'total_amount': f"{table.totals[position]:.2f}",
+            'line_count': int(table.line_counts[position]),
+        })
+
+    app.logger.info(f"تم العثور على {len(matches)} تطابق, {len(results)} فاتورة فريدة")
     return results
 
-def advanced_search_data(search_params, data):
-    if not data: 
-        app.logger.warning("لا توجد بيانات للبحث المتقدم")
-        return []
-    
-    results = []
-    processed_count = 0
-    matched_count = 0
-    INDEX_DATE, INDEX_INVOICE, INDEX_AMOUNT, INDEX_PAYMENT, INDEX_CASHIER, INDEX_CUST_NAME, INDEX_CUST_PHONE = 0, 1, 2, 3, 4, 5, 6
+def _parse_param_date(search_params, key, label):
+    if not search_params.get(key): return None
+    try:
+        return np.datetime64(datetime.strptime(search_params[key], '%Y-%m-%d').date(), 'D')
+    except ValueError:
+        app.logger.warning(f"تنسيق تاريخ '{label}' غير صحيح: {search_params[key]}")
+        return None
 
-    app.logger.info(f"بدء البحث المتقدم مع المعايير: {search_params}")
-    app.logger.info(f"عدد الصفوف المتاحة: {len(data)}")
+def _parse_param_amount(search_params, key):
+    if not search_params.get(key): return None
+    try:
+        return float(search_params[key])
+    except ValueError:
+        return None
 
-    for i, row in enumerate(data):
-        if len(row) <= max(INDEX_CUST_PHONE, INDEX_CASHIER): 
-            continue
-            
-        processed_count += 1
-        
-        try:
-            # محاولة معالجة التاريخ
-            dt_object = parse_date_safely(row[INDEX_DATE])
-            
-            # إذا فشلت معالجة التاريخ، استخدم تاريخ افتراضي أو تخطي الفحص بناءً على وجود معايير تاريخ
-            if not dt_object:
-                if search_params.get('date_from') or search_params.get('date_to'):
-                    continue  # تخطي هذا الصف إذا كان البحث يحتوي على معايير تاريخ
-                # استخدام تاريخ افتراضي
-                dt_object = datetime.now()
-                date_display = "تاريخ غير محدد"
-            else:
-                date_display = f"{dt_object.day:02d} {ARABIC_MONTH_NAMES.get(dt_object.strftime('%b'), dt_object.strftime('%b'))} {dt_object.year}"
+class AdvancedSearchQuery:
+    """معايير البحث المتقدم بعد تحليلها مرة واحدة. rows() يقدّر عدد الصفوف لكل شرط من الفهارس،
+    ويبدأ من أضيقها ثم يطبق باقي الشروط بالترتيب نفسه على الصفوف المرشحة فقط"""
 
-            # معالجة المبلغ
-            try:
-                amount = float(row[INDEX_AMOUNT])
-            except (ValueError, TypeError):
-                continue
+    def __init__(self, search_params):
+        self.search_params = search_params
+        # الصفوف بدون تاريخ صالح تُستبعد فقط إذا احتوى البحث على معايير تاريخ
+        self.requires_date = bool(search_params.get('date_from') or search_params.get('date_to'))
+        self.date_from = _parse_param_date(search_params, 'date_from', 'من')
+        self.date_to = _parse_param_date(search_params, 'date_to', 'إلى')
+        # "nan" تُقرأ كرقم لكنها لا تستبعد أي صف
+        self.amount_min, self.amount_max = (None if amount is None or np.isnan(amount) else amount
+                                            for amount in (_parse_param_amount(search_params, 'amount_min'), _parse_param_amount(search_params, 'amount_max')))
 
-            # معالجة البيانات النصية
-            payment_method = str(row[INDEX_PAYMENT]).strip().lower()
-            customer_name = str(row[INDEX_CUST_NAME] or '').strip().lower()
-            cashier_name = str(row[INDEX_CASHIER] or '').strip().lower()
-
-            # فحص المعايير
-            # فحص التاريخ (فقط إذا كان التاريخ صحيح)
-            if dt_object and dt_object != datetime.now():  # التأكد من أن التاريخ ليس افتراضي
-                if search_params.get('date_from'):
-                    try:
-                        date_from = datetime.strptime(search_params['date_from'], '%Y-%m-%d').date()
-                        if dt_object.date() < date_from:
-                            continue
-                    except ValueError:
-                        app.logger.warning(f"تنسيق تاريخ 'من' غير صحيح: {search_params['date_from']}")
-                        
-                if search_params.get('date_to'):
-                    try:
-                        date_to = datetime.strptime(search_params['date_to'], '%Y-%m-%d').date()
-                        if dt_object.date() > date_to:
-                            continue
-                    except ValueError:
-                        app.logger.warning(f"تنسيق تاريخ 'إلى' غير صحيح: {search_params['date_to']}")
-
-            # فحص طريقة الدفع
-            if search_params.get('payment_method') and search_params['payment_method'] != 'all':
-                if payment_method != search_params['payment_method']:
-                    continue
+        # شروط الأعمدة المصنفة: (العمود، دالة تعيد أكواد القيم المطابقة في ds)
+        self.category_filters = []
+        payment_filter = search_params.get('payment_method')
+        if payment_filter and payment_filter != 'all':
+            self.category_filters.append(('payment', lambda ds: ds.category_codes('payment', lambda p: p.lower() == payment_filter)))
+        if search_params.get('customer_name'):
+            # مطابقة الاسم بعد توحيد الحروف العربية والتهجئة اللاتينية من فهرس الأسماء
+            query = search_params['customer_name']
+            self.category_filters.append(('customer', lambda ds: [code for code, _ in ds.customer_matches(query)] or self._raw_matches(ds, 'customer', query)))
+        if search_params.get('cashier_name'):
+            needle = search_params['cashier_name']
+            self.category_filters.append(('cashier', lambda ds: self._raw_matches(ds, 'cashier', needle)))
 
-            # فحص المبلغ الأدنى
-            if search_params.get('amount_min'):
-                try:
-                    if amount < float(search_params['amount_min']):
-                        continue
-                except ValueError:
-                    pass
+    @staticmethod
+    def _raw_matches(ds, name, needle):
+        needle = needle.lower()
+        return ds.category_codes(name, lambda v: needle in str(v or '').strip().lower())
 
-            # فحص المبلغ الأعلى
-            if search_params.get('amount_max'):
-                try:
-                    if amount > float(search_params['amount_max']):
-                        continue
-                except ValueError:
-                    pass
-
-            # فحص اسم العميل
-            if search_params.get('customer_name'):
-                if search_params['customer_name'].lower() not in customer_name:
-                    continue
+    def _filters(self, ds, index):
+        """(عدد الصفوف المتوقع، دالة الصفوف المرشحة، دالة الفحص على صفوف معينة) لكل شرط"""
+        filters = []
+        if self.requires_date:
+            lo, hi = index.date_range(self.date_from, self.date_to)
+            first = _day_number(self.date_from) if self.date_from is not None else None
+            last = _day_number(self.date_to) if self.date_to is not None else None
+            def check_date(rows):
+                dates = ds.dates[rows]
+                days = dates.astype('datetime64[D]').astype(np.int64)
+                mask = ~np.isnat(dates)
+                if first is not None: mask &= days >= first
+                if last is not None: mask &= days <= last
+                return mask
+            filters.append((hi - lo, lambda lo=lo, hi=hi: np.sort(index.date_rows[lo:hi]), check_date))
 
-            # فحص اسم الكاشير
-            if search_params.get('cashier_name'):
-                if search_params['cashier_name'].lower() not in cashier_name:
-                    continue
+        for name, select in self.category_filters:
+            codes = select(ds)
+            estimate = sum(len(index.code_rows[name].get(code, ())) for code in codes)
+            column, selected = getattr(ds, f'{name}_codes'), np.array(codes, dtype=np.int32)
+            filters.append((estimate, lambda name=name, codes=codes: index.category_rows(name, codes),
+                            lambda rows, column=column, selected=selected: np.isin(column[rows], selected)))
+        return sorted(filters, key=lambda f: f[0])
 
-            # إذا وصلنا هنا، فالصف يطابق جميع المعايير
-            matched_count += 1
-            
-            results.append({
-                'number': str(int(float(row[INDEX_INVOICE]))),
-                'date': date_display,
-                'original_date': dt_object,
-                'total_amount': f"{amount:.2f}",
-                'payment_method': PAYMENT_METHOD_MAP.get(payment_method, payment_method.capitalize()),
-                'cashier': row[INDEX_CASHIER] or 'غير محدد',
-                'customer_name': row[INDEX_CUST_NAME] or 'غير مسجل',
-                'customer_phone': row[INDEX_CUST_PHONE] or 'غير مسجل'
-            })
-            
-        except (ValueError, IndexError) as e:
-            app.logger.warning(f"خطأ في معالجة الصف {i} في البحث المتقدم: {e}")
-            continue
+    def matching_rows(self, ds):
+        """أول سطر لكل فاتورة فيها سطر مطابق، بترتيبها في الشيت (النتيجة فاتورة واحدة حتى لو طابقت أكثر من سطر فيها)
+        شرط المبلغ يُطبق على مجموع الفاتورة (المبلغ المعروض في النتائج) وليس على مبلغ كل سطر"""
+        index = ds.query_index()
+        filters = self._filters(ds, index)
+        rows = filters[0][1]() if filters else index.rows
+        for _, _, check in filters[1:]:
+            if not len(rows): break
+            rows = rows[check(rows)]
+        table = ds.invoice_table()
+        positions = np.unique(table.positions(ds.invoice_numbers[rows]))
+        if self.amount_min is not None or self.amount_max is not None:
+            totals = table.totals[positions]
+            mask = np.ones(len(positions), dtype=bool)
+            if self.amount_min is not None: mask &= totals >= self.amount_min
+            if self.amount_max is not None: mask &= totals <= self.amount_max
+            positions = positions[mask]
+        return np.sort(table.first_rows[positions])
 
-    app.logger.info(f"البحث المتقدم: تم معالجة {processed_count} صف, وجد {matched_count} تطابق")
-    
-    # ترتيب النتائج حسب التاريخ (الأحدث أولاً)
+    @staticmethod
+    def _order_keys(ds, rows):
+        """مفاتيح الترتيب (التاريخ بالثواني، رقم الفاتورة)؛ الصفوف بدون تاريخ تأخذ أكبر قيمة فتأتي أولاً"""
+        dates = ds.dates[rows].astype(np.int64)
+        return np.where(dates == NAT_SECONDS, np.iinfo(np.int64).max, dates), ds.invoice_numbers[rows]
+
+    def page(self, ds, cursor=None, limit=None):
+        """النتائج بالترتيب: الأحدث أولاً، ثم رقم الفاتورة الأكبر، ثم ترتيب الصف في الشيت
+        مع limit تُختار أول limit نتيجة بعد المؤشر cursor (keyset) دون ترتيب كل النتائج
+        يعيد (أرقام الصفوف، مؤشر الصفحة التالية أو None، عدد كل النتائج)"""
+        rows = self.matching_rows(ds)
+        total = len(rows)
+        dates, invoices = self._order_keys(ds, rows)
+        if cursor is not None:
+            date, invoice, row = cursor
+            after = (dates < date) | ((dates == date) & ((invoices < invoice) | ((invoices == invoice) & (rows > row))))
+            rows, dates, invoices = rows[after], dates[after], invoices[after]
+        remaining = len(rows)
+        if limit is not None and remaining > limit:
+            # الصفوف التي تاريخها أحدث من أو يساوي تاريخ النتيجة رقم limit تكفي لترتيب الصفحة
+            threshold = np.partition(dates, remaining - limit)[remaining - limit]
+            keep = dates >= threshold
+            rows, dates, invoices = rows[keep], dates[keep], invoices[keep]
+
+        # ~ بدلاً من السالب لترتيب تنازلي دون تجاوز حدود int64
+        order = np.lexsort((rows, ~invoices, ~dates))[:limit]
+        next_cursor = None
+        if limit is not None and remaining > limit:
+            last = order[-1]
+            next_cursor = (int(dates[last]), int(invoices[last]), int(rows[last]))
+        return rows[order], next_cursor, total
+
+def encode_search_cursor(cursor):
+    return '_'.join(map(str, cursor)) if cursor else ''
+
+def decode_search_cursor(text):
+    """مؤشر الصفحة من النموذج، أو None إذا كان فارغاً أو غير صالح"""
     try:
-        return sorted(results, key=lambda x: x['original_date'], reverse=True)
-    except (TypeError, KeyError):
-        app.logger.warning("فشل في ترتيب النتائج، إرجاع النتائج بدون ترتيب")
-        return results
+        date, invoice, row = (int(part) for part in (text or '').split('_'))
+        return date, invoice, row
+    except ValueError:
+        return None
+
+ADVANCED_SEARCH_PAGE_SIZE = 100
+ADVANCED_SEARCH_API_MAX_LIMIT = 500   # أكبر صفحة في /api/advanced_search، والنتائج الأكثر تُطلب بالـ cursor
+
+def _advanced_search_results(ds, rows, now):
+    """نتيجة لكل فاتورة من أول سطر لها (rows)، بمجموعها وعدد سطورها من جدول الفواتير"""
+    table = ds.invoice_table()
+    positions = table.positions(ds.invoice_numbers[rows])
+    for i, position in zip(rows.tolist(), positions.tolist()):
+        dt_object = _to_datetime(ds.dates[i])
+        if dt_object:
+            date_display = format_arabic_date(dt_object)
+        else:
+            dt_object = now
+            date_display = "تاريخ غير محدد"
+        yield {
+            'number': str(ds.invoice_numbers[i]),
+            'date': date_display,
+            'original_date': dt_object,
+            'total_amount': f"{table.totals[position]:.2f}",
+            'payment_method': ds.payment_display(i, fallback=str.capitalize),
+            'cashier': ds.cashier(i) or 'غير محدد',
+            'customer_name': ds.customer_name(i) or 'غير مسجل',
+            'customer_phone': ds.customer_phones[i] or 'غير مسجل',
+            'line_count': int(table.line_counts[position])
+        }
+
+def advanced_search_page(search_params, data, cursor=None, limit=ADVANCED_SEARCH_PAGE_SIZE, lazy=False):
+    """صفحة من نتائج البحث المتقدم بعد cursor (كل النتائج إذا كان limit = None)
+    يعيد (النتائج، مؤشر الصفحة التالية أو None، عدد كل النتائج)؛ مع lazy تُنسق النتائج أثناء المرور عليها"""
+    if not data:
+        app.logger.warning("لا توجد بيانات للبحث المتقدم")
+        return [], None, 0
+    ds = _as_dataset(data, 'main')
 
-def analyze_sales_data(sales_data, time_period='all'):
+    if row_logging_enabled():
+        app.logger.info(f"بدء البحث المتقدم مع المعايير: {search_params}")
+        app.logger.info(f"عدد الصفوف المتاحة: {len(ds)}")
+
+    with metrics.timer('hedeya_stage_seconds', stage='filter'):
+        rows, next_cursor, total = AdvancedSearchQuery(search_params).page(ds, cursor, limit)
+    app.logger.info(f"البحث المتقدم: تم معالجة {ds.query_index().processed_count} صف, وجد {total} تطابق")
+
+    results = _advanced_search_results(ds, rows, datetime.now())
+    return (results if lazy else list(results)), next_cursor, total
+
+def advanced_search_data(search_params, data):
+    """كل نتائج البحث المتقدم مرتبة (الأحدث أولاً)"""
+    return advanced_search_page(search_params, data, limit=None)[0]
+
+CUSTOMER_SEARCH_LIMIT = 20
+PHONE_QUERY_PATTERN = re.compile(r'[\d\s+()\-٠-٩۰-۹]+')
+
+def _customer_phone_groups(ds, query):
+    """{الهاتف الموحد: (الدرجة، الصفوف)} للهواتف المطابقة تماماً أو جزئياً"""
+    index = ds.search_index('phone')
+    exact = index.exact(query, len(ds))
+    groups = {}
+    for rows, score in ((exact, CustomerNameIndex.EXACT), (index.partial(query, len(ds)) - exact, CustomerNameIndex.SUBSTRING)):
+        for i in rows:
+            key = normalize_phone(ds.phone_texts[i])
+            best, members = groups.get(key, (0, []))
+            groups[key] = (max(best, score), members + [i])
+    return groups
+
+@timed_stage('filter')
+def search_customers(query, data, limit=CUSTOMER_SEARCH_LIMIT):
+    """العملاء المطابقون لاسم (بعد التوحيد) أو لرقم هاتف، الأقوى مطابقة أولاً ثم الأكثر فواتير"""
+    query = str(query or '').strip()
+    if not data or not query: return []
+    ds = _as_dataset(data, 'main')
+    index = ds.query_index()
+
+    if PHONE_QUERY_PATTERN.fullmatch(query):
+        groups = list(_customer_phone_groups(ds, query).values())
+    else:
+        groups = [(score, index.code_rows['customer'].get(code, ())) for code, score in ds.customer_matches(query)]
+
+    results = []
+    for score, rows in groups:
+        # الفواتير الصالحة فقط (كما في البحث المتقدم)
+        rows = np.intersect1d(np.asarray(rows, dtype=np.int64), index.rows)
+        if not len(rows): continue
+        dates = ds.dates[rows]
+        latest = int(rows[np.argmax(dates.astype(np.int64))])
+        last_purchase = _to_datetime(ds.dates[latest])
+        results.append({
+            'name': ds.customer_name(latest) or 'غير مسجل',
+            'phone': ds.customer_phones[latest] or 'غير مسجل',
+            'invoice_count': int(len(np.unique(ds.invoice_numbers[rows]))),
+            'last_purchase': format_arabic_date(last_purchase) if last_purchase else 'تاريخ غير محدد',
+            'score': score,
+        })
+    results.sort(key=lambda result: (-result['score'], -result['invoice_count']))
+    return results[:limit]
+
+TIME_PERIOD_DAYS = {'day': 1, 'week': 7, '2weeks': 14, 'month': 30}
+TIME_PERIODS = ('all', *TIME_PERIOD_DAYS)
+
+def period_cutoff(time_period):
+    """بداية الفترة المتحركة (آخر يوم/أسبوع/أسبوعين/شهر حتى الآن)، أو None لكل الأوقات"""
+    if time_period == 'all': return None
+    return datetime.now() - timedelta(days=TIME_PERIOD_DAYS.get(time_period, 0))
+
+SALES_ITEM_RANKINGS = ('quantity', 'revenue')
+
+@timed_stage('aggregate')
+def analyze_sales_data(sales_data, time_period='all', by='quantity'):
+    """القطع المباعة في الفترة مع الكمية والإيرادات (عمود القيمة) وعدد سطور المرتجعات، مرتبة حسب الكمية أو الإيرادات
+    (التعادل يُحسم بترتيب أول ظهور). يعيد (القطع، رسالة الخطأ أو None)"""
     if not sales_data: return [], "لا يمكن الوصول إلى شيت المبيعات."
-    INDEX_DATE, INDEX_ITEM_CODE, INDEX_DESCRIPTION, INDEX_QUANTITY = 0, 1, 2, 3
-    item_summary, now = {}, datetime.now()
-    for row in sales_data:
-        if len(row) <= INDEX_QUANTITY: continue
-        try:
-            dt_object = parse_date_safely(str(row[INDEX_DATE]))
-            if not dt_object: continue
+    ds = _as_dataset(sales_data, 'sales')
+    index = ds.sales_index()
+    lo = index.window_start(period_cutoff(time_period))
+    by = by if by in SALES_ITEM_RANKINGS else 'quantity'
 
-            if time_period != 'all':
-                deltas = {'day': 1, 'week': 7, '2weeks': 14, 'month': 30}
-                if dt_object < (now - timedelta(days=deltas.get(time_period, 0))): continue
+    def build():
+        codes, quantities, revenue, returns, first_rows = index.items(ds, lo)
+        order = np.lexsort((first_rows, -(revenue if by == 'revenue' else quantities)))
+        # الأوصاف تُقرأ بترتيب الصفوف (كل شهر من الأرشيف مرة واحدة) ثم تُوزَّع على ترتيب القطع
+        descriptions = {first: ds.descriptions[first] for first in np.sort(first_rows).tolist()}
+        return [{'كود القطعه': ds.item_categories[code], 'الوصف': descriptions[first], 'الكمية': quantity,
+                 'الإيرادات': round(item_revenue, 2), 'المرتجعات': item_returns}
+                for code, first, quantity, item_revenue, item_returns
+                in zip(*(column[order].tolist() for column in (codes, first_rows, quantities, revenue, returns)))]
+    # القائمة محفوظة ومشتركة بين الطلبات، فكل طلب يأخذ نسخة منها
+    return list(index.cached(('analysis', lo, by), build)), None
 
-            item_code = str(row[INDEX_ITEM_CODE]).strip()
-            if not item_code: continue
+@timed_stage('aggregate')
+def analyze_sales_trends(sales_data, time_period='all'):
+    """الكمية والإيرادات وعدد سطور المرتجعات لكل يوم ولكل أسبوع (يبدأ السبت) في الفترة، للرسوم البيانية"""
+    if not sales_data: return {'daily': [], 'weekly': []}
+    ds = _as_dataset(sales_data, 'sales')
+    index = ds.sales_index()
+    lo = index.window_start(period_cutoff(time_period))
 
-            quantity = float(str(row[INDEX_QUANTITY]).replace(',', '.'))
-            description = str(row[INDEX_DESCRIPTION]).strip()
+    def build():
+        return {name: [{'date': str(np.datetime64(day, 'D')), 'quantity': quantity, 'revenue': round(revenue, 2), 'returns': returns}
+                       for day, quantity, revenue, returns in zip(*(column.tolist() for column in columns))]
+                for name, columns in index.trends(ds, lo).items()}
+    return {name: list(points) for name, points in index.cached(('trend_points', lo), build).items()}
 
-            if item_code not in item_summary:
-                item_summary[item_code] = {'description': description, 'quantity': 0.0}
-            item_summary[item_code]['quantity'] += quantity
-        except (ValueError, IndexError):
-            continue
-    if not item_summary: return [], None
-    result_list = [{'كود القطعه': c, 'الوصف': d['description'], 'الكمية': d['quantity']} for c, d in item_summary.items()]
-    return sorted(result_list, key=lambda x: x['الكمية'], reverse=True), None
+TOP_CUSTOMERS_LIMIT = 10
+TOP_CUSTOMER_RANKINGS = {'revenue': 0, 'visits': 1}
+
+@timed_stage('aggregate')
+def analyze_top_customers(main_data, time_period='all', by='revenue', limit=TOP_CUSTOMERS_LIMIT):
+    """أفضل العملاء (حسب الإنفاق أو عدد الزيارات) وأفضل الكاشير (حسب الإيرادات) في نفس فترات analyze_sales_data
+    من التجميعات اليومية، مع heap بحجم limit بدلاً من ترتيب الكل. يعيد (العملاء، الكاشير)"""
+    if not main_data: return [], []
+    ds = _as_dataset(main_data, 'main')
+    customers, cashiers = ds.rollup().activity(ds, period_cutoff(time_period))
+    rank = TOP_CUSTOMER_RANKINGS.get(by, 0)
+
+    def last_purchase(last):
+        dt_object = _to_datetime(ds.dates[last[1]]) if last[1] >= 0 else None
+        return format_arabic_date(dt_object) if dt_object else 'تاريخ غير محدد'
+
+    # التعادل يُحسم بالمقياس الآخر ثم بآخر شراء
+    top_customers = [{
+        'name': ds.customer_name(last[1]) or 'غير مسجل',
+        'phone': ds.customer_phones[last[1]] or 'غير مسجل',
+        'total_spent': revenue,
+        'visit_count': visits,
+        'last_purchase_text': last_purchase(last),
+    } for revenue, visits, last in heapq.nlargest(limit, customers.values(), key=lambda entry: (entry[rank], entry[1 - rank], entry[2]))]
+    top_cashiers = [{
+        'name': ds.cashier_categories[code] or 'غير محدد',
+        'total_revenue': revenue,
+        'invoice_count': visits,
+        'avg_invoice': revenue / visits if visits else 0.0,
+        'last_purchase_text': last_purchase(last),
+    } for code, (revenue, visits, last) in heapq.nlargest(limit, cashiers.items(), key=lambda item: item[1])]
+    return top_customers, top_cashiers
 
+def billing_period_start(today):
+    """بداية فترة الحساب: 26 من الشهر الحالي أو السابق"""
+    if today.day >= 26:
+        # إذا كان اليوم الحالي 26 أو أكثر، البداية من 26 من نفس الشهر
+        return today.replace(day=26)
+    if today.month == 1:
+        # إذا كان الشهر يناير، نذهب للشهر 12 من السنة السابقة
+        return today.replace(year=today.year-1, month=12, day=26)
+    return today.replace(month=today.month-1, day=26)
+
+@timed_stage('aggregate')
 def get_dashboard_stats(main_data):
     if not main_data: return {'total_revenue': '0.00', 'total_invoices': 0, 'avg_invoice': '0.00', 'today_revenue': '0.00'}
+    ds = _as_dataset(main_data, 'main')
 
-    # حساب تاريخ البداية (26 من الشهر السابق)
     today = datetime.now().date()
-    if today.day >= 26:
-        # إذا كان اليوم الحالي 26 أو أكثر، البداية من 26 من نفس الشهر
-        start_date = today.replace(day=26)
-    else:
-        # إذا كان اليوم الحالي أقل من 26، البداية من 26 من الشهر السابق
-        if today.month == 1:
-            # إذا كان الشهر يناير، نذهب للشهر 12 من السنة السابقة
-            start_date = today.replace(year=today.year-1, month=12, day=26)
-        else:
-            start_date = today.replace(month=today.month-1, day=26)
+    start_date = billing_period_start(today)
 
-    total_revenue, today_revenue, period_revenue, invoices, period_invoices = 0.0, 0.0, 0.0, set(), set()
-    INDEX_DATE, INDEX_INVOICE, INDEX_AMOUNT = 0, 1, 2
-    
-    app.logger.info(f"حساب الإيرادات من {start_date} إلى {today}")
-    
-    for row in main_data:
-        if len(row) <= INDEX_AMOUNT: continue
-        try:
-            amount = float(row[INDEX_AMOUNT])
-            invoice_num = str(int(float(row[INDEX_INVOICE])))
-            
-            # إضافة لإجمالي الإيرادات (كل البيانات)
-            total_revenue += amount
-            invoices.add(invoice_num)
-            
-            dt_object = parse_date_safely(str(row[INDEX_DATE]))
-            if dt_object:
-                row_date = dt_object.date()
-                
-                # إيرادات اليوم الحالي
-                if row_date == today:
-                    today_revenue += amount
-                
-                # إيرادات الفترة المحددة (من 26 الشهر السابق لليوم)
-                if start_date <= row_date <= today:
-                    period_revenue += amount
-                    period_invoices.add(invoice_num)
-                    
-        except (ValueError, IndexError):
-            continue
-    
-    total_invoices = len(invoices)
-    period_invoice_count = len(period_invoices)
+    verbose = row_logging_enabled()
+    if verbose: app.logger.info(f"حساب الإيرادات من {start_date} إلى {today}")
+
+    # إيرادات اليوم الحالي وإيرادات الفترة المحددة (من 26 الشهر السابق لليوم) من التجميعات اليومية،
+    # وعدد فواتير الفترة من جدول الفواتير (نفس الفواتير التي يعرضها البحث)
+    rollup = ds.rollup()
+    today_revenue = rollup.period_totals(today, today)['revenue']
+    period_revenue = rollup.period_totals(start_date, today)['revenue']
+    period_invoice_count = ds.invoice_table().count_between(start_date, today)
     avg_invoice = period_revenue / period_invoice_count if period_invoice_count > 0 else 0
-    
-    app.logger.info(f"إجمالي إيرادات الفترة: {period_revenue:,.2f} من {period_invoice_count} فاتورة")
-    
+
+    if verbose: app.logger.info(f"إجمالي إيرادات الفترة: {period_revenue:,.2f} من {period_invoice_count} فاتورة")
+
     return {
         'total_revenue': f"{period_revenue:,.2f}",  # تغيير لعرض إيرادات الفترة المحددة
         'total_invoices': period_invoice_count,     # عدد فواتير الفترة المحددة
-        'avg_invoice': f"{avg_invoice:,.2f}", 
+        'avg_invoice': f"{avg_invoice:,.2f}",
         'today_revenue': f"{today_revenue:,.2f}"
     }
 
+# --- التصدير (CSV / XLSX) ---
+# الملفات تُكتب وتُرسل على دفعات أثناء المرور على النتائج (chunked)، فلا تُحمَّل النتائج كاملة في الذاكرة
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def stream_csv(header, rows):
+    """ملف CSV على دفعات؛ يبدأ بـ BOM ليفتح Excel النص العربي بشكل صحيح"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+class _ChunkWriter(io.RawIOBase):
+    """مخرج غير قابل للتنقل لـ zipfile: ما يُكتب يُجمع حتى يُسحب بـ take()"""
+
+    def __init__(self):
+        self.chunks, self.size = [], 0
+
+    def writable(self): return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def take(self):
+        data, self.chunks, self.size = b''.join(self.chunks), [], 0
+        return data
+
+def _xlsx_cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>' if np.isfinite(value) else '<c/>'
+    text = xml_escape(XML_INVALID_CHARS.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+def stream_xlsx(header, rows):
+    """ملف XLSX (ورقة واحدة من اليمين لليسار) يُكتب بـ zipfile مباشرة على دفعات دون مكتبات إضافية"""
+    output = _ChunkWriter()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetViews><sheetView rightToLeft="1" workbookViewId="0"/></sheetViews><sheetData>')
+            for row in itertools.chain([header], rows):
+                sheet.write(('<row>' + ''.join(map(_xlsx_cell, row)) + '</row>').encode('utf-8'))
+                if output.size >= EXPORT_CHUNK_SIZE:
+                    yield output.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield output.take()
+
+def content_disposition(filename):
+    """ترويسة التنزيل: اسم ASCII بين علامتي تنصيص، والاسم الكامل (مثلاً بالعربية) في filename* بترميز RFC 5987"""
+    fallback = re.sub(r'[^A-Za-z0-9._-]', '_', filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
+
+def export_response(fmt, filename, header, rows):
+    """استجابة تنزيل تُرسل أثناء كتابة الملف"""
+    body = stream_csv(header, rows) if fmt == 'csv' else stream_xlsx(header, rows)
+    return Response(stream_with_context(body), content_type=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': content_disposition(f'{filename}.{fmt}')})
+
+ADVANCED_SEARCH_EXPORT_HEADER = ['رقم الفاتورة', 'التاريخ', 'المبلغ', 'طريقة الدفع', 'العميل', 'الهاتف', 'الكاشير', 'عدد السطور']
+
+def advanced_search_export_rows(search_params, data):
+    """صفوف تصدير البحث المتقدم بنفس الشروط والترتيب، بالقيم الخام (تاريخ ISO ومبلغ رقمي)"""
+    if not data: return
+    ds = _as_dataset(data, 'main')
+    rows = AdvancedSearchQuery(search_params).page(ds)[0]
+    table = ds.invoice_table()
+    for i, position in zip(rows.tolist(), table.positions(ds.invoice_numbers[rows]).tolist()):
+        dt_object = _to_datetime(ds.dates[i])
+        yield [int(ds.invoice_numbers[i]), dt_object.strftime('%Y-%m-%d %H:%M:%S') if dt_object else '', float(table.totals[position]),
+               ds.payment_display(i, fallback=str.capitalize), ds.customer_name(i) or '', ds.customer_phones[i] or '', ds.cashier(i) or '',
+               int(table.line_counts[position])]
+
+SALES_EXPORT_HEADER = ['كود القطعه', 'الوصف', 'الكمية', 'الإيرادات', 'المرتجعات']
+
+# --- ذاكرة الصفحات المعروضة ---
+DASHBOARD_CACHE_BYTES = 32 * 1024 * 1024   # صفحة "كل الأوقات" قد تتجاوز 1MB لكثرة المنتجات
+
+class RenderedPageCache:
+    """صفحات معروضة في ذاكرة LRU (محدودة بالحجم بالبايت) حسب مفتاح يتضمن نسخة البيانات، وتُفرغ عند نشر بيانات جديدة
+    الصفحة المحفوظة تُعاد لأي طلب بنفس المفتاح، فكل ما تعرضه (ومنه رسائل الخطأ) يجب أن يُشتق من المفتاح.
+    الصفحات تُحفظ مرمّزة UTF-8: الحجم المحسوب هو حجمها الفعلي، وهي أصغر من النص (العربي حرفان بايت في str)"""
+
+    def __init__(self, max_bytes):
+        self._pages = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            page = self._pages.get(key)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = render().encode('utf-8')
+        with self._lock:
+            try:
+                self._pages[key] = page
+            except ValueError:  # صفحة أكبر من الحد كله: تُعرض دون حفظ
+                pass
+        return page
+
+    def clear(self, sheet_type=None):
+        with self._lock:
+            self._pages.clear()
+
+    def status(self):
+        return {'entries': len(self._pages), 'bytes': self._pages.currsize, 'hits': self.hits, 'misses': self.misses}
+
+dashboard_cache = RenderedPageCache(DASHBOARD_CACHE_BYTES)
+sheet_refresher.listeners.append(dashboard_cache.clear)
+
+def _cache_metrics():
+    for sheet_type, counters in sheet_refresher.stats.items():
+        for event, value in counters.items():
+            yield 'hedeya_sheet_cache_events_total', {'sheet': sheet_type, 'event': event}, value
+        yield 'hedeya_sheet_rows', {'sheet': sheet_type}, len(sheet_refresher.snapshots.get(sheet_type) or [])
+        archive = sheet_refresher._archive(sheet_type)
+        if archive is not None:
+            yield 'hedeya_archive_partition_loads_total', {'sheet': sheet_type}, archive.loads
+            yield 'hedeya_archive_resident_partitions', {'sheet': sheet_type}, archive.status()['resident']
+    yield 'hedeya_dashboard_cache_events_total', {'event': 'hit'}, dashboard_cache.hits
+    yield 'hedeya_dashboard_cache_events_total', {'event': 'miss'}, dashboard_cache.misses
+
+metrics.collectors.append(_cache_metrics)
+
+def _rolling_window_clock(time_period):
+    """الفترات المتحركة (آخر يوم/أسبوع...) تتغير مع الوقت حتى دون بيانات جديدة، فتتغير نسختها مع كل فترة تحديث"""
+    return None if time_period == 'all' else int(time.time() // SHEET_REFRESH_INTERVAL)
+
 # --- مسارات التطبيق (Routes) ---
 
 @app.route('/')
@@ -549,7 +3025,8 @@ def search():
     if not search_results:
         flash(f'لم يتم العثور على نتائج للبحث: "{query}"', 'warning')
     
-    return render_template('index.html', results=search_results, query=query, search_type=search_type, offline_mode=offline_mode)
+    with metrics.timer('hedeya_stage_seconds', stage='render'):
+        return render_template('index.html', results=search_results, query=query, search_type=search_type, offline_mode=offline_mode)
 
 @app.route('/advanced_search', methods=['GET', 'POST'])
 @login_required
@@ -557,9 +3034,10 @@ def advanced_search():
     if session.get('username', '').lower() != 'admin':
         return redirect(url_for('home'))
 
-    results, search_params = [], {}
+    results, search_params, next_cursor, total_count = [], {}, None, 0
+    show_all = request.form.get('show_all') == 'true'
     if request.method == 'POST':
-        search_params = {k: v for k, v in request.form.items() if v}
+        search_params = {k: v for k, v in request.form.items() if v and k not in ('cursor', 'show_all')}
         main_data = get_sheet_data('main')
         
         # إضافة معلومات تشخيصية
@@ -568,12 +3046,20 @@ def advanced_search():
         elif len(main_data) == 0:
             flash('Google Sheets فارغ أو لا يحتوي على بيانات.', 'warning')
         else:
-            results = advanced_search_data(search_params, main_data)
+            # صفحة واحدة بعد المؤشر، أو كل النتائج تُرسل تدريجياً أثناء عرض القالب
+            cursor = decode_search_cursor(request.form.get('cursor'))
+            results, next_cursor, total_count = advanced_search_page(search_params, main_data, cursor,
+                                                                     limit=None if show_all else ADVANCED_SEARCH_PAGE_SIZE, lazy=show_all)
             
-            if not results:
+            if not total_count:
                 flash('لم يتم العثور على نتائج تطابق معايير البحث المحددة.', 'warning')
+            elif show_all:
+                return Response(stream_with_context(stream_template('advanced_search.html', results=results, search_params=search_params,
+                                                                    payment_methods=PAYMENT_METHOD_MAP, total_count=total_count, show_all=show_all)))
 
-    return render_template('advanced_search.html', results=results, search_params=search_params, payment_methods=PAYMENT_METHOD_MAP)
+    with metrics.timer('hedeya_stage_seconds', stage='render'):
+        return render_template('advanced_search.html', results=results, search_params=search_params, payment_methods=PAYMENT_METHOD_MAP,
+                               total_count=total_count, next_cursor=encode_search_cursor(next_cursor), show_all=show_all)
 
 @app.route('/dashboard', methods=['GET', 'POST'])
 @login_required
@@ -581,19 +3067,153 @@ def dashboard():
     if session.get('username', '').lower() != 'admin':
         return redirect(url_for('home'))
 
+    main_data, sales_data = get_sheets_data('main', 'sales')
+    time_period = request.form.get('time_period', 'all')
+    item_rank = request.form.get('item_rank', 'quantity')
+
+    def render():
+        # رسالة الخطأ جزء من الصفحة (لا flash) لأن الصفحة تُحفظ؛ وهي تعتمد فقط على نسخة بيانات المبيعات في المفتاح
+        top_items, error = analyze_sales_data(sales_data, time_period, by=item_rank)
+        sales_trends = analyze_sales_trends(sales_data, time_period)
+        stats = get_dashboard_stats(main_data)
+        top_customers, top_cashiers = analyze_top_customers(main_data, time_period)
+        with metrics.timer('hedeya_stage_seconds', stage='render'):
+            return render_template('dashboard.html', 
+                                   top_items=top_items or [], 
+                                   sales_trends=sales_trends,
+                                   top_customers=top_customers,
+                                   top_cashiers=top_cashiers,
+                                   selected_period=time_period,
+                                   item_rank=item_rank,
+                                   error=error,
+                                   stats=stats)
+
+    # الصفحة لا تتغير إلا مع بيانات جديدة أو يوم جديد (إيرادات اليوم وفترة الحساب) أو تقدم الفترات المتحركة
+    key = (time_period, item_rank, sheet_refresher.data_version(main_data), sheet_refresher.data_version(sales_data),
+           datetime.now().date(), _rolling_window_clock(time_period))
+    return dashboard_cache.get_or_render(key, render)
+
+@app.route('/advanced_search/export/<fmt>')
+@login_required
+def export_advanced_search(fmt):
+    if session.get('username', '').lower() != 'admin':
+        return redirect(url_for('home'))
+    if fmt not in EXPORT_FORMATS:
+        return redirect(url_for('advanced_search'))
+
+    search_params = {k: v for k, v in request.args.items() if v}
+    rows = advanced_search_export_rows(search_params, get_sheet_data('main'))
+    return export_response(fmt, 'advanced_search', ADVANCED_SEARCH_EXPORT_HEADER, rows)
+
+@app.route('/dashboard/export/<fmt>')
+@login_required
+def export_top_items(fmt):
+    if session.get('username', '').lower() != 'admin':
+        return redirect(url_for('home'))
+    # المعايير تدخل في اسم الملف، فتُقبل القيم المعروفة فقط
+    time_period, by = request.args.get('time_period', 'all'), request.args.get('by', 'quantity')
+    if fmt not in EXPORT_FORMATS or time_period not in TIME_PERIODS or by not in SALES_ITEM_RANKINGS:
+        return redirect(url_for('dashboard'))
+
+    top_items, _ = analyze_sales_data(get_sheet_data('sales'), time_period, by=by)
+    rows = ([item[key] for key in SALES_EXPORT_HEADER] for item in top_items)
+    return export_response(fmt, f'top_items_{time_period}_{by}', SALES_EXPORT_HEADER, rows)
+
+# --- JSON API ---
+# كل استجابة تحمل ETag مشتقاً من نسخة البيانات (generation اللقطة) ومعايير الطلب؛ إذا أرسل العميل نفس الـ ETag
+# في If-None-Match يُرد بـ 304 دون حساب النتيجة، فالأجهزة التي تسأل باستمرار لا تكلف شيئاً بين التحديثات
+
+def api_etag(*parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def conditional_json(etag, build):
+    """استجابة JSON بالـ ETag، أو 304 إذا كانت النسخة لدى العميل هي نفسها"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def api_admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('username', '').lower() != 'admin':
+            return jsonify({'error': 'forbidden'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    query, search_type = request.args.get('query', ''), request.args.get('search_type', 'invoice')
+    offline_mode = request.args.get('offline_mode') == 'true'
+    main_data = get_sheet_data('main', offline_mode=offline_mode)
+    etag = api_etag('search', query, search_type, sheet_refresher.data_version(main_data))
+    return conditional_json(etag, lambda: {'results': search_data_for_web(query, search_type, main_data) if query else []})
+
+@app.route('/api/customers')
+@login_required
+def api_customers():
+    query = request.args.get('query', '')
+    limit = min(max(request.args.get('limit', CUSTOMER_SEARCH_LIMIT, type=int), 1), 100)
     main_data = get_sheet_data('main')
-    sales_data = get_sheet_data('sales')
+    etag = api_etag('customers', query, limit, sheet_refresher.data_version(main_data))
+    return conditional_json(etag, lambda: {'results': search_customers(query, main_data, limit)})
 
-    time_period = request.form.get('time_period', 'all')
-    top_items, error = analyze_sales_data(sales_data, time_period)
-    if error: flash(error, 'error')
+@app.route('/api/advanced_search')
+@login_required
+@api_admin_required
+def api_advanced_search():
+    search_params = {k: v for k, v in request.args.items() if v and k not in ('cursor', 'limit')}
+    cursor = decode_search_cursor(request.args.get('cursor'))
+    limit = min(max(request.args.get('limit', ADVANCED_SEARCH_PAGE_SIZE, type=int), 1), ADVANCED_SEARCH_API_MAX_LIMIT)
+    main_data = get_sheet_data('main')
+    etag = api_etag('advanced_search', search_params, request.args.get('cursor'), limit, sheet_refresher.data_version(main_data))
 
-    stats = get_dashboard_stats(main_data)
+    def build():
+        results, next_cursor, total_count = advanced_search_page(search_params, main_data, cursor, limit=limit)
+        for result in results:
+            result['original_date'] = result['original_date'].isoformat()
+        return {'results': results, 'next_cursor': encode_search_cursor(next_cursor) or None, 'total_count': total_count}
+    return conditional_json(etag, build)
 
-    return render_template('dashboard.html', 
-                           top_items=top_items or [], 
-                           selected_period=time_period,
-                           stats=stats)
+@app.route('/api/dashboard_stats')
+@login_required
+@api_admin_required
+def api_dashboard_stats():
+    main_data = get_sheet_data('main')
+    # الإحصائيات تعتمد على تاريخ اليوم (إيرادات اليوم وبداية فترة الحساب)
+    etag = api_etag('dashboard_stats', datetime.now().date(), sheet_refresher.data_version(main_data))
+    return conditional_json(etag, lambda: get_dashboard_stats(main_data))
+
+@app.route('/api/top_customers')
+@login_required
+@api_admin_required
+def api_top_customers():
+    time_period, by = request.args.get('time_period', 'all'), request.args.get('by', 'revenue')
+    limit = min(max(request.args.get('limit', TOP_CUSTOMERS_LIMIT, type=int), 1), 100)
+    main_data = get_sheet_data('main')
+    etag = api_etag('top_customers', time_period, by, limit, _rolling_window_clock(time_period), sheet_refresher.data_version(main_data))
+
+    def build():
+        top_customers, top_cashiers = analyze_top_customers(main_data, time_period, by, limit)
+        return {'top_customers': top_customers, 'top_cashiers': top_cashiers}
+    return conditional_json(etag, build)
+
+@app.route('/api/sales_analysis')
+@login_required
+@api_admin_required
+def api_sales_analysis():
+    time_period, by = request.args.get('time_period', 'all'), request.args.get('by', 'quantity')
+    sales_data = get_sheet_data('sales')
+    etag = api_etag('sales_analysis', time_period, by, _rolling_window_clock(time_period), sheet_refresher.data_version(sales_data))
+
+    def build():
+        top_items, error = analyze_sales_data(sales_data, time_period, by=by)
+        return {'top_items': top_items, 'trends': analyze_sales_trends(sales_data, time_period), 'error': error}
+    return conditional_json(etag, build)
 
 # --- مسارات المصادقة ---
 @app.route('/login', methods=['GET', 'POST'])
@@ -665,6 +3285,7 @@ def debug_info():
             debug_data['sample_sales_rows'] = sales_data[:3]
     except Exception as e:
         debug_data['errors'].append(f"Sales sheet error: {str(e)}")
+    debug_data['refresher'] = sheet_refresher.status()
     
     return f"<pre>{json.dumps(debug_data, indent=2, ensure_ascii=False)}</pre>"
 
@@ -700,9 +3321,22 @@ def local_data_status():
     
     status = {}
     for sheet_type in ['main', 'sales']:
-        filename = f'local_data_{sheet_type}.pkl'
-        if os.path.exists(filename):
-            try:
+        try:
+            # قراءة الـ manifest فقط دون تحميل البيانات
+            manifest = read_snapshot_metadata(sheet_type)
+            if manifest is not None:
+                months = sorted(segment['month'] for segment in manifest['segments'] if segment.get('month'))
+                status[sheet_type] = {
+                    'exists': True,
+                    'timestamp': manifest['timestamp'],
+                    'rows_count': manifest['rows_count'],
+                    'segments': len(manifest['segments']),
+                    'months': f"{months[0]} - {months[-1]}" if months else None,
+                    'file_size': f"{sum(os.path.getsize(segment['file']) for segment in manifest['segments']) / 1024:.2f} KB"
+                }
+                continue
+            filename = _legacy_pickle_path(sheet_type)
+            if os.path.exists(filename):
                 with open(filename, 'rb') as f:
                     saved_data = pickle.load(f)
                     status[sheet_type] = {
@@ -711,31 +3345,56 @@ def local_data_status():
                         'rows_count': len(saved_data['data']),
                         'file_size': f"{os.path.getsize(filename) / 1024:.2f} KB"
                     }
-            except Exception as e:
-                status[sheet_type] = {
-                    'exists': True,
-                    'error': str(e)
-                }
-        else:
-            status[sheet_type] = {'exists': False}
+            else:
+                status[sheet_type] = {'exists': False}
+        except Exception as e:
+            status[sheet_type] = {
+                'exists': True,
+                'error': str(e)
+            }
     
     return f"<pre>{json.dumps(status, indent=2, ensure_ascii=False)}</pre>"
 
+@app.route('/cache_stats')
+@login_required
+def cache_stats():
+    if session.get('username', '').lower() != 'admin':
+        return redirect(url_for('home'))
+
+    # الأرقام خاصة بعامل gunicorn الذي استقبل هذا الطلب
+    stats = {'worker_pid': os.getpid(), 'sheets': sheet_refresher.status(), 'google_sheets': sheets_connection.status(),
+             'dashboard_cache': dashboard_cache.status(), 'analytics': analytics_engine.status()}
+    return f"<pre>{json.dumps(stats, indent=2, ensure_ascii=False)}</pre>"
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # مع METRICS_TOKEN يقرأها Prometheus بالتوكن دون تسجيل دخول؛ بدونه تُعرض لجلسة المدير فقط
+    # (مثل /cache_stats) وتُعاد 404 لغيره حتى لا تظهر أعداد الصفوف وأخطاء التحديث للعامة
+    token = os.environ.get('METRICS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif 'logged_in' not in session or session.get('username', '').lower() != 'admin':
+        return Response('not found\n', status=404, mimetype='text/plain')
+    # الأرقام خاصة بعامل gunicorn الذي استقبل هذا الطلب (مثل /cache_stats)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/refresh_local_data')
 @login_required  
 def refresh_local_data():
     if session.get('username', '').lower() != 'admin':
         return redirect(url_for('home'))
     
-    try:
-        # تحديث البيانات الرئيسية
-        main_data = get_sheet_data('main', offline_mode=False)
-        # تحديث بيانات المبيعات
-        sales_data = get_sheet_data('sales', offline_mode=False)
-        
+    # تحديث فوري للشيتين بالتوازي بدلاً من انتظار التحديث التالي في الخلفية
+    results = sheet_refresher.refresh_many(sheet_refresher.sheet_types, full=True)
+    failed = [sheet_type for sheet_type, ok in results.items() if ok is False]
+    pending = [sheet_type for sheet_type, ok in results.items() if ok is None]
+    if failed:
+        flash(f'فشل في تحديث البيانات المحلية: {", ".join(failed)}', 'error')
+    if pending:
+        flash(f'تحديث البيانات مستمر في الخلفية: {", ".join(pending)}', 'warning')
+    if not failed and not pending:
         flash('تم تحديث البيانات المحلية بنجاح!', 'success')
-    except Exception as e:
-        flash(f'فشل في تحديث البيانات المحلية: {str(e)}', 'error')
     
     return redirect(url_for('home'))
 
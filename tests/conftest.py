@@ -0,0 +1,35 @@
+# الاختبارات تستورد main وbenchmarks من جذر المشروع
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+main.app.logger.setLevel(logging.ERROR)
+
+import pytest
+
+from benchmarks.synthetic import generate_main_rows, generate_sales_rows
+
+@pytest.fixture
+def sheets(monkeypatch):
+    """بيانات الشيتين للطلبات بدلاً من Google Sheets"""
+    data = {'main': main.SheetDataset(generate_main_rows(3000, days=90, seed=11), 'main'),
+            'sales': main.SheetDataset(generate_sales_rows(3000, days=90, seed=11), 'sales')}
+    monkeypatch.setattr(main, 'get_sheet_data', lambda sheet_type='main', offline_mode=False: data[sheet_type])
+    monkeypatch.setattr(main, 'get_sheets_data', lambda *sheet_types: [data[sheet_type] for sheet_type in sheet_types])
+    return data
+
+@pytest.fixture
+def client():
+    main.app.config['TESTING'] = True
+    with main.app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def admin(client):
+    with client.session_transaction() as session:
+        session.update(username='admin', user_id=1, logged_in=True)
+    return client
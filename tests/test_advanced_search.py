@@ -0,0 +1,129 @@
+# البحث المتقدم: الفهارس وترتيب الشروط مقارنة بفحص كل الصفوف، وشرط المبلغ على مجموع الفاتورة المعروض في النتائج
+
+import re
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows
+
+def _line(invoice, amount, payment='Cash', minute=0):
+    return [f'10-JUL-25 01.{minute:02d}.00 PM +03:00', str(invoice), amount, payment, 'momen.m', 'محمد', '01012345678']
+
+def _dataset():
+    rows = [
+        # فاتورة بثلاثة سطور كل منها أقل من 500 ومجموعها 600
+        _line(1001, 200.0, minute=1), _line(1001, 200.0, minute=1), _line(1001, 200.0, minute=1),
+        _line(1002, 550.0, minute=2),
+        # فاتورة بسطرين أكبرهما أقل من 100 ومجموعها 70
+        _line(1003, 40.0, 'UDF4', minute=3), _line(1003, 30.0, 'UDF4', minute=3),
+        # سطر واحد أقل من 100 في فاتورة مجموعها 180
+        _line(1004, 120.0, minute=4), _line(1004, 60.0, minute=4),
+    ]
+    return main.SheetDataset(rows, 'main')
+
+def _totals(params):
+    return {result['number']: result['total_amount'] for result in main.advanced_search_data(params, _dataset())}
+
+def test_amount_min_uses_invoice_total():
+    assert _totals({'amount_min': '500'}) == {'1001': '600.00', '1002': '550.00'}
+
+def test_amount_max_uses_invoice_total():
+    assert _totals({'amount_max': '100'}) == {'1003': '70.00'}
+
+def test_amount_range_with_other_filters():
+    assert _totals({'amount_min': '50', 'amount_max': '200', 'payment_method': 'udf4'}) == {'1003': '70.00'}
+    assert _totals({'amount_min': '150', 'amount_max': '600', 'payment_method': 'cash'}) == {'1001': '600.00', '1002': '550.00', '1004': '180.00'}
+
+def test_results_report_line_counts():
+    results = main.advanced_search_data({'amount_min': '500'}, _dataset())
+    assert {result['number']: result['line_count'] for result in results} == {'1001': 3, '1002': 1}
+
+@pytest.fixture(scope='module')
+def large():
+    rows = generate_main_rows(5000, days=90, seed=8)
+    rows[100][0], rows[200][2], rows[300][1] = '', 'N/A', ''
+    return main.SheetDataset(rows, 'main')
+
+def _naive_rows(ds, params):
+    """أول سطر لكل فاتورة فيها سطر يطابق كل الشروط، بفحص كل الصفوف"""
+    date_from, date_to = (date.fromisoformat(params[key]) if params.get(key) else None for key in ('date_from', 'date_to'))
+    payment, cashier = params.get('payment_method', 'all'), params.get('cashier_name', '').lower()
+    first_rows, matched = {}, set()
+    for i in range(len(ds)):
+        if not ds.invoice_ok[i]: continue
+        number = int(ds.invoice_numbers[i])
+        first_rows.setdefault(number, i)
+        if ds.row_lengths[i] <= main.MAIN_COLUMNS['customer_phone'] or np.isnan(ds.amounts[i]): continue
+        if date_from or date_to:
+            if np.isnat(ds.dates[i]): continue
+            day = ds.dates[i].astype('datetime64[D]').astype(date)
+            if (date_from and day < date_from) or (date_to and day > date_to): continue
+        if payment != 'all' and ds.payment_categories[ds.payment_codes[i]].lower() != payment: continue
+        if cashier and cashier not in str(ds.cashier(i) or '').strip().lower(): continue
+        matched.add(number)
+    totals = {number: 0.0 for number in matched}
+    for i in range(len(ds)):
+        number = int(ds.invoice_numbers[i])
+        if ds.invoice_ok[i] and number in totals and not np.isnan(ds.amounts[i]):
+            totals[number] += ds.amounts[i]
+    low, high = (float(params[key]) if params.get(key) else None for key in ('amount_min', 'amount_max'))
+    return sorted(first_rows[number] for number, total in totals.items()
+                  if (low is None or total >= low) and (high is None or total <= high))
+
+_today = date.today()
+@pytest.mark.parametrize('params', [
+    {},
+    {'payment_method': 'cash'},
+    {'cashier_name': 'ali'},
+    {'date_from': str(_today - timedelta(days=10))},
+    {'date_from': str(_today - timedelta(days=30)), 'date_to': str(_today - timedelta(days=20)), 'payment_method': 'udf4'},
+    {'date_to': str(_today - timedelta(days=80)), 'cashier_name': 'M', 'amount_min': '300'},
+    {'payment_method': 'bank', 'cashier_name': 'momen', 'amount_max': '400'},
+    {'date_from': str(_today + timedelta(days=1))},
+])
+def test_matching_rows_match_linear_scan(large, params):
+    assert main.AdvancedSearchQuery(params).matching_rows(large).tolist() == _naive_rows(large, params)
+
+def _ties():
+    # فواتير كثيرة بنفس الوقت تماماً وسطور بدون تاريخ، حتى تقع حدود الصفحات داخل مجموعات متساوية
+    rows = [_line(2000 + i % 40, 10.0, minute=i % 3) for i in range(120)]
+    rows += [['', str(3000 + i), 5.0, 'Cash', 'momen.m', '', ''] for i in range(5)]
+    return main.SheetDataset(rows, 'main')
+
+@pytest.mark.parametrize('name, limit', [('ties', 1), ('ties', 7), ('ties', 40), ('large', 97), ('large', 1000)])
+def test_cursor_pages_cover_all_results_in_order(large, name, limit):
+    ds = large if name == 'large' else _ties()
+    expected = [result['number'] for result in main.advanced_search_data({}, ds)]
+    numbers, cursor = [], None
+    while True:
+        results, cursor, total = main.advanced_search_page({}, ds, cursor, limit=limit)
+        assert total == len(expected) and len(results) <= limit
+        numbers += [result['number'] for result in results]
+        if cursor is None: break
+        # المؤشر يمر عبر النموذج كنص
+        cursor = main.decode_search_cursor(main.encode_search_cursor(cursor))
+    assert numbers == expected
+
+def _invoice_cells(html):
+    return re.findall(r'<tr>\s*<td>(\d+)</td>', html)
+
+def test_results_page_links_to_the_next_page(admin, sheets):
+    expected = [result['number'] for result in main.advanced_search_data({'payment_method': 'cash'}, sheets['main'])]
+    first = admin.post('/advanced_search', data={'payment_method': 'cash'}).get_data(as_text=True)
+    assert _invoice_cells(first) == expected[:main.ADVANCED_SEARCH_PAGE_SIZE]
+
+    cursor = re.search(r'name="cursor" value="([^"]+)"', first).group(1)
+    second = admin.post('/advanced_search', data={'payment_method': 'cash', 'cursor': cursor}).get_data(as_text=True)
+    assert _invoice_cells(second) == expected[main.ADVANCED_SEARCH_PAGE_SIZE:2 * main.ADVANCED_SEARCH_PAGE_SIZE]
+
+def test_show_all_streams_every_result(admin, sheets):
+    expected = [result['number'] for result in main.advanced_search_data({'payment_method': 'cash'}, sheets['main'])]
+    assert len(expected) > main.ADVANCED_SEARCH_PAGE_SIZE
+    response = admin.post('/advanced_search', data={'payment_method': 'cash', 'show_all': 'true'})
+    assert response.is_streamed
+    html = response.get_data(as_text=True)
+    assert _invoice_cells(html) == expected
+    assert 'name="cursor"' not in html
@@ -0,0 +1,77 @@
+# التجميعات اليومية من process pool أو بعد إضافة صفوف يجب أن تطابق بناءها مرة واحدة في العملية الحالية
+
+import threading
+
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows
+
+def _rows():
+    rows = generate_main_rows(6000, days=400, seed=5)
+    # فواتير تظهر في أكثر من يوم
+    return rows + [list(row) for row in rows[:40]]
+
+def _value(value):
+    if isinstance(value, float): return round(value, 6)
+    if isinstance(value, (tuple, list)): return tuple(_value(item) for item in value)
+    if isinstance(value, dict): return {key: _value(item) for key, item in value.items()}
+    return value
+
+def _dump(rollup):
+    days = {day: _value((bucket.revenue, bucket.by_payment, bucket.by_cashier, bucket.customers, bucket.cashiers, sorted(bucket.rows)))
+            for day, bucket in rollup.days.items()}
+    return (rollup.size, rollup.day_keys, days, rollup.invoice_days, rollup.multi_day_invoices, rollup.customer_ids,
+            _value(rollup.customer_totals), _value(rollup.cashier_totals))
+
+def _rollup(rows):
+    return main.SheetDataset([list(row) for row in rows], 'main').rollup()
+
+@pytest.fixture
+def engine(monkeypatch):
+    """تجميع متوازي حتى للدفعات الصغيرة، بطريقة بدء العمليات الافتراضية"""
+    engine = main.AnalyticsEngine(2, 1000, main.ANALYTICS_START_METHOD)
+    monkeypatch.setattr(main, 'analytics_engine', engine)
+    yield engine
+    engine.shutdown()
+
+def test_parallel_rollup_matches_serial(engine, monkeypatch):
+    rows = _rows()
+    parallel = _rollup(rows)
+    assert engine.stats['parallel'] == 1 and engine.stats['fallbacks'] == 0
+
+    monkeypatch.setattr(main, 'analytics_engine', main.AnalyticsEngine(1, 1000))
+    assert _dump(parallel) == _dump(_rollup(rows))
+
+def test_appended_rollup_matches_fresh_build(engine):
+    rows = _rows()
+    base = main.SheetDataset([list(row) for row in rows[:5500]], 'main')
+    base.rollup()
+    appended = base.appended([list(row) for row in rows[5500:]])
+    assert _dump(appended.rollup()) == _dump(_rollup(rows))
+    # الأساس بالتوازي، والإضافة (أقل من min_rows) في العملية الحالية
+    assert engine.stats == {'serial': 1, 'parallel': 2, 'fallbacks': 0}
+
+def test_parallel_rollup_from_thread_while_locks_are_held(engine, monkeypatch):
+    """كما في عامل gunicorn: التجميع من thread التحديث بينما thread آخر يمسك قفل metrics وقفل تحديث شيت"""
+    rows = _rows()
+    held, release = threading.Event(), threading.Event()
+    def hold():
+        with main.metrics._lock, main.sheet_refresher._locks['sales']:
+            held.set()
+            release.wait(60)
+    holder = threading.Thread(target=hold, daemon=True)
+    holder.start()
+    assert held.wait(10)
+
+    results = []
+    builder = threading.Thread(target=lambda: results.extend(_rollup(rows) for _ in range(2)), daemon=True)
+    builder.start()
+    builder.join(60)
+    release.set()
+    assert not builder.is_alive() and len(results) == 2
+    # التجميعان من نفس الـ pool
+    assert engine.stats['parallel'] == 2 and engine.stats['fallbacks'] == 0 and engine.status()['pool']
+
+    monkeypatch.setattr(main, 'analytics_engine', main.AnalyticsEngine(1, 1000))
+    assert _dump(results[0]) == _dump(results[1]) == _dump(_rollup(rows))
@@ -0,0 +1,35 @@
+# JSON API: ETag و304 وحدود الصفحات
+
+import main
+
+def test_unchanged_data_answers_304(admin, sheets):
+    first = admin.get('/api/dashboard_stats')
+    assert first.status_code == 200 and first.get_json()['total_invoices'] > 0
+    etag = first.headers['ETag']
+
+    second = admin.get('/api/dashboard_stats', headers={'If-None-Match': etag})
+    assert second.status_code == 304 and second.get_data() == b''
+    assert second.headers['ETag'] == etag
+
+    # بيانات جديدة = ETag جديد
+    sheets['main'] = sheets['main'].appended(sheets['main'][:1])
+    third = admin.get('/api/dashboard_stats', headers={'If-None-Match': etag})
+    assert third.status_code == 200 and third.headers['ETag'] != etag
+
+def test_etag_depends_on_query(admin, sheets):
+    first = admin.get('/api/advanced_search?payment_method=cash')
+    other = admin.get('/api/advanced_search?payment_method=cash', headers={'If-None-Match': first.headers['ETag']})
+    assert other.status_code == 304
+    changed = admin.get('/api/advanced_search?payment_method=udf4', headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+
+def test_advanced_search_limit_is_clamped(admin, sheets):
+    body = admin.get('/api/advanced_search?limit=10000000').get_json()
+    assert body['total_count'] > main.ADVANCED_SEARCH_API_MAX_LIMIT
+    assert len(body['results']) == main.ADVANCED_SEARCH_API_MAX_LIMIT
+    assert body['next_cursor']
+
+    following = admin.get(f"/api/advanced_search?limit=10000000&cursor={body['next_cursor']}").get_json()
+    numbers = {result['number'] for result in body['results']}
+    assert numbers.isdisjoint(result['number'] for result in following['results'])
+    assert len(admin.get('/api/advanced_search?limit=0').get_json()['results']) == 1
@@ -0,0 +1,109 @@
+# تجميعات لوحة التحكم مقارنة بالمرور على كل الصفوف كما كانت تُحسب في كل طلب
+
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows
+
+@pytest.fixture
+def rows():
+    rows = generate_main_rows(4000, days=60, seed=6)
+    # فاتورة تمتد على يومين، وصفوف لا تدخل في الإيرادات
+    rows[2000][1] = rows[1000][1]
+    rows[2001][0], rows[2002][2], rows[2003][1] = '', 'N/A', ''
+    return rows
+
+def _valid_rows(ds):
+    return [i for i in range(len(ds)) if ds.row_lengths[i] > main.MAIN_COLUMNS['amount'] and not np.isnan(ds.amounts[i])
+            and ds.invoice_ok[i] and not np.isnat(ds.dates[i])]
+
+def _naive_totals(ds, first_day, last_day):
+    totals = {'revenue': 0.0, 'by_payment': {}, 'by_cashier': {}}
+    for i in _valid_rows(ds):
+        if first_day <= ds.dates[i].astype('datetime64[D]').astype(date) <= last_day:
+            totals['revenue'] += ds.amounts[i]
+            for name, code in (('by_payment', ds.payment_codes[i]), ('by_cashier', ds.cashier_codes[i])):
+                totals[name][int(code)] = totals[name].get(int(code), 0.0) + ds.amounts[i]
+    return totals
+
+def _assert_totals(actual, expected):
+    assert actual['revenue'] == pytest.approx(expected['revenue'])
+    for name in ('by_payment', 'by_cashier'):
+        assert actual[name] == pytest.approx(expected[name])
+
+PERIODS = [(0, 0), (0, 6), (10, 25), (0, 59), (59, 59)]
+
+def test_period_totals_match_per_row_sums(rows):
+    ds = main.SheetDataset(rows, 'main')
+    rollup = ds.rollup()
+    today = date.today()
+    for lo, hi in PERIODS:
+        first_day, last_day = today - timedelta(days=hi), today - timedelta(days=lo)
+        _assert_totals(rollup.period_totals(first_day, last_day), _naive_totals(ds, first_day, last_day))
+
+def test_extended_rollup_matches_fresh_and_keeps_base(rows):
+    base = main.SheetDataset(rows[:1500], 'main')
+    base_rollup = base.rollup()
+    today = date.today()
+    before = {period: base_rollup.period_totals(today - timedelta(days=period[1]), today - timedelta(days=period[0])) for period in PERIODS}
+
+    dataset = base.appended(rows[1500:])
+    fresh = main.SheetDataset(rows, 'main').rollup()
+    for lo, hi in PERIODS:
+        first_day, last_day = today - timedelta(days=hi), today - timedelta(days=lo)
+        _assert_totals(dataset.rollup().period_totals(first_day, last_day), fresh.period_totals(first_day, last_day))
+        # النسخة السابقة ما زالت تُعرض للطلبات الجارية فلا تتغير
+        _assert_totals(base_rollup.period_totals(first_day, last_day), before[(lo, hi)])
+
+def test_dashboard_stats_match_per_row_computation(rows):
+    ds = main.SheetDataset(rows, 'main')
+    today = date.today()
+    start = main.billing_period_start(today)
+    period = _naive_totals(ds, start, today)
+    # الفاتورة تُحسب في يوم أول سطر لها
+    first_days = {}
+    for i in range(len(ds)):
+        if ds.invoice_ok[i] and not np.isnat(ds.dates[i]):
+            first_days.setdefault(int(ds.invoice_numbers[i]), ds.dates[i].astype('datetime64[D]').astype(date))
+    invoices = sum(start <= day <= today for day in first_days.values())
+
+    assert main.get_dashboard_stats(ds) == {
+        'total_revenue': f"{period['revenue']:,.2f}",
+        'total_invoices': invoices,
+        'avg_invoice': f"{period['revenue'] / invoices:,.2f}",
+        'today_revenue': f"{_naive_totals(ds, today, today)['revenue']:,.2f}",
+    }
+
+def _naive_top(ds, cutoff, by):
+    """أفضل العملاء والكاشير بالمرور على كل الصفوف (كل فاتورة في الشيت المولد برقم مختلف)"""
+    customers, cashiers = {}, {}
+    for i in _valid_rows(ds):
+        if cutoff is not None and ds.dates[i] < np.datetime64(cutoff, 'us'): continue
+        last = (int(ds.dates[i].astype(np.int64)), i)
+        phone = main.normalize_phone(ds.phone_texts[i])
+        for totals, key in ((customers, phone), (cashiers, int(ds.cashier_codes[i]))):
+            if key == '': continue
+            revenue, visits, previous = totals.get(key, (0.0, 0, (0, -1)))
+            totals[key] = (revenue + ds.amounts[i], visits + 1, max(previous, last))
+    rank = main.TOP_CUSTOMER_RANKINGS[by]
+    top_customers = sorted(customers.values(), key=lambda entry: (entry[rank], entry[1 - rank], entry[2]), reverse=True)[:10]
+    top_cashiers = sorted(cashiers.items(), key=lambda item: item[1], reverse=True)[:10]
+    return ([(ds.customer_phones[last[1]], pytest.approx(revenue), visits) for revenue, visits, last in top_customers],
+            [(ds.cashier_categories[code], pytest.approx(revenue), visits) for code, (revenue, visits, _) in top_cashiers])
+
+@pytest.mark.parametrize('time_period', ['all', 'week', 'day'])
+@pytest.mark.parametrize('by', ['revenue', 'visits'])
+def test_top_customers_and_cashiers_match_per_row_totals(rows, monkeypatch, time_period, by):
+    # فاتورة واحدة لكل صف، والحد ثابت حتى لا يتغير بين الحسابين
+    for i, row in enumerate(rows): row[1] = str(1000 + i)
+    ds = main.SheetDataset(rows, 'main')
+    cutoff = None if time_period == 'all' else datetime.now() - timedelta(days=main.TIME_PERIOD_DAYS[time_period])
+    monkeypatch.setattr(main, 'period_cutoff', lambda time_period: cutoff)
+
+    customers, cashiers = main.analyze_top_customers(ds, time_period, by)
+    assert ([(c['phone'], c['total_spent'], c['visit_count']) for c in customers],
+            [(c['name'], c['total_revenue'], c['invoice_count']) for c in cashiers]) == _naive_top(ds, cutoff, by)
+    assert len(customers) == 10
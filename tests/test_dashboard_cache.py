@@ -0,0 +1,38 @@
+# ذاكرة صفحات لوحة التحكم المعروضة
+
+import pytest
+
+import main
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = main.RenderedPageCache(main.DASHBOARD_CACHE_BYTES)
+    monkeypatch.setattr(main, 'dashboard_cache', cache)
+    return cache
+
+def test_size_is_counted_in_utf8_bytes():
+    cache = main.RenderedPageCache(1000)
+    assert cache.get_or_render('a', lambda: 'ب' * 400) == ('ب' * 400).encode('utf-8')
+    assert cache.status()['bytes'] == 800
+    # 600 حرف عربي = 1200 بايت، أكبر من الحد فلا تُحفظ
+    cache.get_or_render('b', lambda: 'ب' * 600)
+    assert cache.status() == {'entries': 1, 'bytes': 800, 'hits': 0, 'misses': 2}
+
+def test_dashboard_is_rendered_once_per_key(admin, sheets, cache):
+    first = admin.post('/dashboard', data={'time_period': 'month'})
+    second = admin.post('/dashboard', data={'time_period': 'month'})
+    assert first.status_code == second.status_code == 200
+    assert first.mimetype == 'text/html'
+    assert first.get_data() == second.get_data()
+    assert (cache.hits, cache.misses) == (1, 1)
+    admin.post('/dashboard', data={'time_period': 'week'})
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_dashboard_error_is_part_of_the_cached_page(admin, sheets, cache):
+    sheets['sales'] = None
+    for _ in range(2):
+        html = admin.post('/dashboard', data={'time_period': 'all'}).get_data(as_text=True)
+        assert 'لا يمكن الوصول إلى شيت المبيعات.' in html
+    with admin.session_transaction() as session:
+        assert not session.get('_flashes')
+    assert cache.hits == 1
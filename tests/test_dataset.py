@@ -0,0 +1,66 @@
+# SheetDataset: الأعمدة المحللة مرة واحدة مقارنة بتحليل كل صف على حدة كما كانت الطلبات تفعل
+
+import numpy as np
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows, generate_sales_rows
+
+def _datetime64(value):
+    dt_object = main.parse_date_safely(value)
+    return np.datetime64('NaT', 's') if dt_object is None else np.datetime64(dt_object.replace(tzinfo=None), 's')
+
+def _cell(row, j):
+    # الخلايا الناقصة في نهاية الصف القصير
+    return row[j] if j < len(row) else None
+
+def _assert_main_columns(ds, rows):
+    cols = main.MAIN_COLUMNS
+    assert len(ds) == len(rows)
+    np.testing.assert_array_equal(ds.dates, [_datetime64(row[cols['date']]) for row in rows])
+    np.testing.assert_array_equal(ds.amounts, [main._to_float(row[cols['amount']]) for row in rows])
+    numbers = [main._to_invoice_number(row[cols['invoice']]) for row in rows]
+    assert ds.invoice_ok.tolist() == [n is not None for n in numbers]
+    assert ds.invoice_numbers[ds.invoice_ok].tolist() == [n for n in numbers if n is not None]
+    for i, row in enumerate(rows):
+        assert ds.cashier(i) == _cell(row, cols['cashier'])
+        assert ds.customer_name(i) == _cell(row, cols['customer_name'])
+        assert ds.payment_categories[ds.payment_codes[i]] == str(row[cols['payment']]).strip()
+        assert ds.invoice_texts[i] == main._cell_text(row[cols['invoice']])
+        assert ds.phone_texts[i] == main._cell_text(_cell(row, cols['customer_phone']))
+        assert list(ds[i]) == row
+
+@pytest.fixture
+def main_rows():
+    rows = generate_main_rows(1500, days=30, seed=4)
+    # قيم شاذة كما تظهر في الشيت: خلايا فارغة، صف قصير، مبلغ نصي، رقم فاتورة عشري وتاريخ غير مفهوم
+    rows[3][1], rows[5][2], rows[7][0] = '1234.0', 'N/A', 'غير معروف'
+    rows[9] = rows[9][:4]
+    rows[11][1] = ' 77 '
+    return rows
+
+def test_main_columns_match_per_row_parsing(main_rows):
+    _assert_main_columns(main.SheetDataset(main_rows, 'main'), main_rows)
+
+def test_appended_version_matches_fresh_parse_and_leaves_base_unchanged(main_rows):
+    base = main.SheetDataset(main_rows[:1000], 'main')
+    categories = list(base.customer_categories)
+    dataset = base.appended(main_rows[1000:])
+
+    _assert_main_columns(dataset, main_rows)
+    _assert_main_columns(base, main_rows[:1000])
+    assert base.customer_categories == categories
+    # نفس الأكواد للقيم المتكررة عبر النسختين
+    assert dataset.customer_codes[:1000].tolist() == base.customer_codes.tolist()
+
+def test_sales_columns_match_per_row_parsing():
+    rows = generate_sales_rows(1000, days=30, seed=4)
+    rows[2][3], rows[4][2] = '2,5', '  LEGO CITY  '
+    ds = main.SheetDataset(rows, 'sales')
+    cols = main.SALES_COLUMNS
+    np.testing.assert_array_equal(ds.dates, [_datetime64(row[cols['date']]) for row in rows])
+    np.testing.assert_array_equal(ds.quantities, [main._to_float(str(row[cols['quantity']]).replace(',', '.')) for row in rows])
+    np.testing.assert_array_equal(ds.amounts, [main._to_float(row[cols['amount']]) for row in rows])
+    assert [ds.item_categories[code] for code in ds.item_codes] == [str(row[cols['item_code']]).strip() for row in rows]
+    assert list(ds.descriptions) == [str(row[cols['description']]).strip() for row in rows]
+    assert ds.quantities[2] == 2.5
@@ -0,0 +1,38 @@
+# تحليل التواريخ: المسار السريع لتنسيق Oracle وأرقام Excel التسلسلية، وdateutil للقيم الأخرى فقط
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import main
+
+def _column(values):
+    return [None if np.isnat(value) else value.astype(datetime) for value in main.parse_date_column(values)]
+
+@pytest.mark.parametrize('text, expected', [
+    ('17-OCT-26 10.54.22 AM +03:00', datetime(2026, 10, 17, 10, 54, 22)),
+    ('01-JAN-25 12.00.05 AM +03:00', datetime(2025, 1, 1, 0, 0, 5)),
+    ('28-FEB-24 12.30.00 PM +03:00', datetime(2024, 2, 28, 12, 30)),
+    ('09-DEC-25 11.59.59 PM', datetime(2025, 12, 9, 23, 59, 59)),
+    ('5-MAY-25 1.02.03 PM +03:00', datetime(2025, 5, 5, 13, 2, 3)),
+])
+def test_oracle_timestamps(text, expected):
+    assert main.parse_date_safely(text) == expected
+    assert _column([text] * 60) == [expected] * 60
+
+def test_excel_serials():
+    assert main.parse_date_safely(45658) == datetime(2025, 1, 1)
+    assert main.parse_date_safely(45658.75) == datetime(2025, 1, 1, 18)
+    values = [45658 + day for day in range(40)] + ['2025-03-01', '', None, '01-JAN-25 10.00.00 AM +03:00']
+    assert _column(values) == ([datetime(2025, 1, 1 + day) if day < 31 else datetime(2025, 2, day - 30) for day in range(40)]
+                               + [datetime(2025, 3, 1), None, None, datetime(2025, 1, 1, 10)])
+
+def test_mixed_column_falls_back_per_value():
+    # العمود بتنسيق Oracle، مع قيم أخرى تُحلل كما كانت تُحلل من قبل
+    oracle = ['17-OCT-26 10.54.22 AM +03:00'] * 50
+    others = ['2025-07-11', '2025-07-11 14:30:00', 45658, 'يوم 3 يوليو 2025', 'غير معروف', '', '31-FEB-25 10.00.00 AM']
+    parsed = _column(oracle + others)
+    assert parsed[:50] == [datetime(2026, 10, 17, 10, 54, 22)] * 50
+    assert parsed[50:] == [datetime(2025, 7, 11), datetime(2025, 7, 11, 14, 30), datetime(2025, 1, 1),
+                           main.parse_date_safely('يوم 3 يوليو 2025'), None, None, None]
@@ -0,0 +1,45 @@
+# تصدير نتائج البحث المتقدم وأكثر القطع مبيعاً كملفات CSV وXLSX
+
+import csv
+import io
+
+import pytest
+
+import main
+
+def test_csv_body(admin, sheets):
+    response = admin.get('/dashboard/export/csv?time_period=all&by=revenue')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/csv; charset=utf-8'
+    text = response.get_data().decode('utf-8')
+    assert text.startswith('﻿')
+    rows = list(csv.reader(io.StringIO(text[1:])))
+    items, _ = main.analyze_sales_data(sheets['sales'], 'all', by='revenue')
+    assert rows[0] == main.SALES_EXPORT_HEADER
+    assert rows[1:] == [[str(item[key]) for key in main.SALES_EXPORT_HEADER] for item in items]
+
+def test_xlsx_opens_with_openpyxl(admin, sheets):
+    openpyxl = pytest.importorskip('openpyxl')
+    response = admin.get('/advanced_search/export/xlsx?payment_method=cash')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == main.EXPORT_FORMATS['xlsx']
+    sheet = openpyxl.load_workbook(io.BytesIO(response.get_data())).active
+    rows = [list(row) for row in sheet.iter_rows(values_only=True)]
+    assert rows[0] == main.ADVANCED_SEARCH_EXPORT_HEADER
+    expected = list(main.advanced_search_export_rows({'payment_method': 'cash'}, sheets['main']))
+    assert rows[1:] == expected and len(expected) > 100
+
+def test_content_disposition_is_quoted():
+    header = main.content_disposition('أفضل المنتجات; x="1".csv')
+    assert header.startswith('attachment; filename="')
+    fallback = header.split('"')[1]
+    assert fallback.isascii() and ';' not in fallback
+    assert header.endswith("filename*=UTF-8''%D8%A3%D9%81%D8%B6%D9%84%20%D8%A7%D9%84%D9%85%D9%86%D8%AA%D8%AC%D8%A7%D8%AA%3B%20x%3D%221%22.csv")
+
+def test_export_filename_uses_known_values_only(admin, sheets):
+    response = admin.get('/dashboard/export/xlsx?time_period=week&by=quantity')
+    response.get_data()
+    assert response.headers['Content-Disposition'] == "attachment; filename=\"top_items_week_quantity.xlsx\"; filename*=UTF-8''top_items_week_quantity.xlsx"
+    for query in ('time_period=all;%20filename=x.exe', 'time_period=%D9%8A%D9%88%D9%85', 'by=%22'):
+        response = admin.get(f'/dashboard/export/csv?{query}')
+        assert response.status_code == 302 and 'Content-Disposition' not in response.headers
@@ -0,0 +1,59 @@
+# /metrics: من يمكنه قراءتها، وصيغة Prometheus، وتسجيل مراحل الطلب
+
+import re
+
+import pytest
+
+import main
+
+def test_metrics_need_admin_session_without_token(client, monkeypatch):
+    monkeypatch.delenv('METRICS_TOKEN', raising=False)
+    assert client.get('/metrics').status_code == 404
+    with client.session_transaction() as session:
+        session.update(username='cashier', user_id=2, logged_in=True)
+    assert client.get('/metrics').status_code == 404
+
+def test_admin_session_reads_metrics(admin, monkeypatch):
+    monkeypatch.delenv('METRICS_TOKEN', raising=False)
+    response = admin.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE hedeya_stage_seconds histogram' in response.get_data(as_text=True)
+
+def test_token_replaces_the_session(admin, monkeypatch):
+    monkeypatch.setenv('METRICS_TOKEN', 's3cret')
+    anonymous = main.app.test_client()
+    assert anonymous.get('/metrics').status_code == 401
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    # جلسة المدير وحدها لا تكفي عند تحديد التوكن
+    assert admin.get('/metrics').status_code == 401
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+def test_render_prometheus_format():
+    metrics = main.Metrics()
+    metrics.define('t_seconds', 'histogram', 'Test latency', (0.1, 1))
+    metrics.define('t_total', 'counter', 'Test events')
+    for value in (0.05, 0.5, 0.5, 3):
+        metrics.observe('t_seconds', value, stage='a')
+    metrics.inc('t_total', kind='say "hi"\n')
+    metrics.collectors.append(lambda: [('t_total', {'kind': 'collected'}, 7)])
+
+    assert metrics.render().splitlines() == [
+        '# HELP t_seconds Test latency', '# TYPE t_seconds histogram',
+        't_seconds_bucket{stage="a",le="0.1"} 1', 't_seconds_bucket{stage="a",le="1"} 3', 't_seconds_bucket{stage="a",le="+Inf"} 4',
+        't_seconds_sum{stage="a"} 4.05', 't_seconds_count{stage="a"} 4',
+        '# HELP t_total Test events', '# TYPE t_total counter',
+        't_total{kind="collected"} 7', 't_total{kind="say \\"hi\\"\\n"} 1',
+    ]
+
+def _stage_count(admin, stage):
+    text = admin.get('/metrics').get_data(as_text=True)
+    match = re.search(rf'^hedeya_stage_seconds_count\{{stage="{stage}"\}} (\d+)$', text, re.M)
+    return int(match.group(1)) if match else 0
+
+@pytest.mark.parametrize('stage', ['filter', 'render'])
+def test_search_records_its_stages(admin, sheets, monkeypatch, stage):
+    monkeypatch.delenv('METRICS_TOKEN', raising=False)
+    before = _stage_count(admin, stage)
+    admin.post('/search', data={'query': sheets['main'][0][1], 'search_type': 'invoice'})
+    assert _stage_count(admin, stage) == before + 1
@@ -0,0 +1,265 @@
+# SheetRefresher مع عميل gspread وهمي: الشيت في الذاكرة، وكل قراءة كاملة تُعدّ
+
+import re
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows, generate_sales_rows
+
+HEADER = ['date', 'invoice', 'amount', 'payment', 'cashier', 'customer', 'phone']
+
+class FakeWorksheet:
+    title, spreadsheet_id = 'الورقة1', 'fake'
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.client = self
+        self.fetches = self.batch_gets = 0
+        # يُفتح عند بدء القراءة ويُنتظر قبل إعادتها، لإبقاء التحميل جارياً أثناء الاختبار
+        self.started, self.release = threading.Event(), threading.Event()
+        self.release.set()
+
+    def get_all_values(self, value_render_option=None):
+        self.fetches += 1
+        rows = [list(row) for row in self.rows]
+        self.started.set()
+        self.release.wait(10)
+        return [HEADER] + rows
+
+    def values_batch_get(self, spreadsheet_id, ranges, params=None):
+        """نطاقات مثل 'الورقة1'!A2:K2 أو 'الورقة1'!A10:K؛ الصف 1 هو العنوان"""
+        self.batch_gets += 1
+        values = []
+        for name in ranges:
+            first, last = re.search(r'!A(\d+):[A-Z]+(\d*)$', name).groups()
+            values.append({'values': [list(row) for row in self.rows[int(first) - 2:int(last) - 1 if last else None]]})
+        return {'valueRanges': values}
+
+class FakeClient:
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def open_by_url(self, url):
+        return self
+
+    def worksheet(self, name):
+        return self._worksheet
+
+@pytest.fixture
+def sheet(tmp_path, monkeypatch):
+    """شيت فواتير وهمي، ومجلد عمل فارغ للقطة المحلية وconfig.ini"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'config.ini').write_text('[GSPREAD]\nsheet_url = https://example.invalid/main\nsales_sheet_url = https://example.invalid/sales\n')
+    worksheet = FakeWorksheet(generate_main_rows(2000, days=60, seed=1))
+    monkeypatch.setattr(main, 'get_gspread_client', lambda: FakeClient(worksheet))
+    monkeypatch.setattr(main, 'sheets_connection', main.SheetsConnection())
+    return worksheet
+
+def _refresher():
+    refresher = main.SheetRefresher(('main',))
+    # بدون thread التحديث الدوري: الاختبار يتحكم في كل تحديث
+    refresher.start = lambda: None
+    return refresher
+
+def _failing_prepare(dataset):
+    raise RuntimeError('index build failed')
+
+def test_cold_start_falls_back_to_local_snapshot_when_prepare_fails(sheet, monkeypatch):
+    main.save_data_locally(main.SheetDataset(sheet.rows[:1500], 'main'), 'main', synced_at=0, incremental_since_full_sync=0)
+    refresher = _refresher()
+    monkeypatch.setattr(refresher, '_prepare', _failing_prepare)
+
+    # التحميل الكامل حُفظ محلياً قبل فشل التجهيز، فيُستخدم كبيانات محلية بدلاً من رفع الخطأ أو KeyError
+    data = refresher.get('main')
+    assert len(data) == len(sheet.rows)
+    assert refresher.last_error['main'] == 'index build failed'
+    assert refresher.failures['main'] == 1
+
+def test_failed_prepare_keeps_serving_previous_snapshot(sheet, monkeypatch):
+    refresher = _refresher()
+    previous = refresher.get('main')
+    sheet.rows = sheet.rows + generate_main_rows(50, days=1, seed=2)
+    # اللقطة حُدّثت للتو، فبدون هذا لا يتصل التحديث بالشيت
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+    monkeypatch.setattr(refresher, '_prepare', _failing_prepare)
+
+    assert refresher.refresh('main') is False
+    assert sheet.fetches == 1   # تحديث تزايدي: الصفوف الجديدة فقط
+    assert refresher.get('main') is previous
+    assert refresher.last_error['main'] == 'index build failed'
+
+def test_appended_rows_use_incremental_sync(sheet, monkeypatch):
+    refresher = _refresher()
+    refresher.get('main')
+    sheet.rows = sheet.rows + generate_main_rows(30, days=1, seed=2)
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+
+    assert refresher.refresh('main')
+    assert (sheet.fetches, sheet.batch_gets) == (1, 1)
+    assert [list(row) for row in refresher.get('main')[-30:]] == sheet.rows[-30:]
+
+def test_prepended_rows_use_full_sync(sheet, monkeypatch):
+    # الشيت بالأحدث أولاً: اليوم الجديد يُضاف في أعلاه
+    sheet.rows = sheet.rows[::-1]
+    refresher = _refresher()
+    refresher.get('main')
+    sheet.rows = generate_main_rows(30, days=1, seed=2)[::-1] + sheet.rows
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+
+    assert refresher.refresh('main')
+    # بدون طلب تزايدي يفشل في مقارنة أول صف
+    assert (sheet.fetches, sheet.batch_gets) == (2, 0)
+    data = refresher.get('main')
+    assert len(data) == len(sheet.rows)
+    assert [list(row) for row in data[:30]] == sheet.rows[:30]
+
+def test_published_dataset_carries_its_generation(sheet, monkeypatch):
+    refresher = _refresher()
+    previous = refresher.get('main')
+    sheet.rows = sheet.rows + generate_main_rows(30, days=1, seed=2)
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+    # المستمع (مثل إفراغ صفحات لوحة التحكم) يُستدعى لحظة النشر، وأي طلب في تلك اللحظة يبني مفتاحه بنفس الطريقة
+    seen = []
+    refresher.listeners.append(lambda sheet_type: seen.append(
+        (refresher.data_version(refresher.snapshots[sheet_type]), refresher.data_version(previous))))
+
+    assert refresher.refresh('main')
+    generation = main.read_snapshot_metadata('main')['generation']
+    assert seen == [(f'main:{generation}', f'{id(previous):x}:{len(previous)}')]
+    assert refresher.get_offline('main') is refresher.get('main')
+
+def _threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads: thread.start()
+    return threads
+
+def test_cold_cache_fetches_once_for_concurrent_requests(sheet):
+    refresher = _refresher()
+    sheet.release.clear()
+    results = []
+    threads = _threads(8, lambda: results.append(refresher.get('main')))
+    assert sheet.started.wait(10)
+    sheet.release.set()
+    for thread in threads: thread.join(10)
+
+    assert sheet.fetches == 1
+    assert len(results) == 8 and all(data is results[0] for data in results)
+    assert refresher.stats['main']['upstream_fetches'] == 1
+
+def _prepared(data):
+    """النسخة المنشورة كاملة: فهارسها مبنية لكل صفوفها"""
+    return all(part is not None and part.size == len(data) for part in (data._rollup, data._query_index, data._invoice_table))
+
+def test_concurrent_refresh_never_exposes_partial_dataset(sheet):
+    refresher = _refresher()
+    before = refresher.get('main')
+    sheet.rows = sheet.rows + generate_main_rows(500, days=1, seed=2)
+    sheet.started.clear()
+    sheet.release.clear()
+
+    seen, done = [], threading.Event()
+    def read():
+        while not done.is_set():
+            data = refresher.get('main')
+            seen.append((len(data), _prepared(data)))
+    readers = _threads(4, read)
+    writer = _threads(1, lambda: refresher.refresh('main', full=True))[0]
+    assert sheet.started.wait(10)
+    sheet.release.set()
+    writer.join(10)
+    done.set()
+    for thread in readers: thread.join(10)
+
+    after = refresher.get('main')
+    assert len(before) == 2000 and len(after) == 2500
+    assert {length for length, _ in seen} <= {2000, 2500}
+    assert all(prepared for _, prepared in seen)
+
+def test_second_worker_reads_the_shared_snapshot(sheet, monkeypatch):
+    # عاملا gunicorn في نفس المجلد: الأول يحمّل من الشيت والثاني يقرأ ما كتبه
+    first, second = _refresher(), _refresher()
+    first.get('main')
+    assert len(second.get('main')) == len(sheet.rows)
+    assert sheet.fetches == 1
+    assert second.stats['main']['shared_loads'] == 1
+    assert first.data_version(first.get('main')) == second.data_version(second.get('main'))
+
+    sheet.rows = sheet.rows + generate_main_rows(30, days=1, seed=2)
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+    assert first.refresh('main')
+    second.poll_shared('main')
+    assert len(second.get('main')) == len(sheet.rows)
+    assert (sheet.fetches, sheet.batch_gets) == (1, 1)
+    assert first.data_version(first.get('main')) == second.data_version(second.get('main'))
+
+@pytest.mark.skipif(main.fcntl is None, reason='قفل الملفات بين العمليات غير متاح')
+def test_busy_shared_lock_keeps_serving_without_fetching(sheet, monkeypatch):
+    refresher = _refresher()
+    before = refresher.get('main')
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+    # عملية أخرى تحمل قفل الشيت
+    holder = subprocess.Popen([sys.executable, '-c', 'import fcntl, sys\n'
+                               'f = open("local_data_main.lock", "a"); fcntl.flock(f, fcntl.LOCK_EX)\n'
+                               'print("locked", flush=True); sys.stdin.read()'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == 'locked'
+        with main.shared_sheet_lock('main', timeout=0.3) as acquired:
+            assert acquired is False
+        assert refresher.refresh('main')
+        assert refresher.get('main') is before
+        assert refresher.stats['main']['lock_busy'] == 1
+        assert sheet.fetches == 1
+    finally:
+        holder.communicate('')
+    with main.shared_sheet_lock('main') as acquired:
+        assert acquired is True
+
+@pytest.fixture
+def sheets(sheet, monkeypatch):
+    """شيت الفواتير وشيت المبيعات، كل منهما برابطه في config.ini"""
+    sales = FakeWorksheet(generate_sales_rows(1000, days=60, seed=1))
+    worksheets = {'https://example.invalid/main': sheet, 'https://example.invalid/sales': sales}
+    monkeypatch.setattr(main, 'get_gspread_client', lambda: type('Client', (), {'open_by_url': lambda self, url: FakeClient(worksheets[url])})())
+    return worksheets.values()
+
+def test_get_many_loads_sheets_in_parallel(sheets):
+    refresher = main.SheetRefresher(('main', 'sales'))
+    refresher.start = lambda: None
+    for worksheet in sheets: worksheet.release.clear()
+    results = []
+    loader = _threads(1, lambda: results.append(refresher.get_many(('main', 'sales'))))[0]
+    # كلا التحميلين بدأ قبل أن ينتهي أي منهما
+    assert all(worksheet.started.wait(10) for worksheet in sheets)
+    for worksheet in sheets: worksheet.release.set()
+    loader.join(10)
+
+    data = results[0]
+    assert [len(data[sheet_type]) for sheet_type in ('main', 'sales')] == [len(worksheet.rows) for worksheet in sheets]
+    assert [worksheet.fetches for worksheet in sheets] == [1, 1]
+
+def test_get_many_uses_local_data_after_the_deadline(sheets):
+    main_sheet, sales_sheet = sheets
+    # لقطة قديمة بدون عداد التحديثات التزايدية، فالتحميل التالي كامل
+    main.save_data_locally(main.SheetDataset(main_sheet.rows[:1500], 'main'), 'main', synced_at=0)
+    refresher = main.SheetRefresher(('main', 'sales'))
+    refresher.start = lambda: None
+    main_sheet.release.clear()
+    try:
+        data = refresher.get_many(('main', 'sales'), timeout=0.5)
+        # الشيت المتأخر من اللقطة المحلية، والآخر من Google Sheets
+        assert len(data['main']) == 1500 and len(data['sales']) == len(sales_sheet.rows)
+        assert refresher.stats['main']['deadline_misses'] == 1
+        assert main_sheet.started.is_set()
+    finally:
+        main_sheet.release.set()
+    # التحميل المتأخر يكتمل في الخلفية
+    with refresher._locks['main']:
+        pass
+    assert len(refresher.get('main')) == len(main_sheet.rows)
+    assert refresher.refresh_many(('main', 'sales'), full=True) == {'main': True, 'sales': True}
+    assert [worksheet.fetches for worksheet in sheets] == [2, 2]
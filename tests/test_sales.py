@@ -0,0 +1,78 @@
+# تحليل شيت المبيعات مقارنة بالمرور على كل الصفوف
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import main
+from benchmarks.synthetic import generate_sales_rows
+
+@pytest.fixture
+def rows():
+    rows = generate_sales_rows(4000, days=60, seed=9, items=300)
+    # صفوف لا تدخل في التحليل أو تدخل بدون إيرادات
+    rows[10][0], rows[20][3], rows[30][1], rows[40][4] = '', 'N/A', '', 'N/A'
+    rows[50] = rows[50][:3]
+    return rows
+
+def _window(ds, cutoff):
+    """صفوف التحليل بترتيب التاريخ ثم الصف"""
+    valid = [i for i in range(len(ds)) if ds.row_lengths[i] > main.SALES_COLUMNS['quantity'] and not np.isnat(ds.dates[i])
+             and not np.isnan(ds.quantities[i]) and ds.item_categories[ds.item_codes[i]]
+             and (cutoff is None or ds.dates[i] >= np.datetime64(cutoff, 'us'))]
+    return sorted(valid, key=lambda i: (ds.dates[i], i))
+
+def _naive_items(ds, cutoff, by):
+    items = {}
+    for i in _window(ds, cutoff):
+        code = ds.item_categories[ds.item_codes[i]]
+        first, quantity, revenue, returns = items.get(code, (i, 0.0, 0.0, 0))
+        amount = 0.0 if np.isnan(ds.amounts[i]) else ds.amounts[i]
+        items[code] = (min(first, i), quantity + ds.quantities[i], revenue + amount, returns + int(ds.quantities[i] < 0))
+    order = sorted(items.items(), key=lambda item: (-item[1][2 if by == 'revenue' else 1], item[1][0]))
+    return [(code, ds.descriptions[first], quantity, round(revenue, 2), returns) for code, (first, quantity, revenue, returns) in order]
+
+def _cutoff(monkeypatch, time_period):
+    cutoff = None if time_period == 'all' else datetime.now() - timedelta(days=main.TIME_PERIOD_DAYS[time_period])
+    monkeypatch.setattr(main, 'period_cutoff', lambda time_period: cutoff)
+    return cutoff
+
+@pytest.mark.parametrize('time_period', ['all', 'month', 'week'])
+@pytest.mark.parametrize('by', ['quantity', 'revenue'])
+def test_items_match_per_row_totals(rows, monkeypatch, time_period, by):
+    ds = main.SheetDataset(rows, 'sales')
+    cutoff = _cutoff(monkeypatch, time_period)
+    items, error = main.analyze_sales_data(ds, time_period, by)
+    assert error is None
+    assert [(item['كود القطعه'], item['الوصف'], item['الكمية'], item['الإيرادات'], item['المرتجعات']) for item in items] == [
+        (code, description, pytest.approx(quantity), pytest.approx(revenue), returns)
+        for code, description, quantity, revenue, returns in _naive_items(ds, cutoff, by)]
+
+@pytest.mark.parametrize('time_period', ['all', 'week'])
+def test_trends_match_per_row_totals(rows, monkeypatch, time_period):
+    ds = main.SheetDataset(rows, 'sales')
+    cutoff = _cutoff(monkeypatch, time_period)
+    expected = {'daily': {}, 'weekly': {}}
+    for i in _window(ds, cutoff):
+        day = ds.dates[i].astype('datetime64[D]').astype(datetime)
+        # الأسبوع يبدأ السبت
+        for name, key in (('daily', day), ('weekly', day - timedelta(days=(day.weekday() + 2) % 7))):
+            quantity, revenue, returns = expected[name].get(key, (0.0, 0.0, 0))
+            amount = 0.0 if np.isnan(ds.amounts[i]) else ds.amounts[i]
+            expected[name][key] = (quantity + ds.quantities[i], revenue + amount, returns + int(ds.quantities[i] < 0))
+
+    trends = main.analyze_sales_trends(ds, time_period)
+    for name in ('daily', 'weekly'):
+        assert [(point['date'], point['quantity'], point['revenue'], point['returns']) for point in trends[name]] == [
+            (str(key), pytest.approx(quantity), pytest.approx(round(revenue, 2)), returns)
+            for key, (quantity, revenue, returns) in sorted(expected[name].items())]
+
+def test_appended_rows_extend_the_index(rows, monkeypatch):
+    _cutoff(monkeypatch, 'all')
+    base = main.SheetDataset(rows[:3000], 'sales')
+    before = main.analyze_sales_data(base, 'all')[0]
+    dataset = base.appended(rows[3000:])
+    assert main.analyze_sales_data(dataset, 'all')[0] == main.analyze_sales_data(main.SheetDataset(rows, 'sales'), 'all')[0]
+    # نتائج النسخة السابقة المحفوظة لا تتغير
+    assert main.analyze_sales_data(base, 'all')[0] == before
@@ -0,0 +1,77 @@
+# فهارس البحث (الفواتير والهواتف وأسماء العملاء) وتوحيد الأسماء وأرقام الهواتف المستخدم فيها
+
+import pytest
+
+import main
+
+def _row(invoice, phone, customer=''):
+    return ['17-OCT-26 10.54.22 AM +03:00', str(invoice), 100, 'Cash', 'm.raafat', customer, phone, '', '', '', '']
+
+PHONES = ['01072478994', '01151234567', '+201099990000', '01555000111', '', '0100']
+
+@pytest.fixture
+def dataset():
+    return main.SheetDataset([_row(1000 + i, phone) for i, phone in enumerate(PHONES)], 'main')
+
+@pytest.mark.parametrize('query', ['5', '99', '0', '010', '5000', '٥'])
+def test_partial_phone_search_matches_linear_scan(dataset, query):
+    index = dataset.search_index('phone')
+    keys = index._keys(query)
+    expected = {i for i, phone in enumerate(PHONES)
+                if phone and any(key in text for key in keys for text in index._keys(phone))}
+    assert index.partial(query, len(dataset)) == expected
+
+def test_short_phone_query_returns_invoices(dataset):
+    # استعلام أقصر من الـ trigram كان يعيد صفر نتائج بعد فهرسة الـ n-grams
+    results = main.search_data_for_web('5', 'phone', dataset)
+    assert sorted(result['number'] for result in results) == ['1001', '1003']
+
+def test_normalize_name():
+    assert main.normalize_name('أَحْمَد') == 'احمد'
+    assert main.normalize_name('  مِنَّة   الله! ') == 'منه الله'
+    assert main.normalize_name('إسلام_مصطفى') == main.normalize_name('اسلام مصطفي') == 'اسلام مصطفي'
+    assert main.normalize_name('MOHAMED ٣') == 'mohamed 3'
+
+@pytest.mark.parametrize('spellings', [('محمد', 'Mohamed', 'Muhammad', 'mohammed'), ('ساره', 'سارة', 'Sara', 'Sarah'), ('يوسف', 'Youssef', 'Yousef')])
+def test_name_skeleton_matches_transliterations(spellings):
+    assert len({main.name_skeleton(main.normalize_name(spelling)) for spelling in spellings}) == 1
+
+def test_name_skeleton_keeps_long_vowels():
+    assert main.name_skeleton('محمد') != main.name_skeleton('محمود')
+
+@pytest.mark.parametrize('text', ['01012345678', '+20 101 234 5678', '00201012345678', '201012345678', '1012345678',
+                                  '01012345678.0', '٠١٠١٢٣٤٥٦٧٨', '010-1234-5678'])
+def test_normalize_phone(text):
+    assert main.normalize_phone(text) == '01012345678'
+
+NAMES = ['محمد', 'محمد علي', 'أحمد محمد', 'Mohamed Ali', 'محمود', 'منة الله', 'ساره', '', 'Muhammad']
+
+@pytest.mark.parametrize('query, expected', [
+    ('مُحَمَّد', [('محمد', 4), ('محمد علي', 3), ('أحمد محمد', 3), ('Mohamed Ali', 1), ('Muhammad', 1)]),
+    ('Mohamed', [('Mohamed Ali', 3), ('محمد', 1), ('محمد علي', 1), ('أحمد محمد', 1), ('Muhammad', 1)]),
+    # استعلام أقصر من الـ trigram
+    ('مح', [('محمد', 2), ('محمد علي', 2), ('أحمد محمد', 2), ('محمود', 2)]),
+    ('منه', [('منة الله', 3)]),
+    ('سارة', [('ساره', 4)]),
+    ('Sara', [('ساره', 1)]),
+    ('!!', []),
+])
+def test_customer_name_ranking(query, expected):
+    index = main.CustomerNameIndex()
+    index.update(NAMES)
+    assert [(NAMES[code], score) for code, score in index.ranked(query, len(NAMES))] == expected
+
+def test_customer_name_index_only_sees_codes_within_limit():
+    index = main.CustomerNameIndex()
+    index.update(NAMES[:3])
+    index.update(NAMES)
+    # فهرس مشترك مع نسخة أحدث فيها أسماء أكثر
+    assert [NAMES[code] for code, _ in index.ranked('محمد', 2)] == ['محمد', 'محمد علي']
+
+def test_search_customers_groups_phone_spellings():
+    rows = [_row(1000, '01012345678', 'محمد'), _row(1001, '+201012345678', 'Mohamed'), _row(1002, '1012345678', ''),
+            _row(1003, '01198765432', 'محمود')]
+    ds = main.SheetDataset(rows, 'main')
+    [customer] = main.search_customers('+20 101 234 5678', ds)
+    assert customer['invoice_count'] == 3
+    assert [result['name'] for result in main.search_customers('محمد', ds)] == ['محمد', 'Mohamed']
@@ -0,0 +1,109 @@
+# عدد طلبات HTTP لكل تحديث، مع خادم Sheets محلي عبر GSPREAD_API_BASE_URL
+
+import collections
+import json
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import main
+from benchmarks.synthetic import generate_main_rows
+
+SPREADSHEET_ID = 'stub-main'
+TITLE = 'الورقة1'
+
+class SheetsStub(BaseHTTPRequestHandler):
+    """بيانات الشيت الوصفية، values.get وvalues:batchGet لشيت واحد في self.server.rows (الصف الأول عنوان)"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): pass
+
+    def _send(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _values(self, name):
+        """صفوف نطاق مثل 'الورقة1'!A2:G2 أو 'الورقة1'!A10:G أو الورقة كلها، بدون الخلايا الفارغة في نهاية الصف"""
+        match = re.search(r'!A(\d+):[A-Z]+(\d*)$', name)
+        first, last = (int(match.group(1)), int(match.group(2)) if match.group(2) else None) if match else (1, None)
+        values = []
+        for row in self.server.rows[first - 1:last]:
+            row = list(row)
+            while row and row[-1] == '': row.pop()
+            values.append(row)
+        return values
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        rest = urllib.parse.unquote(url.path[len(f'/v4/spreadsheets/{SPREADSHEET_ID}'):])
+        if rest == '':
+            self.server.requests['metadata'] += 1
+            return self._send({'spreadsheetId': SPREADSHEET_ID, 'properties': {'title': 'main'},
+                               'sheets': [{'properties': {'sheetId': 0, 'title': TITLE, 'index': 0,
+                                                          'gridProperties': {'rowCount': len(self.server.rows), 'columnCount': 11}}}]})
+        if rest == '/values:batchGet':
+            self.server.requests['batch_get'] += 1
+            ranges = urllib.parse.parse_qs(url.query)['ranges']
+            return self._send({'spreadsheetId': SPREADSHEET_ID, 'valueRanges': [{'range': r, 'values': self._values(r)} for r in ranges]})
+        self.server.requests['values'] += 1
+        name = rest[len('/values/'):]
+        return self._send({'range': name, 'majorDimension': 'ROWS', 'values': self._values(name)})
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SheetsStub)
+    server.rows = [['التاريخ'] * 7] + generate_main_rows(1000, days=30, seed=3)
+    server.requests = collections.Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    monkeypatch.setenv('GSPREAD_CREDENTIALS_JSON', json.dumps({
+        'type': 'service_account', 'project_id': 'stub', 'private_key_id': '1', 'private_key': key,
+        'client_email': 'stub@example.invalid', 'client_id': '1', 'token_uri': base_url + '/token',
+        # خارج googleapis.com توقّع google-auth الـ JWT بنفسها، فلا طلب token ولا بحث عن حدود المنطقة عبر الإنترنت
+        'universe_domain': 'stub.invalid'}))
+    monkeypatch.setenv('GSPREAD_API_BASE_URL', base_url)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'config.ini').write_text(f'[GSPREAD]\nsheet_url = https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/edit\n')
+    monkeypatch.setattr(main, 'sheets_connection', main.SheetsConnection())
+    # كل تحديث في الاختبار يتصل بالشيت حتى لو كانت اللقطة حديثة
+    monkeypatch.setattr(main, 'SHEET_REFRESH_INTERVAL', 0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _refresher():
+    refresher = main.SheetRefresher(('main',))
+    refresher.start = lambda: None
+    return refresher
+
+def test_request_counts_per_refresh(stub):
+    refresher = _refresher()
+    assert len(refresher.get('main')) == 1000
+    # أول تحميل: فتح الشيت ثم ورقة العمل (كلاهما يقرأ البيانات الوصفية في gspread)، وقراءة الورقة كاملة
+    assert stub.requests == {'metadata': 2, 'values': 1}
+
+    stub.rows += generate_main_rows(20, days=1, seed=4)
+    stub.requests.clear()
+    assert refresher.refresh('main')
+    assert len(refresher.get('main')) == 1020
+    # تحديث تزايدي: طلب batchGet واحد بأول صف وآخر صف معروفين والصفوف الجديدة
+    assert stub.requests == {'batch_get': 1}
+
+    stub.requests.clear()
+    assert refresher.refresh('main', full=True)
+    assert len(refresher.get('main')) == 1020
+    # تحميل كامل بمقبض ورقة العمل المحفوظ: بدون فتح الشيت مرة أخرى
+    assert stub.requests == {'values': 1}
+    assert main.sheets_connection.status()['http_requests'] == 5
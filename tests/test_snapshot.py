@@ -0,0 +1,108 @@
+# اللقطة المحلية: segments الشهور وأرشيف الشهور القديمة
+
+import os
+import pickle
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import main
+from benchmarks.synthetic import generate_main_rows
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def _assert_same_dataset(loaded, expected):
+    assert [list(row) for row in loaded] == [list(row) for row in expected]
+    for name in main.SheetDataset.NUMERIC_COLUMNS[expected.sheet_type]:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(expected, name))
+    for name in main.SheetDataset.TEXT_COLUMNS[expected.sheet_type]:
+        assert list(getattr(loaded, name)) == list(getattr(expected, name))
+    for name in main.SheetDataset.CATEGORY_COLUMNS[expected.sheet_type]:
+        assert getattr(loaded, f'{name}_categories') == getattr(expected, f'{name}_categories')
+
+def _segment_files(workdir):
+    return sorted(path.name for path in workdir.glob('local_data_main.*.seg'))
+
+def test_snapshot_round_trip(workdir):
+    rows = generate_main_rows(3000, days=90, end=datetime(2025, 7, 11), seed=3)
+    rows[10] = rows[10][:3]
+    rows[20][1], rows[30][2] = '000123', 12345678901234567890
+    dataset = main.SheetDataset(rows, 'main')
+    manifest = main.save_data_locally(dataset, 'main', synced_at=0, incremental_since_full_sync=0)
+
+    loaded = main.load_snapshot('main', manifest)
+    _assert_same_dataset(loaded, dataset)
+    # الصفوف الخام تبقى في الـ segments (mmap) دون نسخة في الذاكرة
+    assert loaded.rows.status()['heap_bytes'] == 0
+    assert not [name for name in os.listdir(workdir) if '.tmp-' in name]
+
+def test_appends_add_segments_and_compact_the_open_month(workdir, monkeypatch):
+    monkeypatch.setattr(main, 'SNAPSHOT_MAX_SEGMENTS', 3)
+    rows = generate_main_rows(2000, days=60, end=datetime(2025, 7, 11), seed=3)
+    dataset = main.SheetDataset(rows[:1800], 'main')
+    manifest = main.save_data_locally(dataset, 'main', synced_at=0, incremental_since_full_sync=0)
+    closed = [segment['file'] for segment in manifest['segments'][:-1]]
+
+    assert manifest['segments'][-1]['month'] == '2025-07'
+    for lo, hi in ((1800, 1850), (1850, 1900)):
+        dataset = dataset.appended(rows[lo:hi])
+        previous, manifest = manifest, main.save_data_locally(dataset, 'main', new_rows_count=hi - lo)
+        # الـ segments الموجودة لا يُعاد كتابتها
+        assert manifest['segments'][:-1] == previous['segments']
+        assert manifest['generation'] == previous['generation'] + 1
+    assert [segment['month'] for segment in manifest['segments'][-3:]] == ['2025-07'] * 3
+
+    dataset = dataset.appended(rows[1900:])
+    manifest = main.save_data_locally(dataset, 'main', new_rows_count=100)
+    # الشهر المفتوح أعيدت كتابته كـ segment واحد والشهور الأقدم كما هي
+    assert [segment['file'] for segment in manifest['segments'][:-1]] == closed
+    assert manifest['segments'][-1]['month'] == '2025-07'
+    assert _segment_files(workdir) == sorted(segment['file'] for segment in manifest['segments'])
+    _assert_same_dataset(main.load_snapshot('main', manifest), main.SheetDataset(rows, 'main'))
+
+def test_legacy_pickle_is_still_loaded(workdir):
+    rows = generate_main_rows(100, days=5, seed=3)
+    with open('local_data_main.pkl', 'wb') as f:
+        pickle.dump({'data': rows, 'timestamp': '2025-07-11 10:00:00'}, f)
+    _assert_same_dataset(main.load_data_locally('main'), main.SheetDataset(rows, 'main'))
+
+def _newest_first_rows():
+    # الشيت الحقيقي يضيف الأيام الجديدة في أعلاه
+    return generate_main_rows(4000, days=240, end=datetime(2025, 7, 11), seed=2)[::-1]
+
+def _months(dataset, lo, hi):
+    return set(dataset.dates[lo:hi].astype('datetime64[M]').astype(str).tolist())
+
+def test_newest_first_rows_get_one_segment_per_month(workdir):
+    dataset = main.SheetDataset(_newest_first_rows(), 'main')
+    manifest = main.save_data_locally(dataset, 'main', synced_at=0, incremental_since_full_sync=0)
+
+    months = [segment['month'] for segment in manifest['segments']]
+    assert months == sorted(_months(dataset, 0, len(dataset)), reverse=True)
+    start = 0
+    for segment in manifest['segments']:
+        assert _months(dataset, start, start + segment['rows']) == {segment['month']}
+        start += segment['rows']
+    assert start == len(dataset)
+
+def test_newest_first_snapshot_archives_old_months_at_the_end(workdir, monkeypatch):
+    monkeypatch.setattr(main, 'hot_window_start', lambda today=None: '2025-06')
+    rows = _newest_first_rows()
+    plain = main.SheetDataset([list(row) for row in rows], 'main')
+    manifest = main.save_data_locally(main.SheetDataset(rows, 'main'), 'main', synced_at=0, incremental_since_full_sync=0)
+
+    loaded = main.load_snapshot('main', manifest)
+    hot = int(np.count_nonzero(plain.dates >= np.datetime64('2025-06')))
+    assert (loaded.archive.offset, loaded.archive.stop) == (hot, len(plain))
+    assert max(loaded.archive.months) == '2025-05'
+    for name in main.SheetDataset.TEXT_COLUMNS['main']:
+        column, expected = getattr(loaded, name), getattr(plain, name)
+        assert list(column) == expected
+        assert column[hot - 5:hot + 5] == expected[hot - 5:hot + 5]
+        assert [column[i] for i in range(0, len(plain), 97)] == expected[::97]
+    # المرور على كل الشهور القديمة لا يُبقي منها في الذاكرة أكثر من COLD_PARTITIONS_RESIDENT
+    assert loaded.archive.status()['resident'] == main.COLD_PARTITIONS_RESIDENT < len(loaded.archive.months)